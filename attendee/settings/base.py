@@ -202,3 +202,30 @@ STORAGES = {
 }
 AWS_S3_SIGNATURE_VERSION = "s3v4"
 AWS_RECORDING_STORAGE_BUCKET_NAME = os.getenv("AWS_RECORDING_STORAGE_BUCKET_NAME")
+
+# Where per participant utterance audio is kept until it has been transcribed.
+# "database" stores it in Utterance.audio_blob, "s3" in the recording bucket and "local" on local disk, which is only useful for development.
+UTTERANCE_AUDIO_STORAGE = os.getenv("UTTERANCE_AUDIO_STORAGE", "database")
+UTTERANCE_AUDIO_LOCAL_DIRECTORY = os.getenv("UTTERANCE_AUDIO_LOCAL_DIRECTORY", "/tmp/utterance_audio")
+
+# How per participant utterance audio is encoded by the bot before it's stored: "pcm", "flac" (lossless) or "opus"
+UTTERANCE_AUDIO_FORMAT = os.getenv("UTTERANCE_AUDIO_FORMAT", "pcm")
+
+# How many utterances from the same batch a transcription worker sends to the transcription provider at once
+TRANSCRIPTION_MAX_CONCURRENCY = int(os.getenv("TRANSCRIPTION_MAX_CONCURRENCY", "4"))
+
+# Which workers transcribe per participant utterances: "celery" runs the process_utterances task,
+# "async" queues them for the run_transcription_worker management command
+TRANSCRIPTION_WORKER = os.getenv("TRANSCRIPTION_WORKER", "celery")
+
+# How long transcription results are remembered by the hash of their audio, so retries aren't transcribed and billed twice. 0 turns this off.
+TRANSCRIPTION_RESULTS_CACHE_TTL_SECONDS = int(os.getenv("TRANSCRIPTION_RESULTS_CACHE_TTL_SECONDS", "86400"))
+
+# Where bots stream audio to when realtime transcription is enabled. Can be pointed at a local mock server for testing.
+DEEPGRAM_STREAMING_URL = os.getenv("DEEPGRAM_STREAMING_URL", "wss://api.deepgram.com/v1/listen")
+# Where run_transcription_worker sends utterances to be transcribed. Can be pointed at a local mock server for testing.
+DEEPGRAM_LISTEN_URL = os.getenv("DEEPGRAM_LISTEN_URL", "https://api.deepgram.com/v1/listen")
+
+# Which workers deliver webhooks: "celery" runs a deliver_webhook task per delivery attempt,
+# "async" leaves pending delivery attempts for the run_webhook_dispatcher management command
+WEBHOOK_DISPATCHER = os.getenv("WEBHOOK_DISPATCHER", "celery")
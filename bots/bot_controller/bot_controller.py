@@ -6,6 +6,7 @@ import traceback
 
 import gi
 import redis
+from django.conf import settings
 from django.core.files.base import ContentFile
 from django.utils import timezone
 
@@ -26,20 +27,27 @@ from bots.models import (
     Recording,
     RecordingFormats,
     RecordingManager,
+    RecordingResolutions,
     RecordingStates,
+    TranscriptionTypes,
     Utterance,
 )
+from bots.transcription_client_cache import deepgram_client_cache
 from bots.utils import meeting_type_from_url
 
 from .audio_output_manager import AudioOutputManager
 from .automatic_leave_configuration import AutomaticLeaveConfiguration
 from .closed_caption_manager import ClosedCaptionManager
+from .encoder_profile import EncoderProfile
 from .file_uploader import FileUploader
 from .gstreamer_pipeline import GstreamerPipeline
 from .individual_audio_input_manager import IndividualAudioInputManager
 from .media_recorder_receiver import MediaRecorderReceiver
 from .pipeline_configuration import PipelineConfiguration
+from .realtime_transcriber import RealtimeTranscriber
 from .rtmp_client import RTMPClient
+from .utterance_persistence_worker import UtterancePersistenceWorker
+from .video_frame_rate_governor import VideoFrameRateGovernor
 
 gi.require_version("GLib", "2.0")
 from gi.repository import GLib
@@ -62,6 +70,7 @@ class BotController:
             automatic_leave_configuration=self.automatic_leave_configuration,
             add_encoded_mp4_chunk_callback=self.media_recorder_receiver.on_encoded_mp4_chunk,
             recording_view=self.bot_in_db.recording_view(),
+            send_video=self.pipeline_configuration.record_video,
             google_meet_closed_captions_language=self.bot_in_db.google_meet_closed_captions_language(),
             should_create_debug_recording=self.bot_in_db.create_debug_recording(),
         )
@@ -73,13 +82,15 @@ class BotController:
             display_name=self.bot_in_db.name,
             send_message_callback=self.on_message_from_adapter,
             meeting_url=self.bot_in_db.meeting_url,
-            add_video_frame_callback=self.gstreamer_pipeline.on_new_video_frame,
+            add_video_frame_callback=self.video_frame_rate_governor.on_new_video_frame,
             wants_any_video_frames_callback=self.gstreamer_pipeline.wants_any_video_frames,
+            video_frame_size=self.gstreamer_pipeline.video_frame_size,
             add_mixed_audio_chunk_callback=self.gstreamer_pipeline.on_mixed_audio_raw_data_received_callback,
             upsert_caption_callback=self.closed_caption_manager.upsert_caption,
             automatic_leave_configuration=self.automatic_leave_configuration,
             add_encoded_mp4_chunk_callback=None,
             recording_view=self.bot_in_db.recording_view(),
+            send_video=self.pipeline_configuration.record_video or self.pipeline_configuration.rtmp_stream_video,
             should_create_debug_recording=self.bot_in_db.create_debug_recording(),
         )
 
@@ -104,12 +115,32 @@ class BotController:
             zoom_client_id=zoom_oauth_credentials["client_id"],
             zoom_client_secret=zoom_oauth_credentials["client_secret"],
             meeting_url=self.bot_in_db.meeting_url,
-            add_video_frame_callback=self.gstreamer_pipeline.on_new_video_frame,
+            add_video_frame_callback=self.video_frame_rate_governor.on_new_video_frame,
             wants_any_video_frames_callback=self.gstreamer_pipeline.wants_any_video_frames,
+            video_frame_size=self.gstreamer_pipeline.video_frame_size,
             add_mixed_audio_chunk_callback=self.gstreamer_pipeline.on_mixed_audio_raw_data_received_callback,
             automatic_leave_configuration=self.automatic_leave_configuration,
         )
 
+    def get_realtime_transcriber(self):
+        from bots.tasks.process_utterance_task import get_deepgram_options
+
+        return RealtimeTranscriber(
+            url=settings.DEEPGRAM_STREAMING_URL,
+            api_key=deepgram_client_cache.get_api_key(self.bot_in_db.project_id),
+            options=get_deepgram_options(self.bot_in_db),
+            sample_rate=IndividualAudioInputManager.SAMPLE_RATE,
+            get_participant_callback=self.get_participant,
+            save_transcription_callback=self.utterance_persistence_worker.add_realtime_transcription,
+        )
+
+    def get_encoder_profile(self):
+        video_frame_size = {
+            RecordingResolutions.HD_720P: (1280, 720),
+            RecordingResolutions.FULL_HD_1080P: (1920, 1080),
+        }[self.bot_in_db.recording_resolution()]
+        return EncoderProfile(video_frame_size=video_frame_size, **self.bot_in_db.recording_encoder_settings())
+
     def get_meeting_type(self):
         meeting_type = meeting_type_from_url(self.bot_in_db.meeting_url)
         if meeting_type is None:
@@ -172,6 +203,16 @@ class BotController:
         )
         self.cleanup()
 
+    def on_gstreamer_pipeline_degraded(self, queue_name):
+        logger.info(f"GStreamer pipeline degraded, queue {queue_name} is dropping media")
+        if not BotEventManager.is_state_that_can_play_media(self.bot_in_db.state):
+            return
+        BotEventManager.create_event(
+            bot=self.bot_in_db,
+            event_type=BotEventTypes.RECORDING_DEGRADED,
+            event_metadata={"queue": queue_name, "pipeline_metrics": self.gstreamer_pipeline.get_metrics()},
+        )
+
     def on_new_sample_from_gstreamer_pipeline(self, data):
         # For now, we'll assume that if rtmp streaming is enabled, we don't need to upload to s3
         if self.rtmp_client:
@@ -204,6 +245,7 @@ class BotController:
         termination_thread.start()
 
         if self.gstreamer_pipeline:
+            logger.info(f"Video frame rate governor stats: {self.video_frame_rate_governor.get_stats()}")
             logger.info("Telling gstreamer pipeline to cleanup...")
             self.gstreamer_pipeline.cleanup()
 
@@ -217,6 +259,14 @@ class BotController:
             logger.info("Telling adapter to cleanup...")
             self.adapter.cleanup()
 
+        if self.realtime_transcriber:
+            logger.info("Telling realtime transcriber to cleanup...")
+            self.realtime_transcriber.cleanup()
+
+        if self.utterance_persistence_worker:
+            logger.info("Telling utterance persistence worker to cleanup...")
+            self.utterance_persistence_worker.cleanup()
+
         if self.main_loop and self.main_loop.is_running():
             self.main_loop.quit()
 
@@ -253,11 +303,15 @@ class BotController:
         self.automatic_leave_configuration = AutomaticLeaveConfiguration()
 
         if self.bot_in_db.rtmp_destination_url():
-            self.pipeline_configuration = PipelineConfiguration.rtmp_streaming_bot()
+            self.pipeline_configuration = PipelineConfiguration.rtmp_streaming_bot(native_sink=os.getenv("RTMP_NATIVE_SINK") == "true")
+        elif self.bot_in_db.recording_format() == RecordingFormats.M4A:
+            self.pipeline_configuration = PipelineConfiguration.audio_recorder_bot()
         else:
             self.pipeline_configuration = PipelineConfiguration.recorder_bot()
 
     def get_gstreamer_sink_type(self):
+        if self.pipeline_configuration.rtmp_native_sink:
+            return GstreamerPipeline.SINK_TYPE_RTMP
         if self.pipeline_configuration.rtmp_stream_audio or self.pipeline_configuration.rtmp_stream_video:
             return GstreamerPipeline.SINK_TYPE_APPSINK
         else:
@@ -269,6 +323,8 @@ class BotController:
 
         if self.bot_in_db.recording_format() == RecordingFormats.WEBM:
             return GstreamerPipeline.OUTPUT_FORMAT_WEBM
+        elif self.bot_in_db.recording_format() == RecordingFormats.M4A:
+            return GstreamerPipeline.OUTPUT_FORMAT_M4A
         else:
             return GstreamerPipeline.OUTPUT_FORMAT_MP4
 
@@ -305,9 +361,14 @@ class BotController:
 
         # Initialize core objects
         # Only used for adapters that can provide per-participant audio
+        self.utterance_persistence_worker = UtterancePersistenceWorker(bot_id=self.bot_in_db.id)
+        self.realtime_transcriber = None
+        if Recording.objects.get(bot=self.bot_in_db, is_default_recording=True).transcription_type == TranscriptionTypes.REALTIME:
+            self.realtime_transcriber = self.get_realtime_transcriber()
         self.individual_audio_input_manager = IndividualAudioInputManager(
-            save_utterance_callback=self.save_individual_audio_utterance,
+            save_utterance_callback=self.utterance_persistence_worker.add_utterance,
             get_participant_callback=self.get_participant,
+            realtime_transcriber=self.realtime_transcriber,
         )
 
         # Only used for adapters that can provide closed captions
@@ -316,8 +377,9 @@ class BotController:
             get_participant_callback=self.get_participant,
         )
 
+        # When using the native RTMP sink, the GStreamer pipeline talks to the RTMP server directly
         self.rtmp_client = None
-        if self.pipeline_configuration.rtmp_stream_audio or self.pipeline_configuration.rtmp_stream_video:
+        if (self.pipeline_configuration.rtmp_stream_audio or self.pipeline_configuration.rtmp_stream_video) and not self.pipeline_configuration.rtmp_native_sink:
             self.rtmp_client = RTMPClient(rtmp_url=self.bot_in_db.rtmp_destination_url())
             self.rtmp_client.start()
 
@@ -325,15 +387,25 @@ class BotController:
         if self.should_create_gstreamer_pipeline():
             self.gstreamer_pipeline = GstreamerPipeline(
                 on_new_sample_callback=self.on_new_sample_from_gstreamer_pipeline,
-                video_frame_size=(1920, 1080),
                 audio_format=self.get_audio_format(),
                 output_format=self.get_gstreamer_output_format(),
                 num_audio_sources=self.get_num_audio_sources(),
                 sink_type=self.get_gstreamer_sink_type(),
                 file_location=self.get_recording_file_location(),
+                zero_copy_samples=True,  # on_new_sample_from_gstreamer_pipeline writes the sample out before returning
+                rtmp_location=self.bot_in_db.rtmp_destination_url(),
+                on_rtmp_connection_failed_callback=lambda: GLib.idle_add(self.on_rtmp_connection_failed),
+                encoder_profile=self.get_encoder_profile(),
+                on_degraded_callback=lambda queue_name: GLib.idle_add(lambda: self.on_gstreamer_pipeline_degraded(queue_name)),
             )
             self.gstreamer_pipeline.setup()
 
+            self.video_frame_rate_governor = VideoFrameRateGovernor(
+                output_callback=self.gstreamer_pipeline.on_new_video_frame,
+                video_frame_size=self.gstreamer_pipeline.video_frame_size,
+                fps=self.gstreamer_pipeline.encoder_profile.fps,
+            )
+
         self.media_recorder_receiver = None
         if self.should_create_media_recorder_receiver():
             self.media_recorder_receiver = MediaRecorderReceiver(
@@ -484,6 +556,8 @@ class BotController:
     def set_bot_heartbeat(self):
         if self.bot_in_db.last_heartbeat_timestamp is None or self.bot_in_db.last_heartbeat_timestamp <= int(timezone.now().timestamp()) - 60:
             self.bot_in_db.set_heartbeat()
+            if self.gstreamer_pipeline:
+                logger.info(f"GStreamer pipeline metrics: {self.gstreamer_pipeline.get_metrics()}")
 
     def on_main_loop_timeout(self):
         try:
@@ -499,6 +573,10 @@ class BotController:
             # Process audio chunks
             self.individual_audio_input_manager.process_chunks()
 
+            # Save realtime transcription results
+            if self.realtime_transcriber:
+                self.realtime_transcriber.process_results()
+
             # Process captions
             self.closed_caption_manager.process_captions()
 
@@ -552,38 +630,6 @@ class BotController:
 
         RecordingManager.set_recording_transcription_in_progress(recording_in_progress)
 
-    def save_individual_audio_utterance(self, message):
-        from bots.tasks.process_utterance_task import process_utterance
-
-        logger.info("Received message that new utterance was detected")
-
-        # Create participant record if it doesn't exist
-        participant, _ = Participant.objects.get_or_create(
-            bot=self.bot_in_db,
-            uuid=message["participant_uuid"],
-            defaults={
-                "user_uuid": message["participant_user_uuid"],
-                "full_name": message["participant_full_name"],
-            },
-        )
-
-        # Create new utterance record
-        recording_in_progress = self.get_recording_in_progress()
-        utterance = Utterance.objects.create(
-            source=Utterance.Sources.PER_PARTICIPANT_AUDIO,
-            recording=recording_in_progress,
-            participant=participant,
-            audio_blob=message["audio_data"],
-            audio_format=Utterance.AudioFormat.PCM,
-            timestamp_ms=message["timestamp_ms"],
-            duration_ms=len(message["audio_data"]) / 64,
-            sample_rate=message["sample_rate"],
-        )
-
-        # Process the utterance immediately
-        process_utterance.delay(utterance.id)
-        return
-
     def on_message_from_adapter(self, message):
         GLib.idle_add(lambda: self.take_action_based_on_message_from_adapter(message))
 
@@ -591,6 +637,11 @@ class BotController:
         if self.individual_audio_input_manager:
             logger.info("Flushing utterances...")
             self.individual_audio_input_manager.flush_utterances()
+            if self.realtime_transcriber:
+                logger.info("Waiting for the last realtime transcription results...")
+                self.realtime_transcriber.flush()
+            logger.info("Waiting for utterances to be saved...")
+            self.utterance_persistence_worker.flush()
         if self.closed_caption_manager:
             logger.info("Flushing captions...")
             self.closed_caption_manager.flush_captions()
@@ -0,0 +1,65 @@
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+from bots.models import RecordingEncoderPresets
+
+
+# Specifies how the GStreamer pipeline encodes the recording or stream.
+# The defaults match what every bot used before encoder settings were configurable.
+@dataclass(frozen=True)
+class EncoderProfile:
+    video_frame_size: Tuple[int, int] = (1920, 1080)
+    fps: int = 30
+    # At most one of video_bitrate_kbps and crf may be set. If neither is, x264enc's default bitrate is used.
+    video_bitrate_kbps: Optional[int] = None
+    crf: Optional[int] = None
+    preset: str = RecordingEncoderPresets.ULTRAFAST
+    # 0 lets x264 pick the number of threads based on the number of cores
+    threads: int = 0
+    audio_bitrate: int = 128000
+    # How much media the pipeline's queues may hold, so memory use is bounded when the encoder falls behind.
+    # Raw video is dropped once its queues hold video_queue_max_ms, well before any audio is dropped.
+    video_queue_max_ms: int = 1000
+    audio_queue_max_ms: int = 10000
+
+    def __post_init__(self):
+        if self.video_bitrate_kbps is not None and self.crf is not None:
+            raise ValueError("Only one of video_bitrate_kbps and crf can be set")
+        if self.preset not in RecordingEncoderPresets.values:
+            raise ValueError(f"Invalid x264 preset: {self.preset}. Must be one of: {RecordingEncoderPresets.values}")
+
+    @property
+    def frame_duration_ns(self) -> int:
+        return 1_000_000_000 // self.fps
+
+    @property
+    def raw_video_frame_bytes(self) -> int:
+        width, height = self.video_frame_size
+        return width * height * 3 // 2
+
+    def raw_video_queue_limits_string(self) -> str:
+        max_frames = max(1, self.fps * self.video_queue_max_ms // 1000)
+        return f"leaky=downstream max-size-buffers={max_frames} max-size-bytes={max_frames * self.raw_video_frame_bytes} max-size-time={self.video_queue_max_ms * 1_000_000}"
+
+    def encoded_video_queue_limits_string(self) -> str:
+        # Dropping encoded video would corrupt the stream until the next keyframe, so this queue blocks the encoder
+        # when it's full instead, which makes the raw video queues upstream of the encoder drop frames.
+        return f"max-size-buffers=0 max-size-bytes=0 max-size-time={self.audio_queue_max_ms * 1_000_000}"
+
+    def audio_queue_limits_string(self) -> str:
+        # Raw audio is at most 192 KB/s, so the byte limit only kicks in if timestamps are broken
+        return f"leaky=downstream max-size-buffers=0 max-size-bytes={self.audio_queue_max_ms * 1000} max-size-time={self.audio_queue_max_ms * 1_000_000}"
+
+    def video_encoder_string(self) -> str:
+        properties = ["tune=zerolatency", f"speed-preset={self.preset}"]
+        if self.threads:
+            properties.append(f"threads={self.threads}")
+        if self.video_bitrate_kbps is not None:
+            properties.append(f"bitrate={self.video_bitrate_kbps}")
+        if self.crf is not None:
+            # In quality mode, x264enc treats the quantizer as a constant rate factor
+            properties.append(f"pass=qual quantizer={self.crf}")
+        return f"x264enc {' '.join(properties)}"
+
+    def audio_encoder_string(self) -> str:
+        return f"voaacenc bitrate={self.audio_bitrate}"
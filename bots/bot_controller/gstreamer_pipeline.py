@@ -2,9 +2,13 @@ import gi
 
 gi.require_version("Gst", "1.0")
 import logging
+import threading
 import time
 
-from gi.repository import GLib, Gst
+from gi.repository import Gst
+
+from .encoder_profile import EncoderProfile
+from .latency_stats import LatencyStats
 
 logger = logging.getLogger(__name__)
 
@@ -15,28 +19,47 @@ class GstreamerPipeline:
     OUTPUT_FORMAT_FLV = "flv"
     OUTPUT_FORMAT_MP4 = "mp4"
     OUTPUT_FORMAT_WEBM = "webm"
+    # Audio only, so the pipeline has no video branch
+    OUTPUT_FORMAT_M4A = "m4a"
 
     SINK_TYPE_APPSINK = "appsink"
     SINK_TYPE_FILE = "filesink"
+    SINK_TYPE_RTMP = "rtmpsink"
+
+    # Bounds the number of encoder input timestamps held while waiting for the encoded buffer
+    MAX_TRACKED_ENCODER_INPUTS = 300
 
     def __init__(
         self,
         *,
         on_new_sample_callback,
-        video_frame_size,
         audio_format,
         output_format,
         num_audio_sources,
         sink_type,
         file_location=None,
+        zero_copy_samples=False,
+        rtmp_location=None,
+        on_rtmp_connection_failed_callback=None,
+        encoder_profile=None,
+        on_degraded_callback=None,
     ):
         self.on_new_sample_callback = on_new_sample_callback
-        self.video_frame_size = video_frame_size
+        self.encoder_profile = encoder_profile or EncoderProfile()
+        self.video_frame_size = self.encoder_profile.video_frame_size
         self.audio_format = audio_format
         self.output_format = output_format
         self.num_audio_sources = num_audio_sources
         self.sink_type = sink_type
         self.file_location = file_location
+        # When enabled, the appsink callback receives a memoryview over the mapped Gst buffer instead of a copy.
+        # The memoryview is only valid for the duration of the callback, so the callback must not hold onto it.
+        self.zero_copy_samples = zero_copy_samples
+        self.rtmp_location = rtmp_location
+        self.on_rtmp_connection_failed_callback = on_rtmp_connection_failed_callback
+        self.rtmp_connection_failed = False
+        # Called from a streaming thread with the queue's name the first time a queue overruns and starts dropping media
+        self.on_degraded_callback = on_degraded_callback
 
         self.pipeline = None
         self.appsrc = None
@@ -45,27 +68,56 @@ class GstreamerPipeline:
         self.audio_appsrcs = []
         self.audio_recording_active = False
 
+        # Audio and video buffers are pushed from different threads, but their timestamps must share one start time
+        self.start_time_lock = threading.Lock()
         self.start_time_ns = None  # Will be set on first frame/audio sample
 
         # Initialize GStreamer
         Gst.init(None)
 
-        self.queue_drops = {}
-        self.last_reported_drops = {}
+        self.reset_metrics()
+
+    def reset_metrics(self):
+        self.degraded = False
+        self.queues = {}
+        self.queue_overruns = {}
+
+        self.encoder_latency_lock = threading.Lock()
+        self.encoder_input_times_ns = {}
+        self.encoder_latency = LatencyStats()
+
+        self.video_buffers_pushed = 0
+        self.video_push_failures = 0
+        self.audio_buffers_pushed = 0
+        self.audio_push_failures = 0
+        self.last_video_pts_ns = None
+        self.last_audio_pts_ns = None
 
     def on_new_sample_from_appsink(self, sink):
         """Handle new samples from the appsink"""
         sample = sink.emit("pull-sample")
         if sample:
             buffer = sample.get_buffer()
-            data = buffer.extract_dup(0, buffer.get_size())
-            self.on_new_sample_callback(data)
+            if self.zero_copy_samples:
+                success, map_info = buffer.map(Gst.MapFlags.READ)
+                if not success:
+                    logger.info("Failed to map buffer from appsink")
+                    return Gst.FlowReturn.ERROR
+                try:
+                    self.on_new_sample_callback(map_info.data)
+                finally:
+                    buffer.unmap(map_info)
+            else:
+                data = buffer.extract_dup(0, buffer.get_size())
+                self.on_new_sample_callback(data)
             return Gst.FlowReturn.OK
         return Gst.FlowReturn.ERROR
 
     def setup(self):
         """Initialize GStreamer pipeline for combined MP4 recording with audio and video"""
-        self.start_time_ns = None
+        with self.start_time_lock:
+            self.start_time_ns = None
+        self.reset_metrics()
 
         # Setup muxer based on output format
         if self.output_format == self.OUTPUT_FORMAT_MP4:
@@ -74,6 +126,8 @@ class GstreamerPipeline:
             muxer_string = "h264parse ! flvmux name=muxer streamable=true"
         elif self.output_format == self.OUTPUT_FORMAT_WEBM:
             muxer_string = "h264parse ! matroskamux name=muxer"
+        elif self.output_format == self.OUTPUT_FORMAT_M4A:
+            muxer_string = "mp4mux name=muxer"
         else:
             raise ValueError(f"Invalid output format: {self.output_format}")
 
@@ -81,6 +135,13 @@ class GstreamerPipeline:
             sink_string = "appsink name=sink emit-signals=true sync=false drop=false "
         elif self.sink_type == self.SINK_TYPE_FILE:
             sink_string = f"filesink location={self.file_location} name=sink sync=false "
+        elif self.sink_type == self.SINK_TYPE_RTMP:
+            if self.output_format != self.OUTPUT_FORMAT_FLV:
+                raise ValueError(f"RTMP sink requires output format {self.OUTPUT_FORMAT_FLV}, got {self.output_format}")
+            # Prefer the newer rtmp2sink, fall back to the librtmp based rtmpsink if it isn't installed
+            rtmp_sink_factory = "rtmp2sink" if Gst.ElementFactory.find("rtmp2sink") else "rtmpsink"
+            # The location is set as a property after parsing, so stream keys don't need escaping
+            sink_string = f"{rtmp_sink_factory} name=sink sync=false "
         else:
             raise ValueError(f"Invalid sink type: {self.sink_type}")
 
@@ -89,66 +150,69 @@ class GstreamerPipeline:
             audio_source_string = (
                 # --- AUDIO STRING FOR 1 AUDIO SOURCE ---
                 "appsrc name=audio_source_1 do-timestamp=false stream-type=0 format=time ! "
-                "queue name=q5 leaky=downstream max-size-buffers=1000000 max-size-bytes=100000000 max-size-time=0 ! "
+                f"queue name=q5 {self.encoder_profile.audio_queue_limits_string()} ! "
                 "audioconvert ! "
                 "audiorate ! "
-                "queue name=q6 leaky=downstream max-size-buffers=1000000 max-size-bytes=100000000 max-size-time=0 ! "
-                "voaacenc bitrate=128000 ! "
-                "queue name=q7 leaky=downstream max-size-buffers=1000000 max-size-bytes=100000000 max-size-time=0 ! "
+                f"queue name=q6 {self.encoder_profile.audio_queue_limits_string()} ! "
+                f"{self.encoder_profile.audio_encoder_string()} ! "
+                f"queue name=q7 {self.encoder_profile.audio_queue_limits_string()} ! "
             )
             # fmt: on
         elif self.num_audio_sources == 3:
             audio_source_string = (
                 # --- AUDIO BRANCH 1 ---
                 "appsrc name=audio_source_1 do-timestamp=false stream-type=0 format=time ! "
-                "queue name=q5_1 leaky=downstream max-size-buffers=1000000 max-size-bytes=100000000 max-size-time=0 ! "
+                f"queue name=q5_1 {self.encoder_profile.audio_queue_limits_string()} ! "
                 "mixer. "
                 # --- AUDIO BRANCH 2 ---
                 "appsrc name=audio_source_2 do-timestamp=false stream-type=0 format=time ! "
-                "queue name=q5_2 leaky=downstream max-size-buffers=1000000 max-size-bytes=100000000 max-size-time=0 ! "
+                f"queue name=q5_2 {self.encoder_profile.audio_queue_limits_string()} ! "
                 "mixer. "
                 # --- AUDIO BRANCH 3 ---
                 "appsrc name=audio_source_3 do-timestamp=false stream-type=0 format=time ! "
-                "queue name=q5_3 leaky=downstream max-size-buffers=1000000 max-size-bytes=100000000 max-size-time=0 ! "
+                f"queue name=q5_3 {self.encoder_profile.audio_queue_limits_string()} ! "
                 "mixer. "
                 # --- AUDIO MIXER
                 "adder name=mixer ! "
-                "queue name=mixer_q1 leaky=downstream max-size-buffers=1000000 max-size-bytes=100000000 max-size-time=0 ! "
+                f"queue name=mixer_q1 {self.encoder_profile.audio_queue_limits_string()} ! "
                 "audioconvert ! "
                 "audiorate ! "
-                "queue name=mixer_q2 leaky=downstream max-size-buffers=1000000 max-size-bytes=100000000 max-size-time=0 ! "
-                "voaacenc bitrate=128000 ! "
-                "queue name=mixer_q3 leaky=downstream max-size-buffers=1000000 max-size-bytes=100000000 max-size-time=0 ! "
+                f"queue name=mixer_q2 {self.encoder_profile.audio_queue_limits_string()} ! "
+                f"{self.encoder_profile.audio_encoder_string()} ! "
+                f"queue name=mixer_q3 {self.encoder_profile.audio_queue_limits_string()} ! "
             )
         else:
             raise ValueError(f"Unsupported number of audio sources: {self.num_audio_sources}")
 
-        pipeline_str = (
-            "appsrc name=video_source do-timestamp=false stream-type=0 format=time ! "
-            "queue name=q1 max-size-buffers=1000 max-size-bytes=100000000 max-size-time=0 ! "  # q1 can contain 100mb of video before it drops
-            "videoconvert ! "
-            "videorate ! "
-            "queue name=q2 max-size-buffers=5000 max-size-bytes=500000000 max-size-time=0 ! "  # q2 can contain 100mb of video before it drops
-            "x264enc tune=zerolatency speed-preset=ultrafast ! "
-            "queue name=q3 max-size-buffers=1000 max-size-bytes=100000000 max-size-time=0 ! "
-            f"{muxer_string} ! queue name=q4 ! {sink_string} "
-            f"{audio_source_string} "
-            "muxer. "
-        )
+        if self.output_format == self.OUTPUT_FORMAT_M4A:
+            # No appsrc, videoconvert or x264enc is created, so audio-only bots don't pay for encoding video
+            pipeline_str = f"{audio_source_string}{muxer_string} ! queue name=q4 ! {sink_string}"
+        else:
+            pipeline_str = (
+                "appsrc name=video_source do-timestamp=false stream-type=0 format=time ! "
+                f"queue name=q1 {self.encoder_profile.raw_video_queue_limits_string()} ! "
+                "videoconvert ! "
+                "videorate drop-only=true ! "  # VideoFrameRateGovernor drops duplicate frames, so don't let videorate recreate them
+                f"queue name=q2 {self.encoder_profile.raw_video_queue_limits_string()} ! "
+                f"{self.encoder_profile.video_encoder_string()} name=video_encoder ! "
+                f"queue name=q3 {self.encoder_profile.encoded_video_queue_limits_string()} ! "
+                f"{muxer_string} ! queue name=q4 ! {sink_string} "
+                f"{audio_source_string} "
+                "muxer. "
+            )
 
         self.pipeline = Gst.parse_launch(pipeline_str)
 
-        # Get both appsrc elements
-        self.appsrc = self.pipeline.get_by_name("video_source")
-
         # Configure video appsrc
-        video_caps = Gst.Caps.from_string(f"video/x-raw,format=I420,width={self.video_frame_size[0]},height={self.video_frame_size[1]},framerate=30/1")
-        self.appsrc.set_property("caps", video_caps)
-        self.appsrc.set_property("format", Gst.Format.TIME)
-        self.appsrc.set_property("is-live", True)
-        self.appsrc.set_property("do-timestamp", False)
-        self.appsrc.set_property("stream-type", 0)  # GST_APP_STREAM_TYPE_STREAM
-        self.appsrc.set_property("block", True)  # This helps with synchronization
+        self.appsrc = self.pipeline.get_by_name("video_source")
+        if self.appsrc:
+            video_caps = Gst.Caps.from_string(f"video/x-raw,format=I420,width={self.video_frame_size[0]},height={self.video_frame_size[1]},framerate={self.encoder_profile.fps}/1")
+            self.appsrc.set_property("caps", video_caps)
+            self.appsrc.set_property("format", Gst.Format.TIME)
+            self.appsrc.set_property("is-live", True)
+            self.appsrc.set_property("do-timestamp", False)
+            self.appsrc.set_property("stream-type", 0)  # GST_APP_STREAM_TYPE_STREAM
+            self.appsrc.set_property("block", True)  # This helps with synchronization
 
         audio_caps = Gst.Caps.from_string(self.audio_format)  # e.g. "audio/x-raw,rate=48000,channels=2,format=S16LE"
         self.audio_appsrcs = []
@@ -171,6 +235,10 @@ class GstreamerPipeline:
         if self.sink_type == self.SINK_TYPE_APPSINK:
             sink = self.pipeline.get_by_name("sink")
             sink.connect("new-sample", self.on_new_sample_from_appsink)
+        elif self.sink_type == self.SINK_TYPE_RTMP:
+            self.rtmp_connection_failed = False
+            sink = self.pipeline.get_by_name("sink")
+            sink.set_property("location", self.rtmp_location)
 
         # Start the pipeline
         self.pipeline.set_state(Gst.State.PLAYING)
@@ -178,11 +246,7 @@ class GstreamerPipeline:
         self.recording_active = True
         self.audio_recording_active = True
 
-        # Initialize queue monitoring
-        self.queue_drops = {}
-        self.last_reported_drops = {}
-
-        # Find all queue elements and connect drop signals
+        # Find all queue elements so their levels can be reported and connect overrun signals
         iterator = self.pipeline.iterate_elements()
         while True:
             result, element = iterator.next()
@@ -193,12 +257,15 @@ class GstreamerPipeline:
 
             if isinstance(element, Gst.Element) and element.get_factory().get_name() == "queue":
                 queue_name = element.get_name()
-                self.queue_drops[queue_name] = 0
-                self.last_reported_drops[queue_name] = 0
+                self.queues[queue_name] = element
+                self.queue_overruns[queue_name] = 0
                 element.connect("overrun", self.on_queue_overrun, queue_name)
 
-        # Start statistics monitoring
-        GLib.timeout_add_seconds(15, self.monitor_pipeline_stats)
+        # Measure how long buffers spend inside the video encoder
+        video_encoder = self.pipeline.get_by_name("video_encoder")
+        if video_encoder:
+            video_encoder.get_static_pad("sink").add_probe(Gst.PadProbeType.BUFFER, self.on_video_encoder_input)
+            video_encoder.get_static_pad("src").add_probe(Gst.PadProbeType.BUFFER, self.on_video_encoder_output)
 
     def on_pipeline_message(self, bus, message):
         """Handle pipeline messages"""
@@ -209,36 +276,84 @@ class GstreamerPipeline:
             src = message.src
             src_name = src.name if src else "unknown"
             logger.info(f"GStreamer Error: {err}, Debug: {debug}, src_name: {src_name}")
+
+            # An error from the RTMP sink means we couldn't connect to the server or the connection dropped
+            if self.sink_type == self.SINK_TYPE_RTMP and src_name == "sink" and not self.rtmp_connection_failed:
+                self.rtmp_connection_failed = True
+                if self.on_rtmp_connection_failed_callback:
+                    self.on_rtmp_connection_failed_callback()
         elif t == Gst.MessageType.EOS:
             logger.info("GStreamer pipeline reached end of stream")
 
-    def monitor_pipeline_stats(self):
-        """Periodically print pipeline statistics"""
-        if not self.recording_active:
-            return False
-
-        try:
-            logger.info("\nDropped Buffers Since Last Check:")
-            for queue_name in self.queue_drops:
-                drops = self.queue_drops[queue_name] - self.last_reported_drops[queue_name]
-                if drops > 0:
-                    logger.info(f"  {queue_name}: {drops} buffers dropped")
-                self.last_reported_drops[queue_name] = self.queue_drops[queue_name]
-
-        except Exception as e:
-            logger.info(f"Error getting pipeline stats: {e}")
-
-        return True  # Continue timer
-
     def on_queue_overrun(self, queue, queue_name):
-        """Callback for when a queue drops buffers"""
-        self.queue_drops[queue_name] += 1
+        """Callback for when a queue is full"""
+        self.queue_overruns[queue_name] += 1
+        if not self.degraded:
+            self.degraded = True
+            logger.info(f"GStreamer pipeline degraded, queue {queue_name} is full")
+            if self.on_degraded_callback:
+                self.on_degraded_callback(queue_name)
         return True
 
+    def on_video_encoder_input(self, pad, info):
+        buffer = info.get_buffer()
+        with self.encoder_latency_lock:
+            self.encoder_input_times_ns[buffer.pts] = time.perf_counter_ns()
+            # Buffers the encoder drops never come out the other side, so forget the oldest ones
+            if len(self.encoder_input_times_ns) > self.MAX_TRACKED_ENCODER_INPUTS:
+                del self.encoder_input_times_ns[next(iter(self.encoder_input_times_ns))]
+        return Gst.PadProbeReturn.OK
+
+    def on_video_encoder_output(self, pad, info):
+        buffer = info.get_buffer()
+        with self.encoder_latency_lock:
+            input_time_ns = self.encoder_input_times_ns.pop(buffer.pts, None)
+            if input_time_ns is not None:
+                self.encoder_latency.record(time.perf_counter_ns() - input_time_ns)
+        return Gst.PadProbeReturn.OK
+
+    def get_metrics(self):
+        """Returns counters describing the health of the pipeline, for reporting alongside the bot heartbeat"""
+        queues = {}
+        for queue_name, queue in self.queues.items():
+            queues[queue_name] = {
+                "level_buffers": queue.get_property("current-level-buffers"),
+                "level_bytes": queue.get_property("current-level-bytes"),
+                "level_time_ms": queue.get_property("current-level-time") // Gst.MSECOND,
+                "overruns": self.queue_overruns[queue_name],
+            }
+
+        with self.encoder_latency_lock:
+            encoder_latency = self.encoder_latency.as_dict()
+
+        # Positive when video is ahead of audio
+        av_drift_ms = None
+        if self.last_video_pts_ns is not None and self.last_audio_pts_ns is not None:
+            av_drift_ms = (self.last_video_pts_ns - self.last_audio_pts_ns) // 1_000_000
+
+        return {
+            "degraded": self.degraded,
+            "queues": queues,
+            "encoder_latency": encoder_latency,
+            "av_drift_ms": av_drift_ms,
+            "video_buffers_pushed": self.video_buffers_pushed,
+            "video_push_failures": self.video_push_failures,
+            "audio_buffers_pushed": self.audio_buffers_pushed,
+            "audio_push_failures": self.audio_push_failures,
+        }
+
+    def get_buffer_pts(self, current_time_ns):
+        """The buffer's timestamp relative to the first audio or video buffer, whichever came first"""
+        with self.start_time_lock:
+            # Initialize start time if not set
+            if self.start_time_ns is None:
+                self.start_time_ns = current_time_ns
+            return current_time_ns - self.start_time_ns
+
     def on_mixed_audio_raw_data_received_callback(self, data, timestamp=None, audio_appsrc_idx=0):
         audio_appsrc = self.audio_appsrcs[audio_appsrc_idx]
 
-        if not self.audio_recording_active or not audio_appsrc or not self.recording_active or not self.appsrc:
+        if not self.audio_recording_active or not audio_appsrc or not self.recording_active:
             return
 
         try:
@@ -246,51 +361,55 @@ class GstreamerPipeline:
             buffer_bytes = data
             buffer = Gst.Buffer.new_wrapped(buffer_bytes)
 
-            # Initialize start time if not set
-            if self.start_time_ns is None:
-                self.start_time_ns = current_time_ns
-
             # Calculate timestamp relative to same start time as video
-            buffer.pts = current_time_ns - self.start_time_ns
+            buffer.pts = self.get_buffer_pts(current_time_ns)
 
             ret = audio_appsrc.emit("push-buffer", buffer)
             if ret != Gst.FlowReturn.OK:
+                self.audio_push_failures += 1
                 logger.info(f"Warning: Failed to push audio buffer to pipeline: {ret}")
+            else:
+                self.audio_buffers_pushed += 1
+                self.last_audio_pts_ns = max(buffer.pts, self.last_audio_pts_ns or 0)
         except Exception as e:
             logger.info(f"Error processing audio data: {e}")
 
     def wants_any_video_frames(self):
+        # Audio-only pipelines have no video appsrc
         if not self.audio_recording_active or not self.audio_appsrcs[0] or not self.recording_active or not self.appsrc:
             return False
 
         return True
 
-    def on_new_video_frame(self, frame, current_time_ns):
+    def on_new_video_frame(self, frame, current_time_ns, duration_ns=None):
         try:
-            # Initialize start time if not set
-            if self.start_time_ns is None:
-                self.start_time_ns = current_time_ns
-
             # Calculate buffer timestamp relative to start time
-            buffer_pts = current_time_ns - self.start_time_ns
+            buffer_pts = self.get_buffer_pts(current_time_ns)
 
-            # Create buffer with timestamp
-            buffer = Gst.Buffer.new_wrapped(frame)
+            # Create buffer with timestamp. Scaled frames arrive as a memoryview into a reused canvas,
+            # so they must be copied before the canvas is overwritten. bytes() is a no-op for bytes.
+            buffer = Gst.Buffer.new_wrapped(bytes(frame))
             buffer.pts = buffer_pts
 
-            # Default to 33ms (30fps)
-            buffer.duration = 33 * 1000 * 1000  # 33ms in nanoseconds
+            # Default to one frame at the profile's frame rate
+            buffer.duration = duration_ns if duration_ns is not None else self.encoder_profile.frame_duration_ns
 
             # Push buffer to pipeline
             ret = self.appsrc.emit("push-buffer", buffer)
             if ret != Gst.FlowReturn.OK:
+                self.video_push_failures += 1
                 logger.info(f"Warning: Failed to push buffer to pipeline: {ret}")
+            else:
+                self.video_buffers_pushed += 1
+                self.last_video_pts_ns = buffer_pts
 
         except Exception as e:
             logger.info(f"Error processing video frame: {e}")
 
     def cleanup(self):
         logger.info("Shutting down GStreamer pipeline...")
+        if self.pipeline:
+            logger.info(f"GStreamer pipeline final metrics: {self.get_metrics()}")
 
         self.recording_active = False
         self.audio_recording_active = False
@@ -300,19 +419,23 @@ class GstreamerPipeline:
         bus = self.pipeline.get_bus()
         bus.remove_signal_watch()
 
-        if self.appsrc:
-            self.appsrc.emit("end-of-stream")
-        for audio_appsrc in self.audio_appsrcs:
-            audio_appsrc.emit("end-of-stream")
-
-        msg = bus.timed_pop_filtered(
-            5 * 60 * Gst.SECOND,  # 5 minute timeout
-            Gst.MessageType.EOS | Gst.MessageType.ERROR,
-        )
-
-        if msg and msg.type == Gst.MessageType.ERROR:
-            err, debug = msg.parse_error()
-            logger.info(f"Error during pipeline shutdown: {err}, {debug}")
+        # If the RTMP sink has errored out, EOS will never reach it, so there's no point waiting for it
+        if self.rtmp_connection_failed:
+            logger.info("RTMP connection failed, not waiting for EOS")
+        else:
+            if self.appsrc:
+                self.appsrc.emit("end-of-stream")
+            for audio_appsrc in self.audio_appsrcs:
+                audio_appsrc.emit("end-of-stream")
+
+            msg = bus.timed_pop_filtered(
+                5 * 60 * Gst.SECOND,  # 5 minute timeout
+                Gst.MessageType.EOS | Gst.MessageType.ERROR,
+            )
+
+            if msg and msg.type == Gst.MessageType.ERROR:
+                err, debug = msg.parse_error()
+                logger.info(f"Error during pipeline shutdown: {err}, {debug}")
 
         self.pipeline.set_state(Gst.State.NULL)
         logger.info("GStreamer pipeline shut down")
@@ -1,6 +1,8 @@
 import logging
 import queue
+import threading
 from datetime import datetime, timedelta
+from functools import partial
 
 import numpy as np
 import webrtcvad
@@ -9,36 +11,101 @@ logger = logging.getLogger(__name__)
 
 
 def calculate_normalized_rms(audio_bytes):
-    samples = np.frombuffer(audio_bytes, dtype=np.int16)
+    # Widen before squaring, squares of 16-bit samples overflow an int16
+    samples = np.frombuffer(audio_bytes, dtype=np.int16).astype(np.int32)
     rms = np.sqrt(np.mean(np.square(samples)))
     # Normalize by max possible value for 16-bit audio (32768)
     return rms / 32768
 
 
+def calculate_normalized_rms_batch(chunks):
+    """Computes calculate_normalized_rms for each of a list of non-empty chunks in a single vectorized pass"""
+    chunk_sample_counts = np.fromiter((len(chunk) // 2 for chunk in chunks), dtype=np.int64, count=len(chunks))
+    chunk_offsets = np.zeros(len(chunks), dtype=np.int64)
+    np.cumsum(chunk_sample_counts[:-1], out=chunk_offsets[1:])
+
+    # Squares of 16-bit samples fit in an int32, so only the sums need 64 bits
+    samples = np.frombuffer(b"".join(chunks), dtype=np.int16).astype(np.int32)
+    sums_of_squares = np.add.reduceat(samples * samples, chunk_offsets, dtype=np.int64)
+    return np.sqrt(sums_of_squares / chunk_sample_counts, dtype=np.float32) / 32768
+
+
+class UtteranceAudioArena:
+    """
+    Hands out fixed-size blocks to accumulate utterance audio in, and takes them back once the
+    utterance has been saved so the next utterance can reuse them.
+
+    Blocks are allocated with np.empty, so the OS only commits the pages an utterance actually
+    writes to. Up to max_free_blocks released blocks are kept around, the rest are freed.
+    Blocks can be released from any thread.
+    """
+
+    def __init__(self, *, block_size, max_free_blocks=4):
+        self.block_size = block_size
+        self.max_free_blocks = max_free_blocks
+        self.lock = threading.Lock()
+        self.free_blocks = []
+        self.blocks_allocated = 0
+        self.blocks_reused = 0
+
+    def acquire(self):
+        with self.lock:
+            if self.free_blocks:
+                self.blocks_reused += 1
+                return self.free_blocks.pop()
+            self.blocks_allocated += 1
+        return np.empty(self.block_size, dtype=np.uint8)
+
+    def release(self, block):
+        with self.lock:
+            if len(self.free_blocks) < self.max_free_blocks:
+                self.free_blocks.append(block)
+
+
 class IndividualAudioInputManager:
-    def __init__(self, *, save_utterance_callback, get_participant_callback):
+    SAMPLE_RATE = 32000
+
+    def __init__(self, *, save_utterance_callback, get_participant_callback, realtime_transcriber=None):
         self.queue = queue.Queue()
 
         self.save_utterance_callback = save_utterance_callback
         self.get_participant_callback = get_participant_callback
+        # When set, each utterance's audio is streamed to the realtime transcriber as it arrives instead of being saved once it ends
+        self.realtime_transcriber = realtime_transcriber
 
+        # Each speaker's in progress utterance is written into a block from the arena
         self.utterances = {}
-        self.sample_rate = 32000
+        self.utterance_lengths = {}
+        self.sample_rate = self.SAMPLE_RATE
 
         self.first_nonsilent_audio_time = {}
         self.last_nonsilent_audio_time = {}
 
         self.UTTERANCE_SIZE_LIMIT = 19200000  # 19.2 MB / 2 bytes per sample / 32,000 samples per second = 300 seconds of continuous audio
+        self.arena = UtteranceAudioArena(block_size=self.UTTERANCE_SIZE_LIMIT)
         self.SILENCE_DURATION_LIMIT = 3  # seconds
+        self.RMS_SILENCE_THRESHOLD = 0.01
         self.vad = webrtcvad.Vad()
 
     def add_chunk(self, speaker_id, chunk_time, chunk_bytes):
         self.queue.put((speaker_id, chunk_time, chunk_bytes))
 
     def process_chunks(self):
-        while not self.queue.empty():
-            speaker_id, chunk_time, chunk_bytes = self.queue.get()
-            self.process_chunk(speaker_id, chunk_time, chunk_bytes)
+        # Drain everything that's pending and group it by speaker, keeping each speaker's chunks in order
+        chunks_by_speaker = {}
+        while True:
+            try:
+                speaker_id, chunk_time, chunk_bytes = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            chunks_by_speaker.setdefault(speaker_id, []).append((chunk_time, chunk_bytes))
+
+        if chunks_by_speaker:
+            pending_chunks = [chunk_bytes for speaker_chunks in chunks_by_speaker.values() for _, chunk_bytes in speaker_chunks]
+            silence_flags = iter(self.silence_detected_batch(pending_chunks))
+            for speaker_id, speaker_chunks in chunks_by_speaker.items():
+                for chunk_time, chunk_bytes in speaker_chunks:
+                    self.process_chunk(speaker_id, chunk_time, chunk_bytes, audio_is_silent=next(silence_flags))
 
         for speaker_id in list(self.first_nonsilent_audio_time.keys()):
             self.process_chunk(speaker_id, datetime.utcnow(), None)
@@ -53,30 +120,54 @@ class IndividualAudioInputManager:
             )
 
     def silence_detected(self, chunk_bytes):
-        if calculate_normalized_rms(chunk_bytes) < 0.01:
+        if calculate_normalized_rms(chunk_bytes) < self.RMS_SILENCE_THRESHOLD:
             return True
         return not self.vad.is_speech(chunk_bytes, self.sample_rate)
 
-    def process_chunk(self, speaker_id, chunk_time, chunk_bytes):
-        audio_is_silent = self.silence_detected(chunk_bytes) if chunk_bytes else True
+    def silence_detected_batch(self, chunks):
+        """Same as silence_detected for each chunk, but the RMS gate is computed for all chunks at once and the VAD only runs on chunks that pass it"""
+        silence_flags = [True] * len(chunks)
+        nonempty_chunk_indices = [i for i, chunk_bytes in enumerate(chunks) if chunk_bytes]
+        if not nonempty_chunk_indices:
+            return silence_flags
+
+        rms_values = calculate_normalized_rms_batch([chunks[i] for i in nonempty_chunk_indices])
+        for i, rms in zip(nonempty_chunk_indices, rms_values):
+            if rms >= self.RMS_SILENCE_THRESHOLD:
+                silence_flags[i] = not self.vad.is_speech(chunks[i], self.sample_rate)
+        return silence_flags
+
+    def process_chunk(self, speaker_id, chunk_time, chunk_bytes, audio_is_silent=None):
+        if audio_is_silent is None:
+            audio_is_silent = self.silence_detected(chunk_bytes) if chunk_bytes else True
+
+        # If the chunk doesn't fit in what's left of the block, flush the utterance and start a new one with the chunk
+        if chunk_bytes and speaker_id in self.utterances and self.utterance_lengths[speaker_id] + len(chunk_bytes) > self.UTTERANCE_SIZE_LIMIT:
+            self.flush_utterance(speaker_id, "buffer_full")
 
         # Initialize buffer and timing for new speaker
-        if speaker_id not in self.utterances or len(self.utterances[speaker_id]) == 0:
+        if speaker_id not in self.utterances:
             if audio_is_silent:
                 return
-            self.utterances[speaker_id] = bytearray()
+            self.utterances[speaker_id] = None if self.realtime_transcriber else self.arena.acquire()
+            self.utterance_lengths[speaker_id] = 0
             self.first_nonsilent_audio_time[speaker_id] = chunk_time
             self.last_nonsilent_audio_time[speaker_id] = chunk_time
 
         # Add new audio data to buffer
         if chunk_bytes:
-            self.utterances[speaker_id].extend(chunk_bytes)
+            utterance_length = self.utterance_lengths[speaker_id]
+            if self.realtime_transcriber:
+                self.realtime_transcriber.send_audio(speaker_id, chunk_time, chunk_bytes)
+            else:
+                self.utterances[speaker_id][utterance_length : utterance_length + len(chunk_bytes)] = np.frombuffer(chunk_bytes, dtype=np.uint8)
+            self.utterance_lengths[speaker_id] = utterance_length + len(chunk_bytes)
 
         should_flush = False
         reason = None
 
         # Check buffer size
-        if len(self.utterances[speaker_id]) >= self.UTTERANCE_SIZE_LIMIT:
+        if self.utterance_lengths[speaker_id] >= self.UTTERANCE_SIZE_LIMIT:
             should_flush = True
             reason = "buffer_full"
 
@@ -92,19 +183,33 @@ class IndividualAudioInputManager:
             logger.debug(f"Speaker {speaker_id} is speaking")
 
         # Flush buffer if needed
-        if should_flush and len(self.utterances[speaker_id]) > 0:
-            participant = self.get_participant_callback(speaker_id)
-            if participant:
-                self.save_utterance_callback(
-                    {
-                        **participant,
-                        "audio_data": bytes(self.utterances[speaker_id]),
-                        "timestamp_ms": int(self.first_nonsilent_audio_time[speaker_id].timestamp() * 1000),
-                        "flush_reason": reason,
-                        "sample_rate": self.sample_rate,
-                    }
-                )
-            # Clear the buffer
-            self.utterances[speaker_id] = bytearray()
-            del self.first_nonsilent_audio_time[speaker_id]
-            del self.last_nonsilent_audio_time[speaker_id]
+        if should_flush:
+            self.flush_utterance(speaker_id, reason)
+
+    def flush_utterance(self, speaker_id, reason):
+        block = self.utterances.pop(speaker_id)
+        utterance_length = self.utterance_lengths.pop(speaker_id)
+        first_nonsilent_audio_time = self.first_nonsilent_audio_time.pop(speaker_id)
+        del self.last_nonsilent_audio_time[speaker_id]
+
+        if self.realtime_transcriber:
+            self.realtime_transcriber.finalize(speaker_id)
+            return
+
+        participant = self.get_participant_callback(speaker_id) if utterance_length > 0 else None
+        if not participant:
+            self.arena.release(block)
+            return
+
+        # audio_data is a view of the block, not a copy. The callback must call release_audio_data
+        # once it's done with audio_data, after which the block is handed to another utterance.
+        self.save_utterance_callback(
+            {
+                **participant,
+                "audio_data": memoryview(block)[:utterance_length],
+                "release_audio_data": partial(self.arena.release, block),
+                "timestamp_ms": int(first_nonsilent_audio_time.timestamp() * 1000),
+                "flush_reason": reason,
+                "sample_rate": self.sample_rate,
+            }
+        )
@@ -0,0 +1,19 @@
+class LatencyStats:
+    """Count, average and maximum of the durations recorded for one step of media processing"""
+
+    def __init__(self):
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
+
+    def record(self, duration_ns):
+        self.count += 1
+        self.total_ns += duration_ns
+        self.max_ns = max(self.max_ns, duration_ns)
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total_ns / self.count / 1_000_000, 2) if self.count else 0,
+            "max_ms": round(self.max_ns / 1_000_000, 2),
+        }
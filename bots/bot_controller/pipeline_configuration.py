@@ -12,6 +12,8 @@ class PipelineConfiguration:
     transcribe_audio: bool
     rtmp_stream_audio: bool
     rtmp_stream_video: bool
+    # Push the stream to the RTMP server from inside the GStreamer pipeline instead of piping it through ffmpeg
+    rtmp_native_sink: bool = False
 
     def __post_init__(self):
         # Convert to FrozenSet of FrozenSet[str]
@@ -19,8 +21,12 @@ class PipelineConfiguration:
             {
                 # Basic meeting bot configuration
                 frozenset({"record_audio", "record_video", "transcribe_audio"}),
+                # Audio only meeting bot configuration
+                frozenset({"record_audio", "transcribe_audio"}),
                 # RTMP streaming configuration
                 frozenset({"rtmp_stream_audio", "rtmp_stream_video", "transcribe_audio"}),
+                # RTMP streaming configuration with the native GStreamer RTMP sink
+                frozenset({"rtmp_stream_audio", "rtmp_stream_video", "transcribe_audio", "rtmp_native_sink"}),
                 # Voice agent configuration
                 frozenset({"transcribe_audio"}),
             }
@@ -44,13 +50,24 @@ class PipelineConfiguration:
         )
 
     @classmethod
-    def rtmp_streaming_bot(cls) -> "PipelineConfiguration":
+    def audio_recorder_bot(cls) -> "PipelineConfiguration":
+        return cls(
+            record_video=False,
+            record_audio=True,
+            transcribe_audio=True,
+            rtmp_stream_audio=False,
+            rtmp_stream_video=False,
+        )
+
+    @classmethod
+    def rtmp_streaming_bot(cls, native_sink: bool = False) -> "PipelineConfiguration":
         return cls(
             record_video=False,
             record_audio=False,
             transcribe_audio=True,
             rtmp_stream_audio=True,
             rtmp_stream_video=True,
+            rtmp_native_sink=native_sink,
         )
 
     @classmethod
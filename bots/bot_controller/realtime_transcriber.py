@@ -0,0 +1,221 @@
+import bisect
+import json
+import logging
+import queue
+import threading
+import time
+import uuid
+from urllib.parse import urlencode
+
+from websockets.sync.client import connect
+
+logger = logging.getLogger(__name__)
+
+
+class DeepgramStream:
+    """
+    A websocket to Deepgram's streaming API that one speaker's audio is sent over.
+
+    Audio is sent from a thread of its own so a slow connection never blocks the caller, and
+    results are read on another. Deepgram only hears audio while the speaker is talking, so the
+    offsets in its results are mapped back to wall clock time using the time of the first chunk
+    sent after each pause.
+    """
+
+    FINALIZE = object()
+    CLOSE = object()
+
+    # Deepgram closes streams that haven't received anything for 10 seconds
+    KEEPALIVE_INTERVAL_SECONDS = 5
+    IDLE_TIMEOUT_SECONDS = 60
+
+    def __init__(self, *, url, api_key, sample_rate, on_result_callback):
+        self.url = url
+        self.api_key = api_key
+        self.sample_rate = sample_rate
+        self.on_result_callback = on_result_callback
+        self.stream_id = uuid.uuid4().hex
+
+        self.queue = queue.Queue()
+        # Offsets in seconds of Deepgram's audio timeline and the wall clock times they correspond to
+        self.segment_offsets = []
+        self.segment_start_times = []
+        self.audio_bytes_sent = 0
+        self.starting_new_segment = True
+
+        self.connection = None
+        self.receiver_thread = None
+        # When the stream ended because of an error, so the transcriber can wait a bit before replacing it
+        self.failed_at = None
+        self.sender_thread = threading.Thread(target=self.send_loop, name="deepgram_stream_sender", daemon=True)
+        self.sender_thread.start()
+
+    def is_alive(self):
+        return self.sender_thread.is_alive()
+
+    def send_audio(self, chunk_time, chunk_bytes):
+        if self.starting_new_segment:
+            self.segment_offsets.append(self.audio_bytes_sent / (2 * self.sample_rate))
+            self.segment_start_times.append(chunk_time)
+            self.starting_new_segment = False
+        self.audio_bytes_sent += len(chunk_bytes)
+        self.queue.put(chunk_bytes)
+
+    def finalize(self):
+        """Asks Deepgram for final results for everything sent so far. The next chunk starts a new segment."""
+        self.starting_new_segment = True
+        self.queue.put(self.FINALIZE)
+
+    def close(self):
+        self.queue.put(self.CLOSE)
+
+    def join(self, timeout):
+        deadline = time.monotonic() + timeout
+        self.sender_thread.join(timeout=timeout)
+        if self.receiver_thread:
+            self.receiver_thread.join(timeout=max(0, deadline - time.monotonic()))
+        if self.connection:
+            self.connection.close()
+
+    def wall_time(self, audio_offset_seconds):
+        # Deepgram rounds its offsets, so a result that starts a few milliseconds before a segment still belongs to it
+        segment_index = max(0, bisect.bisect_right(self.segment_offsets, audio_offset_seconds + 0.01) - 1)
+        return self.segment_start_times[segment_index].timestamp() + audio_offset_seconds - self.segment_offsets[segment_index]
+
+    def send_loop(self):
+        try:
+            self.connection = connect(self.url, additional_headers={"Authorization": f"Token {self.api_key}"})
+        except Exception as e:
+            logger.exception(f"Error connecting to Deepgram streaming API: {e}")
+            self.failed_at = time.monotonic()
+            return
+
+        self.receiver_thread = threading.Thread(target=self.receive_loop, name="deepgram_stream_receiver", daemon=True)
+        self.receiver_thread.start()
+
+        last_audio_time = time.monotonic()
+        try:
+            while True:
+                try:
+                    item = self.queue.get(timeout=self.KEEPALIVE_INTERVAL_SECONDS)
+                except queue.Empty:
+                    if time.monotonic() - last_audio_time >= self.IDLE_TIMEOUT_SECONDS:
+                        self.connection.send(json.dumps({"type": "CloseStream"}))
+                        return
+                    self.connection.send(json.dumps({"type": "KeepAlive"}))
+                    continue
+
+                if item is self.CLOSE:
+                    # Deepgram sends the remaining results and then closes the connection
+                    self.connection.send(json.dumps({"type": "CloseStream"}))
+                    return
+                if item is self.FINALIZE:
+                    self.connection.send(json.dumps({"type": "Finalize"}))
+                    continue
+                self.connection.send(item)
+                last_audio_time = time.monotonic()
+        except Exception as e:
+            logger.exception(f"Error sending audio to Deepgram streaming API: {e}")
+            self.failed_at = time.monotonic()
+            self.connection.close()
+
+    def receive_loop(self):
+        try:
+            for message in self.connection:
+                result = json.loads(message)
+                if result.get("type") != "Results":
+                    continue
+                alternative = result["channel"]["alternatives"][0]
+                if not alternative.get("transcript"):
+                    continue
+                self.on_result_callback(
+                    {
+                        "segment_id": f"{self.stream_id}-{round(result['start'] * 1000)}",
+                        "transcription": alternative,
+                        "is_final": result.get("is_final", False),
+                        "timestamp_ms": round(self.wall_time(result["start"]) * 1000),
+                        "duration_ms": round(result["duration"] * 1000),
+                    }
+                )
+        except Exception as e:
+            logger.exception(f"Error receiving results from Deepgram streaming API: {e}")
+
+
+class RealtimeTranscriber:
+    """
+    Transcribes each speaker's audio as it arrives, by streaming it to Deepgram over a websocket per speaker.
+
+    IndividualAudioInputManager calls send_audio for every chunk of an utterance and finalize when the
+    utterance ends. Interim and final results are queued by the streams' threads and handed to
+    save_transcription_callback when process_results is called from the main loop. Results for the same
+    segment of speech share a source_uuid_suffix, so each interim result can replace the previous one.
+    """
+
+    # While Deepgram can't be reached, the speaker's audio is dropped rather than reconnecting for every chunk
+    RECONNECT_DELAY_SECONDS = 5
+
+    def __init__(self, *, url, api_key, options, sample_rate, get_participant_callback, save_transcription_callback):
+        params = {key: str(value).lower() if isinstance(value, bool) else value for key, value in options.items() if value is not None}
+        self.url = f"{url}?{urlencode({**params, 'encoding': 'linear16', 'sample_rate': sample_rate, 'channels': 1, 'interim_results': 'true'})}"
+        self.api_key = api_key
+        self.sample_rate = sample_rate
+        self.get_participant_callback = get_participant_callback
+        self.save_transcription_callback = save_transcription_callback
+
+        self.streams = {}
+        self.results = queue.Queue()
+
+    def send_audio(self, speaker_id, chunk_time, chunk_bytes):
+        stream = self.streams.get(speaker_id)
+        if stream is None or not stream.is_alive():
+            if stream and stream.failed_at and time.monotonic() - stream.failed_at < self.RECONNECT_DELAY_SECONDS:
+                return
+            stream = DeepgramStream(
+                url=self.url,
+                api_key=self.api_key,
+                sample_rate=self.sample_rate,
+                on_result_callback=lambda result: self.results.put((speaker_id, result)),
+            )
+            self.streams[speaker_id] = stream
+        stream.send_audio(chunk_time, chunk_bytes)
+
+    def finalize(self, speaker_id):
+        stream = self.streams.get(speaker_id)
+        if stream:
+            stream.finalize()
+
+    def process_results(self):
+        while True:
+            try:
+                speaker_id, result = self.results.get_nowait()
+            except queue.Empty:
+                return
+
+            participant = self.get_participant_callback(speaker_id)
+            if not participant:
+                continue
+            self.save_transcription_callback(
+                {
+                    **participant,
+                    "source_uuid_suffix": f"{participant['participant_uuid']}-{result['segment_id']}",
+                    "transcription": result["transcription"],
+                    "is_final": result["is_final"],
+                    "timestamp_ms": result["timestamp_ms"],
+                    "duration_ms": result["duration_ms"],
+                }
+            )
+
+    def flush(self, timeout=10):
+        """Closes every stream, waits up to timeout seconds for their last results and processes them"""
+        deadline = time.monotonic() + timeout
+        for stream in self.streams.values():
+            stream.close()
+        for stream in self.streams.values():
+            stream.join(timeout=max(0, deadline - time.monotonic()))
+        self.streams = {}
+        self.process_results()
+
+    def cleanup(self):
+        for stream in self.streams.values():
+            stream.close()
+        self.streams = {}
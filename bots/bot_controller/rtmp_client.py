@@ -43,7 +43,7 @@ class RTMPClient:
                 stdin=subprocess.PIPE,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE,
-                bufsize=10**8,
+                bufsize=0,  # Unbuffered so that writes go straight to the pipe without an intermediate copy
             )
             self.is_running = True
             logger.info(f"FFmpeg RTMP client started with PID {self.ffmpeg_process.pid}")
@@ -57,7 +57,8 @@ class RTMPClient:
         Write FLV data to the RTMP stream.
 
         Args:
-            flv_data (bytes): FLV formatted data containing audio and video
+            flv_data (bytes-like): FLV formatted data containing audio and video. Can be a memoryview
+                over a mapped GStreamer buffer, it is written out before this method returns.
 
         Returns:
             bool: True if data was written, False if failed
@@ -66,8 +67,11 @@ class RTMPClient:
             return False
 
         try:
-            self.ffmpeg_process.stdin.write(flv_data)
-            self.ffmpeg_process.stdin.flush()
+            # stdin is unbuffered, so a single write may be partial
+            remaining = memoryview(flv_data)
+            while remaining:
+                bytes_written = self.ffmpeg_process.stdin.write(remaining)
+                remaining = remaining[bytes_written:]
             return True
         except BrokenPipeError:
             logger.info("FFmpeg pipe broken - stream may have failed")
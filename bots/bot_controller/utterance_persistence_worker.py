@@ -0,0 +1,348 @@
+import logging
+import queue
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import connection, transaction
+
+from bots.models import Bot, Participant, Recording, RecordingManager, RecordingStates, Utterance, WebhookTriggerTypes
+from bots.transcription_queue import enqueue_utterances_for_transcription
+from bots.utils import pcm_to_flac, pcm_to_opus
+from bots.webhook_utils import trigger_webhook
+
+logger = logging.getLogger(__name__)
+
+
+class UtterancePersistenceWorker:
+    """
+    Saves utterances from the IndividualAudioInputManager on a background thread, so the GLib main
+    loop never waits on Postgres while media is flowing.
+
+    Utterances are queued and written in batches with bulk_create. The in progress recording and the
+    participants that have already been saved are cached, so a batch usually costs a single
+    insert. The thread uses its own database connection, which Django opens on first use and which
+    is closed when the worker stops. When utterances are saved as FLAC or Opus, each batch is
+    encoded on a pool of up to max_encoding_workers threads, so several ffmpeg processes run at once.
+
+    Adding an utterance never blocks the caller. If the database falls behind, the queue keeps
+    growing past max_pending_utterances, which is logged. A batch that fails to save is retried
+    with backoff, and its audio is only released once it's saved or SAVE_ATTEMPTS have failed.
+    A batch's audio is encoded and uploaded once, retries only repeat what failed.
+
+    Saved utterances are handed to the transcription workers in batches too. Their ids are held
+    for up to transcription_batch_window_seconds, then enqueued as a single batch per recording.
+    Ids that fail to be enqueued are kept and tried again one window later.
+
+    Results from the RealtimeTranscriber go through the same queue. Each one is saved over the
+    previous result for its segment of speech and sent in a transcript.update webhook.
+    """
+
+    STOP = object()
+
+    SAVE_ATTEMPTS = 5
+    SAVE_RETRY_BASE_DELAY_SECONDS = 0.5
+
+    AUDIO_FILE_EXTENSIONS = {
+        Utterance.AudioFormat.PCM: "pcm",
+        Utterance.AudioFormat.FLAC: "flac",
+        Utterance.AudioFormat.OGG_OPUS: "ogg",
+    }
+
+    def __init__(self, *, bot_id, max_pending_utterances=100, max_batch_size=20, transcription_batch_window_seconds=2, max_transcription_batch_size=20, max_encoding_workers=4):
+        self.bot_id = bot_id
+        self.max_batch_size = max_batch_size
+        # ffmpeg runs in a subprocess, so the threads encode in parallel
+        self.encoding_pool = ThreadPoolExecutor(max_workers=max_encoding_workers, thread_name_prefix="utterance_encoder")
+        self.max_pending_utterances = max_pending_utterances
+        self.queue = queue.Queue()
+        self.backlogged = False
+
+        self.transcription_batch_window_seconds = transcription_batch_window_seconds
+        self.max_transcription_batch_size = max_transcription_batch_size
+        # recording id -> ids of saved utterances that haven't been enqueued for transcription yet
+        self.pending_transcription_utterance_ids = {}
+        self.pending_transcription_since = None
+        # Set after enqueuing failed, so the next attempt waits for a window instead of retrying in a loop
+        self.transcription_enqueue_retry_at = None
+        self.transcription_tasks_enqueued = 0
+
+        self.bot = None
+        self.recording_in_progress = None
+        self.recording_transcription_in_progress = False
+        self.participants = {}
+
+        self.utterances_saved = 0
+        self.batches_saved = 0
+        self.realtime_transcriptions_saved = 0
+        self.utterances_backlogged = 0
+        self.utterances_dropped = 0
+
+        self.thread = threading.Thread(target=self.run, name="utterance_persistence_worker", daemon=True)
+        self.thread.start()
+
+    def add_utterance(self, message):
+        """Queue an utterance message from IndividualAudioInputManager. Its audio buffer is released once it has been saved."""
+        self.queue.put_nowait(message)
+
+        # The main loop must not wait on the database, so a backlog is only reported
+        if self.queue.qsize() > self.max_pending_utterances:
+            self.utterances_backlogged += 1
+            if not self.backlogged:
+                logger.warning(f"Utterance persistence worker is more than {self.max_pending_utterances} utterances behind")
+                self.backlogged = True
+        else:
+            self.backlogged = False
+
+    def add_realtime_transcription(self, message):
+        """Queue a result from the RealtimeTranscriber"""
+        self.queue.put_nowait(message)
+
+    def flush(self, timeout=10):
+        """
+        Blocks until everything queued so far has been saved and enqueued for transcription, or for up to
+        timeout seconds, since the database may be down. Returns whether everything was saved in time.
+        """
+        flushed = threading.Event()
+        self.queue.put(flushed)
+        if flushed.wait(timeout):
+            return True
+        logger.warning(f"Stopped waiting for the utterance persistence worker after {timeout} seconds, {self.queue.qsize()} messages are still queued")
+        return False
+
+    def cleanup(self):
+        self.queue.put(self.STOP)
+        # BotController.cleanup force kills the process after 20 seconds
+        self.thread.join(timeout=10)
+        logger.info(f"UtterancePersistenceWorker saved {self.utterances_saved} utterances in {self.batches_saved} batches and {self.realtime_transcriptions_saved} realtime transcriptions and enqueued {self.transcription_tasks_enqueued} transcription tasks. {self.utterances_backlogged} utterances were queued behind a backlog and {self.utterances_dropped} couldn't be saved")
+
+    def run(self):
+        try:
+            while True:
+                try:
+                    batch = [self.queue.get(timeout=self.seconds_until_transcription_batch_due())]
+                except queue.Empty:
+                    self.enqueue_transcriptions()
+                    continue
+                while len(batch) < self.max_batch_size:
+                    try:
+                        batch.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+
+                stopping = any(message is self.STOP for message in batch)
+                # flush puts an Event in the queue, which is set once everything queued before it is done
+                flushed_events = [message for message in batch if isinstance(message, threading.Event)]
+                flushing = stopping or bool(flushed_events)
+                messages = [message for message in batch if message is not self.STOP and not isinstance(message, threading.Event)]
+                # Realtime transcriptions have no audio
+                utterance_messages = [message for message in messages if "audio_data" in message]
+                realtime_transcription_messages = [message for message in messages if "audio_data" not in message]
+                try:
+                    if utterance_messages:
+                        self.save_utterances(utterance_messages)
+                finally:
+                    for message in utterance_messages:
+                        message["release_audio_data"]()
+                if realtime_transcription_messages:
+                    self.save_with_retries(lambda: self.save_realtime_transcriptions(realtime_transcription_messages), len(realtime_transcription_messages))
+
+                if flushing or self.seconds_until_transcription_batch_due() == 0:
+                    self.enqueue_transcriptions()
+                for _ in batch:
+                    self.queue.task_done()
+                for flushed in flushed_events:
+                    flushed.set()
+
+                if stopping:
+                    for recording_id, utterance_ids in self.pending_transcription_utterance_ids.items():
+                        logger.error(f"Stopping without enqueuing the transcription of utterances {utterance_ids} of recording {recording_id}")
+                    return
+        finally:
+            self.encoding_pool.shutdown(wait=False)
+            connection.close()
+
+    def save_with_retries(self, save, num_utterances):
+        """Calls save, retrying with backoff if the database or the audio storage fails. Returns whether it succeeded."""
+        for attempt in range(1, self.SAVE_ATTEMPTS + 1):
+            try:
+                save()
+                return True
+            except Exception as e:
+                logger.exception(f"Error saving {num_utterances} utterances, attempt {attempt} of {self.SAVE_ATTEMPTS}: {e}")
+                # A connection that broke is replaced on the next query
+                connection.close_if_unusable_or_obsolete()
+                if attempt < self.SAVE_ATTEMPTS:
+                    time.sleep(self.SAVE_RETRY_BASE_DELAY_SECONDS * 2 ** (attempt - 1))
+        logger.error(f"Giving up on saving {num_utterances} utterances after {self.SAVE_ATTEMPTS} attempts")
+        self.utterances_dropped += num_utterances
+        return False
+
+    def get_bot(self):
+        if self.bot is None:
+            self.bot = Bot.objects.get(id=self.bot_id)
+        return self.bot
+
+    def get_recording_in_progress(self):
+        if self.recording_in_progress is None:
+            recordings_in_progress = list(Recording.objects.filter(bot_id=self.bot_id, state=RecordingStates.IN_PROGRESS)[:2])
+            if len(recordings_in_progress) != 1:
+                raise Exception(f"Expected exactly one recording in progress for bot {self.bot_id}, but found {len(recordings_in_progress)}")
+            self.recording_in_progress = recordings_in_progress[0]
+        return self.recording_in_progress
+
+    def get_participant(self, message):
+        participant = self.participants.get(message["participant_uuid"])
+        if participant is None:
+            participant, _ = Participant.objects.get_or_create(
+                bot_id=self.bot_id,
+                uuid=message["participant_uuid"],
+                defaults={
+                    "user_uuid": message["participant_user_uuid"],
+                    "full_name": message["participant_full_name"],
+                },
+            )
+            self.participants[message["participant_uuid"]] = participant
+        return participant
+
+    def encode_audio(self, message):
+        if settings.UTTERANCE_AUDIO_FORMAT == "flac":
+            return Utterance.AudioFormat.FLAC, pcm_to_flac(bytes(message["audio_data"]), sample_rate=message["sample_rate"])
+        if settings.UTTERANCE_AUDIO_FORMAT == "opus":
+            return Utterance.AudioFormat.OGG_OPUS, pcm_to_opus(bytes(message["audio_data"]), sample_rate=message["sample_rate"])
+        return Utterance.AudioFormat.PCM, message["audio_data"]
+
+    def create_utterance(self, message, recording, audio_format, audio_data):
+        utterance = Utterance(
+            source=Utterance.Sources.PER_PARTICIPANT_AUDIO,
+            recording=recording,
+            participant=self.get_participant(message),
+            audio_format=audio_format,
+            timestamp_ms=message["timestamp_ms"],
+            duration_ms=len(message["audio_data"]) / 64,
+            sample_rate=message["sample_rate"],
+        )
+
+        if settings.UTTERANCE_AUDIO_STORAGE == "database":
+            # PCM audio_data is a view of the IndividualAudioInputManager's buffer, so it isn't copied before being sent to the database
+            utterance.audio_blob = audio_data
+        else:
+            # Keep the audio out of Postgres, the row only stores a reference to it
+            utterance.audio_blob = b""
+            utterance.audio_file.save(f"{recording.object_id}/{uuid.uuid4().hex}.{self.AUDIO_FILE_EXTENSIONS[audio_format]}", ContentFile(audio_data), save=False)
+
+        return utterance
+
+    def save_utterances(self, messages):
+        # Kept across attempts, so a retry doesn't encode the audio again or upload another copy of it
+        encoded_audio = []
+        utterances = [None] * len(messages)
+
+        def save():
+            recording_in_progress = self.get_recording_in_progress()
+            if not encoded_audio:
+                encoded_audio.extend(self.encoding_pool.map(self.encode_audio, messages))
+            for i, (message, (audio_format, audio_data)) in enumerate(zip(messages, encoded_audio)):
+                if utterances[i] is None:
+                    utterances[i] = self.create_utterance(message, recording_in_progress, audio_format, audio_data)
+            Utterance.objects.bulk_create(utterances)
+
+        if not self.save_with_retries(save, len(messages)):
+            # Nothing refers to the audio that was uploaded
+            for utterance in utterances:
+                if utterance is not None and utterance.audio_file:
+                    try:
+                        utterance.audio_file.delete(save=False)
+                    except Exception as e:
+                        logger.exception(f"Error deleting the audio of an utterance that couldn't be saved: {e}")
+            return
+
+        self.utterances_saved += len(utterances)
+        self.batches_saved += 1
+
+        if self.pending_transcription_since is None:
+            self.pending_transcription_since = time.monotonic()
+        self.pending_transcription_utterance_ids.setdefault(utterances[0].recording_id, []).extend(utterance.id for utterance in utterances)
+
+    def save_realtime_transcriptions(self, messages):
+        recording_in_progress = self.get_recording_in_progress()
+        # Outside the transaction, so a rollback can't leave a participant in the cache that was never saved
+        participants = {message["participant_uuid"]: self.get_participant(message) for message in messages}
+
+        # The results and their webhooks are saved together, so a retry after a failure part way through doesn't send any webhook twice
+        with transaction.atomic():
+            # Each interim result replaces the previous one for the same segment of speech, so only the latest result for each segment is saved
+            latest_messages = {message["source_uuid_suffix"]: message for message in messages}
+            for source_uuid_suffix, message in latest_messages.items():
+                Utterance.objects.update_or_create(
+                    recording=recording_in_progress,
+                    source_uuid=f"{recording_in_progress.object_id}-{source_uuid_suffix}",
+                    defaults={
+                        "source": Utterance.Sources.PER_PARTICIPANT_AUDIO,
+                        "participant": participants[message["participant_uuid"]],
+                        "transcription": message["transcription"],
+                        "timestamp_ms": message["timestamp_ms"],
+                        "duration_ms": message["duration_ms"],
+                        "sample_rate": None,
+                    },
+                )
+
+            if not self.recording_transcription_in_progress:
+                RecordingManager.set_recording_transcription_in_progress(recording_in_progress)
+
+            # Every result is still sent, interim ones included
+            for message in messages:
+                participant = participants[message["participant_uuid"]]
+                trigger_webhook(
+                    webhook_trigger_type=WebhookTriggerTypes.TRANSCRIPT_UPDATE,
+                    bot=self.get_bot(),
+                    payload={
+                        "speaker_name": participant.full_name,
+                        "speaker_uuid": participant.uuid,
+                        "speaker_user_uuid": participant.user_uuid,
+                        "timestamp_ms": message["timestamp_ms"],
+                        "duration_ms": message["duration_ms"],
+                        "transcription": message["transcription"],
+                        "is_final": message["is_final"],
+                    },
+                )
+
+        self.recording_transcription_in_progress = True
+        self.realtime_transcriptions_saved += len(messages)
+
+    def seconds_until_transcription_batch_due(self):
+        """None if no utterances are waiting to be transcribed, otherwise how long until they should be enqueued"""
+        if self.pending_transcription_since is None:
+            return None
+        if self.transcription_enqueue_retry_at is not None:
+            return max(0, self.transcription_enqueue_retry_at - time.monotonic())
+        if any(len(utterance_ids) >= self.max_transcription_batch_size for utterance_ids in self.pending_transcription_utterance_ids.values()):
+            return 0
+        return max(0, self.pending_transcription_since + self.transcription_batch_window_seconds - time.monotonic())
+
+    def enqueue_transcriptions(self):
+        pending_transcription_utterance_ids = self.pending_transcription_utterance_ids
+        self.pending_transcription_utterance_ids = {}
+        self.pending_transcription_since = None
+        self.transcription_enqueue_retry_at = None
+
+        failed_utterance_ids = {}
+        for recording_id, utterance_ids in pending_transcription_utterance_ids.items():
+            for i in range(0, len(utterance_ids), self.max_transcription_batch_size):
+                batch_utterance_ids = utterance_ids[i : i + self.max_transcription_batch_size]
+                try:
+                    enqueue_utterances_for_transcription(recording_id, batch_utterance_ids)
+                except Exception as e:
+                    logger.exception(f"Error enqueuing transcription of utterances {batch_utterance_ids}, will try again: {e}")
+                    failed_utterance_ids.setdefault(recording_id, []).extend(batch_utterance_ids)
+                    continue
+                self.transcription_tasks_enqueued += 1
+
+        # Keep the ids that couldn't be enqueued for the next attempt
+        if failed_utterance_ids:
+            self.pending_transcription_utterance_ids = failed_utterance_ids
+            self.pending_transcription_since = time.monotonic()
+            self.transcription_enqueue_retry_at = self.pending_transcription_since + self.transcription_batch_window_seconds
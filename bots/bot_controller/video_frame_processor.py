@@ -0,0 +1,187 @@
+import logging
+import threading
+import time
+from collections import deque
+
+from bots.utils import I420Scaler
+
+from .latency_stats import LatencyStats
+
+logger = logging.getLogger(__name__)
+
+
+class VideoFrameProcessor:
+    """
+    Scales raw I420 frames to the output size on a small pool of worker threads, so the
+    thread that receives frames (websocket reader, Zoom SDK callback) never blocks on
+    cv2 or on the GStreamer appsrc. cv2 and numpy release the GIL while scaling.
+
+    Frames waiting for a worker are held in a bounded queue; when it is full the oldest
+    frame is dropped, since a late frame is worth less than a fresh one. Scaled frames are
+    handed to output_callback one at a time in the order they were added, and frames whose
+    timestamp is older than the last one emitted are dropped.
+    """
+
+    STATS_LOG_INTERVAL_SECONDS = 30
+
+    def __init__(self, *, output_callback, output_size, num_workers=2, max_pending_frames=4):
+        self.output_callback = output_callback
+        self.output_size = output_size
+        self.max_pending_frames = max_pending_frames
+
+        self.lock = threading.Lock()
+        self.frames_available = threading.Condition(self.lock)
+        # Held while calling output_callback so only one worker emits at a time
+        self.emit_lock = threading.Lock()
+
+        self.pending_frames = deque()
+        self.completed_frames = {}
+        self.next_sequence_number = 0
+        self.next_sequence_number_to_emit = 0
+        self.last_emitted_timestamp_ns = None
+        self.stopped = False
+
+        self.frames_added = 0
+        self.frames_emitted = 0
+        self.frames_dropped_queue_full = 0
+        self.frames_dropped_out_of_order = 0
+        self.stage_stats = {
+            "queue_wait": LatencyStats(),
+            "scale": LatencyStats(),
+            "reorder_wait": LatencyStats(),
+            "output": LatencyStats(),
+        }
+        self.last_stats_log_time = time.time()
+
+        self.thread_local = threading.local()
+        self.scalers = []
+        self.workers = [threading.Thread(target=self.run_worker, name=f"video_frame_processor_{i}", daemon=True) for i in range(num_workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def add_frame(self, frame, frame_size, timestamp_ns):
+        """Queue a packed I420 frame. The frame buffer must not be modified after it is added."""
+        self.enqueue(frame, frame_size, timestamp_ns)
+
+    def add_frame_planes(self, y_buffer, u_buffer, v_buffer, frame_size, timestamp_ns):
+        """Queue an I420 frame whose planes are in separate buffers. The buffers must not be modified after they are added."""
+        self.enqueue((y_buffer, u_buffer, v_buffer), frame_size, timestamp_ns)
+
+    def enqueue(self, frame, frame_size, timestamp_ns):
+        with self.lock:
+            if self.stopped:
+                return
+
+            if len(self.pending_frames) >= self.max_pending_frames:
+                dropped_sequence_number = self.pending_frames.popleft()[0]
+                # Mark the slot as empty so the emitter skips over it. We don't emit from here because that
+                # could block the receiving thread; the worker that handles the frame added below will do it.
+                self.completed_frames[dropped_sequence_number] = None
+                self.frames_dropped_queue_full += 1
+
+            self.pending_frames.append((self.next_sequence_number, frame, frame_size, timestamp_ns, time.perf_counter_ns()))
+            self.next_sequence_number += 1
+            self.frames_added += 1
+            self.frames_available.notify()
+
+    def get_scaler(self):
+        if not hasattr(self.thread_local, "scaler"):
+            self.thread_local.scaler = I420Scaler()
+            with self.lock:
+                self.scalers.append(self.thread_local.scaler)
+        return self.thread_local.scaler
+
+    def run_worker(self):
+        while True:
+            with self.lock:
+                while not self.pending_frames and not self.stopped:
+                    self.frames_available.wait()
+                if self.stopped:
+                    return
+                sequence_number, frame, frame_size, timestamp_ns, added_at_ns = self.pending_frames.popleft()
+
+            scale_started_at_ns = time.perf_counter_ns()
+            try:
+                if isinstance(frame, tuple):
+                    scaled_frame = self.get_scaler().scale_planes(*frame, frame_size, self.output_size)
+                else:
+                    scaled_frame = self.get_scaler().scale(frame, frame_size, self.output_size)
+                # The scaler reuses its canvas for the next frame, so take a copy before handing it off.
+                # Frames that were already the output size come back as a view of the original buffer, which is safe to pass on.
+                if scaled_frame.obj is not frame:
+                    scaled_frame = bytes(scaled_frame)
+                result = (scaled_frame, timestamp_ns, time.perf_counter_ns())
+            except Exception as e:
+                logger.info(f"Error scaling video frame: {e}")
+                result = None
+            scale_finished_at_ns = time.perf_counter_ns()
+
+            with self.lock:
+                self.stage_stats["queue_wait"].record(scale_started_at_ns - added_at_ns)
+                self.stage_stats["scale"].record(scale_finished_at_ns - scale_started_at_ns)
+                self.completed_frames[sequence_number] = result
+
+            self.emit_completed_frames()
+
+    def pop_next_completed_frame(self):
+        with self.lock:
+            while self.next_sequence_number_to_emit in self.completed_frames:
+                result = self.completed_frames.pop(self.next_sequence_number_to_emit)
+                self.next_sequence_number_to_emit += 1
+                if result is None:
+                    continue
+
+                frame, timestamp_ns, scaled_at_ns = result
+                if self.last_emitted_timestamp_ns is not None and timestamp_ns < self.last_emitted_timestamp_ns:
+                    self.frames_dropped_out_of_order += 1
+                    continue
+
+                self.last_emitted_timestamp_ns = timestamp_ns
+                self.stage_stats["reorder_wait"].record(time.perf_counter_ns() - scaled_at_ns)
+                return frame, timestamp_ns
+            return None
+
+    def emit_completed_frames(self):
+        with self.emit_lock:
+            while True:
+                next_frame = self.pop_next_completed_frame()
+                if next_frame is None:
+                    break
+
+                frame, timestamp_ns = next_frame
+                output_started_at_ns = time.perf_counter_ns()
+                try:
+                    self.output_callback(frame, timestamp_ns)
+                except Exception as e:
+                    logger.info(f"Error emitting video frame: {e}")
+
+                with self.lock:
+                    self.stage_stats["output"].record(time.perf_counter_ns() - output_started_at_ns)
+                    self.frames_emitted += 1
+
+            if time.time() - self.last_stats_log_time >= self.STATS_LOG_INTERVAL_SECONDS:
+                self.last_stats_log_time = time.time()
+                logger.info(f"VideoFrameProcessor stats: {self.get_stats()}")
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "frames_added": self.frames_added,
+                "frames_emitted": self.frames_emitted,
+                "frames_dropped_queue_full": self.frames_dropped_queue_full,
+                "frames_dropped_out_of_order": self.frames_dropped_out_of_order,
+                "pending_frames": len(self.pending_frames),
+                "scale_paths": {path: sum(scaler.path_counts[path] for scaler in self.scalers) for path in I420Scaler.PATHS},
+                "stages": {stage_name: stats.as_dict() for stage_name, stats in self.stage_stats.items()},
+            }
+
+    def cleanup(self):
+        with self.lock:
+            self.stopped = True
+            self.pending_frames.clear()
+            self.frames_available.notify_all()
+
+        for worker in self.workers:
+            worker.join(timeout=5)
+
+        logger.info(f"VideoFrameProcessor final stats: {self.get_stats()}")
@@ -0,0 +1,89 @@
+import logging
+import threading
+import zlib
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class VideoFrameRateGovernor:
+    """
+    Sits in front of GstreamerPipeline.on_new_video_frame and decides which frames are worth encoding.
+
+    - Frames arriving faster than fps are dropped. Time is divided into 1/fps slots and at most
+      one frame is passed on per slot, which tolerates jitter in the arrival times.
+    - Frames that are identical to the last frame passed on are dropped. Frames are compared using a
+      checksum of a subsampled Y plane, which is cheap enough to run on every frame. This catches static
+      screenshares, Zoom's black frames for participants with their camera off and the browser's filler frames.
+    - While the content stays identical, the frame is re-emitted once every keepalive_interval_seconds,
+      so streams never go quiet.
+
+    Every frame passed on lasts one frame interval, keepalives included. It starts at its own timestamp
+    and ends before the next frame's slot, so frames never overlap, and no buffer is long enough to fill
+    the pipeline's time based queues. The muxer keeps each frame on screen until the next one.
+
+    Since the pipeline's videorate element only drops frames, the encoder only sees the frames passed on here.
+    """
+
+    Y_PLANE_SUBSAMPLE_STEP = 4
+
+    def __init__(self, *, output_callback, video_frame_size, fps, keepalive_interval_seconds=1):
+        self.output_callback = output_callback
+        self.video_frame_size = video_frame_size
+        self.frame_interval_ns = 1_000_000_000 // fps
+        self.keepalive_interval_ns = int(keepalive_interval_seconds * 1_000_000_000)
+
+        self.lock = threading.Lock()
+        self.start_time_ns = None
+        self.last_emitted_slot = None
+        self.last_emitted_time_ns = None
+        self.last_emitted_checksum = None
+
+        self.frames_received = 0
+        self.frames_emitted = 0
+        self.frames_dropped_over_rate = 0
+        self.frames_dropped_duplicate = 0
+        self.keepalive_frames_emitted = 0
+
+    def y_plane_checksum(self, frame):
+        width, height = self.video_frame_size
+        y_plane = np.frombuffer(frame, dtype=np.uint8, count=width * height).reshape(height, width)
+        subsampled_y_plane = y_plane[:: self.Y_PLANE_SUBSAMPLE_STEP, :: self.Y_PLANE_SUBSAMPLE_STEP]
+        return zlib.crc32(np.ascontiguousarray(subsampled_y_plane))
+
+    def on_new_video_frame(self, frame, current_time_ns):
+        with self.lock:
+            self.frames_received += 1
+
+            if self.start_time_ns is None:
+                self.start_time_ns = current_time_ns
+
+            slot = (current_time_ns - self.start_time_ns) // self.frame_interval_ns
+            if self.last_emitted_slot is not None and slot <= self.last_emitted_slot:
+                self.frames_dropped_over_rate += 1
+                return
+
+            checksum = self.y_plane_checksum(frame)
+            if checksum == self.last_emitted_checksum:
+                if current_time_ns - self.last_emitted_time_ns < self.keepalive_interval_ns:
+                    self.frames_dropped_duplicate += 1
+                    return
+                self.keepalive_frames_emitted += 1
+
+            self.last_emitted_slot = slot
+            self.last_emitted_time_ns = current_time_ns
+            self.last_emitted_checksum = checksum
+            self.frames_emitted += 1
+
+        self.output_callback(frame, current_time_ns, duration_ns=self.frame_interval_ns)
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "frames_received": self.frames_received,
+                "frames_emitted": self.frames_emitted,
+                "frames_dropped_over_rate": self.frames_dropped_over_rate,
+                "frames_dropped_duplicate": self.frames_dropped_duplicate,
+                "keepalive_frames_emitted": self.keepalive_frames_emitted,
+            }
@@ -19,6 +19,7 @@ class BotPodCreator:
         # Get configuration from environment variables
         self.app_name = os.getenv('CUBER_APP_NAME', 'attendee')
         self.app_version = os.getenv('CUBER_RELEASE_VERSION')
+        self.memory = os.getenv('BOT_POD_MEMORY', '4Gi')
         
         if not self.app_version:
             raise ValueError("CUBER_RELEASE_VERSION environment variable is required")
@@ -71,11 +72,11 @@ class BotPodCreator:
                         resources=client.V1ResourceRequirements(
                             requests={
                                 "cpu": "4",
-                                "memory": "4Gi",
+                                "memory": self.memory,
                                 "ephemeral-storage": "10Gi"
                             },
                             limits={
-                                "memory": "4Gi",
+                                "memory": self.memory,
                                 "ephemeral-storage": "10Gi"
                             }
                         ),
@@ -27,9 +27,7 @@ from .models import (
     Credentials,
     MediaBlob,
     Recording,
-    RecordingTypes,
     TranscriptionProviders,
-    TranscriptionTypes,
     Utterance,
 )
 from .serializers import (
@@ -200,8 +198,8 @@ class BotCreateView(APIView):
 
         Recording.objects.create(
             bot=bot,
-            recording_type=RecordingTypes.AUDIO_AND_VIDEO,
-            transcription_type=TranscriptionTypes.NON_REALTIME,
+            recording_type=bot.recording_type(),
+            transcription_type=bot.transcription_type(),
             transcription_provider=TranscriptionProviders.DEEPGRAM,
             is_default_recording=True,
         )
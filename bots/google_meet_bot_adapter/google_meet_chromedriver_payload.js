@@ -276,7 +276,45 @@ class FullCaptureManager {
         });
     }
 
+    setUpMixedAudioTrack() {
+        this.audioContext = new AudioContext();
+
+        this.audioSources = this.audioTracks.map(track => {
+            const mediaStream = new MediaStream([track]);
+            return this.audioContext.createMediaStreamSource(mediaStream);
+        });
+
+        // Create a destination node
+        const destination = this.audioContext.createMediaStreamDestination();
+
+        // Connect all sources to the destination
+        this.audioSources.forEach(source => {
+            source.connect(destination);
+        });
+
+        // Create analyzer and connect it to the destination
+        this.analyser = this.audioContext.createAnalyser();
+        this.analyser.fftSize = 256;
+        const bufferLength = this.analyser.frequencyBinCount;
+        this.audioDataArray = new Uint8Array(bufferLength);
+
+        // Create a source from the destination's stream and connect it to the analyzer
+        const mixedSource = this.audioContext.createMediaStreamSource(destination.stream);
+        mixedSource.connect(this.analyser);
+
+        this.mixedAudioTrack = destination.stream.getAudioTracks()[0];
+    }
+
     async start() {
+        // For audio only recordings, skip rendering the meeting to a canvas and just record the mixed audio
+        if (!window.initialData.sendVideo) {
+            this.setUpMixedAudioTrack();
+            this.finalStream = new MediaStream([this.mixedAudioTrack]);
+            this.startRecording();
+            this.startSilenceDetection();
+            return;
+        }
+
         // Find the main element that contains all the video elements
         const mainElement = document.querySelector('main');
         if (!mainElement) {
@@ -429,33 +467,7 @@ class FullCaptureManager {
         this.videoTrack = videoTrack;
         this.canvas = canvas; // Store canvas reference for cleanup
 
-        // Set up audio context and processing as before
-        this.audioContext = new AudioContext();
-
-        this.audioSources = this.audioTracks.map(track => {
-            const mediaStream = new MediaStream([track]);
-            return this.audioContext.createMediaStreamSource(mediaStream);
-        });
-
-        // Create a destination node
-        const destination = this.audioContext.createMediaStreamDestination();
-
-        // Connect all sources to the destination
-        this.audioSources.forEach(source => {
-            source.connect(destination);
-        });
-
-        // Create analyzer and connect it to the destination
-        this.analyser = this.audioContext.createAnalyser();
-        this.analyser.fftSize = 256;
-        const bufferLength = this.analyser.frequencyBinCount;
-        this.audioDataArray = new Uint8Array(bufferLength);
-
-        // Create a source from the destination's stream and connect it to the analyzer
-        const mixedSource = this.audioContext.createMediaStreamSource(destination.stream);
-        mixedSource.connect(this.analyser);
-
-        this.mixedAudioTrack = destination.stream.getAudioTracks()[0];
+        this.setUpMixedAudioTrack();
 
         this.finalStream = new MediaStream([
             this.videoTrack,
@@ -504,7 +516,7 @@ class FullCaptureManager {
 
     startRecording() {
         // Options for better quality
-        const options = { mimeType: 'video/mp4' };
+        const options = { mimeType: window.initialData.sendVideo ? 'video/mp4' : 'audio/mp4' };
         this.mediaRecorder = new MediaRecorder(this.finalStream, options);
 
         this.mediaRecorder.ondataavailable = (event) => {
@@ -0,0 +1,80 @@
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from bots.bot_controller.individual_audio_input_manager import IndividualAudioInputManager
+
+
+class Command(BaseCommand):
+    help = "Replays a synthetic many-speaker meeting through IndividualAudioInputManager and reports chunks/sec"
+
+    # Zoom delivers per-participant audio in 10ms chunks of 32kHz mono S16LE
+    CHUNK_SAMPLES = 320
+    # process_chunks runs on a 100ms main loop timeout
+    TICK_SECONDS = 0.1
+
+    def add_arguments(self, parser):
+        parser.add_argument("--speakers", type=int, default=50, help="Number of participants sending audio")
+        parser.add_argument("--active-speakers", type=int, default=5, help="How many of the participants are talking at once")
+        parser.add_argument("--meeting-seconds", type=int, default=60, help="Length of the replayed meeting")
+
+    def create_workload(self, options):
+        rng = np.random.default_rng(0)
+        chunks_per_tick = round(self.TICK_SECONDS * 32000 / self.CHUNK_SAMPLES)
+        # A handful of distinct chunks per speaker is enough, the manager doesn't care that they repeat
+        chunks = {}
+        for speaker_id in range(options["speakers"]):
+            # Talking participants get loud noise, the rest get the low level hiss of an open microphone
+            amplitude = 3000 if speaker_id < options["active_speakers"] else 50
+            chunks[speaker_id] = [rng.normal(0, amplitude, self.CHUNK_SAMPLES).clip(-32768, 32767).astype(np.int16).tobytes() for _ in range(chunks_per_tick)]
+        return chunks
+
+    def replay(self, chunks, options, process_tick):
+        utterances_saved = 0
+
+        def save_utterance(utterance):
+            nonlocal utterances_saved
+            utterances_saved += 1
+            utterance["release_audio_data"]()
+
+        manager = IndividualAudioInputManager(save_utterance_callback=save_utterance, get_participant_callback=lambda speaker_id: {"participant_uuid": speaker_id})
+        # process_chunks compares against the wall clock, so the replayed meeting has to start now
+        meeting_start = datetime.utcnow()
+        num_ticks = int(options["meeting_seconds"] / self.TICK_SECONDS)
+        num_chunks = 0
+
+        cpu_seconds = 0.0
+        for tick in range(num_ticks):
+            tick_time = meeting_start + timedelta(seconds=tick * self.TICK_SECONDS)
+            for speaker_id, speaker_chunks in chunks.items():
+                for i, chunk_bytes in enumerate(speaker_chunks):
+                    manager.add_chunk(speaker_id, tick_time + timedelta(milliseconds=10 * i), chunk_bytes)
+                    num_chunks += 1
+
+            tick_start = time.process_time()
+            process_tick(manager)
+            cpu_seconds += time.process_time() - tick_start
+
+        # Like flush_utterances, but relative to the end of the replayed meeting rather than the wall clock
+        meeting_end = meeting_start + timedelta(seconds=num_ticks * self.TICK_SECONDS + manager.SILENCE_DURATION_LIMIT + 1)
+        for speaker_id in list(manager.first_nonsilent_audio_time.keys()):
+            manager.process_chunk(speaker_id, meeting_end, None)
+        return num_chunks / cpu_seconds, cpu_seconds / num_ticks, utterances_saved, manager.arena.blocks_allocated
+
+    def process_tick_one_chunk_at_a_time(self, manager):
+        # How process_chunks worked before it was batched
+        while not manager.queue.empty():
+            manager.process_chunk(*manager.queue.get())
+
+        for speaker_id in list(manager.first_nonsilent_audio_time.keys()):
+            manager.process_chunk(speaker_id, datetime.utcnow(), None)
+
+    def handle(self, *args, **options):
+        chunks = self.create_workload(options)
+        self.stdout.write(f"speakers: {options['speakers']} ({options['active_speakers']} talking), meeting length: {options['meeting_seconds']}s")
+
+        for name, process_tick in [("one chunk at a time", self.process_tick_one_chunk_at_a_time), ("batched", IndividualAudioInputManager.process_chunks)]:
+            chunks_per_second, cpu_seconds_per_tick, utterances_saved, blocks_allocated = self.replay(chunks, options, process_tick)
+            self.stdout.write(f"{name}: {chunks_per_second:.0f} chunks/sec, {1000 * cpu_seconds_per_tick:.2f} ms per 100ms tick, {utterances_saved} utterances saved, {blocks_allocated} utterance buffers allocated")
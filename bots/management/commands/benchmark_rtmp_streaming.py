@@ -0,0 +1,81 @@
+import os
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+
+from bots.bot_controller.encoder_profile import EncoderProfile
+from bots.bot_controller.gstreamer_pipeline import GstreamerPipeline
+
+
+class Command(BaseCommand):
+    help = "Measures throughput and CPU usage of the GStreamer FLV appsink path used for RTMP streaming"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--seconds", type=int, default=30, help="How long to stream for")
+        parser.add_argument("--zero-copy", action="store_true", help="Map appsink buffers instead of copying them")
+        parser.add_argument("--output", type=str, default=os.devnull, help="Where to write the FLV stream")
+        parser.add_argument("--width", type=int, default=1920, help="Video frame width")
+        parser.add_argument("--height", type=int, default=1080, help="Video frame height")
+        parser.add_argument("--preset", type=str, default="ultrafast", help="x264 preset")
+
+    def handle(self, *args, **options):
+        encoder_profile = EncoderProfile(video_frame_size=(options["width"], options["height"]), preset=options["preset"])
+        video_frame_size = encoder_profile.video_frame_size
+        output_file = open(options["output"], "wb", buffering=0)
+
+        bytes_written = 0
+        callback_cpu_seconds = 0.0
+        stats_lock = threading.Lock()
+
+        # Mimics RTMPClient.write_data, which writes each sample to the ffmpeg pipe before returning
+        def on_new_sample(data):
+            nonlocal bytes_written, callback_cpu_seconds
+            callback_start = time.thread_time()
+            remaining = memoryview(data)
+            while remaining:
+                remaining = remaining[output_file.write(remaining) :]
+            with stats_lock:
+                bytes_written += len(data)
+                callback_cpu_seconds += time.thread_time() - callback_start
+
+        pipeline = GstreamerPipeline(
+            on_new_sample_callback=on_new_sample,
+            encoder_profile=encoder_profile,
+            audio_format=GstreamerPipeline.AUDIO_FORMAT_PCM,
+            output_format=GstreamerPipeline.OUTPUT_FORMAT_FLV,
+            num_audio_sources=1,
+            sink_type=GstreamerPipeline.SINK_TYPE_APPSINK,
+            zero_copy_samples=options["zero_copy"],
+        )
+        pipeline.setup()
+
+        # Black I420 frame (Y=0, U=V=128)
+        video_frame = b"\x00" * (video_frame_size[0] * video_frame_size[1]) + b"\x80" * (video_frame_size[0] * video_frame_size[1] // 2)
+        # 10ms of 32kHz mono S16LE silence
+        audio_chunk = b"\x00" * 640
+
+        wall_start = time.monotonic()
+        cpu_start = time.process_time()
+        next_video_time = wall_start
+        next_audio_time = wall_start
+        while time.monotonic() - wall_start < options["seconds"]:
+            now = time.monotonic()
+            if now >= next_audio_time:
+                pipeline.on_mixed_audio_raw_data_received_callback(audio_chunk, time.time_ns())
+                next_audio_time += 0.01
+            if now >= next_video_time:
+                pipeline.on_new_video_frame(video_frame, time.time_ns())
+                next_video_time += 1 / 30
+            time.sleep(max(0, min(next_audio_time, next_video_time) - time.monotonic()))
+
+        pipeline.cleanup()
+        wall_seconds = time.monotonic() - wall_start
+        cpu_seconds = time.process_time() - cpu_start
+        output_file.close()
+
+        mode = "zero-copy" if options["zero_copy"] else "copy"
+        self.stdout.write(f"mode: {mode}")
+        self.stdout.write(f"bytes/sec: {bytes_written / wall_seconds:.0f}")
+        self.stdout.write(f"process CPU per stream: {100 * cpu_seconds / wall_seconds:.1f}% of one core")
+        self.stdout.write(f"appsink callback CPU: {callback_cpu_seconds:.3f}s ({1_000_000 * callback_cpu_seconds / max(bytes_written / 1024, 1):.3f}us per KB)")
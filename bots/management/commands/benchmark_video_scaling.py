@@ -0,0 +1,44 @@
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from bots.utils import I420Scaler, half_ceil, scale_i420
+
+
+class Command(BaseCommand):
+    help = "Measures single-core frames/sec of scale_i420 versus the cached-canvas I420Scaler"
+
+    # Source sizes seen in practice: Zoom 180P tiles, 4:3 webcams, portrait phones, full HD and 4K screenshares
+    FRAME_SIZES = [(320, 180), (640, 480), (360, 640), (1280, 720), (1920, 1080), (3840, 2160)]
+
+    def add_arguments(self, parser):
+        parser.add_argument("--seconds", type=float, default=3, help="How long to run each case for")
+        parser.add_argument("--width", type=int, default=1920, help="Output frame width")
+        parser.add_argument("--height", type=int, default=1080, help="Output frame height")
+
+    def frames_per_second(self, scale, seconds):
+        frames = 0
+        start = time.perf_counter()
+        while time.perf_counter() - start < seconds:
+            scale()
+            frames += 1
+        return frames / (time.perf_counter() - start)
+
+    def handle(self, *args, **options):
+        new_size = (options["width"], options["height"])
+        scaler = I420Scaler()
+        rng = np.random.default_rng(0)
+
+        self.stdout.write(f"output size: {new_size[0]}x{new_size[1]}")
+        for frame_size in self.FRAME_SIZES:
+            width, height = frame_size
+            frame = rng.integers(0, 256, width * height + 2 * half_ceil(width) * half_ceil(height), dtype=np.uint8).tobytes()
+
+            legacy_fps = self.frames_per_second(lambda: scale_i420(frame, frame_size, new_size), options["seconds"])
+            # bytes() accounts for the copy GstreamerPipeline makes when it wraps the frame in a Gst.Buffer
+            scaler_fps = self.frames_per_second(lambda: bytes(scaler.scale(frame, frame_size, new_size)), options["seconds"])
+
+            self.stdout.write(f"{width}x{height}: scale_i420 {legacy_fps:.0f} fps, I420Scaler {scaler_fps:.0f} fps ({scaler_fps / legacy_fps:.2f}x)")
+
+        self.stdout.write(f"I420Scaler paths taken: {scaler.path_counts}")
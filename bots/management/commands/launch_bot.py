@@ -9,7 +9,6 @@ from bots.models import (
     BotEventTypes,
     Project,
     Recording,
-    RecordingTypes,
     TranscriptionProviders,
     TranscriptionTypes,
 )
@@ -47,7 +46,7 @@ class Command(BaseCommand):
 
         Recording.objects.create(
             bot=bot,
-            recording_type=RecordingTypes.AUDIO_AND_VIDEO,
+            recording_type=bot.recording_type(),
             transcription_type=TranscriptionTypes.NON_REALTIME,
             transcription_provider=TranscriptionProviders.DEEPGRAM,
             is_default_recording=True,
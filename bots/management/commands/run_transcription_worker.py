@@ -0,0 +1,234 @@
+import asyncio
+import hashlib
+import json
+import logging
+import signal
+import time
+import uuid
+
+import httpx
+import redis.asyncio as aioredis
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from bots.models import Recording, RecordingManager, Utterance
+from bots.tasks.process_utterance_task import get_deepgram_encoding_options, get_deepgram_options, save_transcriptions, set_recording_transcription_complete_if_done
+from bots.transcription_client_cache import deepgram_client_cache
+from bots.transcription_queue import (
+    TRANSCRIPTION_PROCESSING_KEY_PREFIX,
+    TRANSCRIPTION_QUEUE_KEY,
+    TRANSCRIPTION_RETRY_QUEUE_KEY,
+    TRANSCRIPTION_WORKER_HEARTBEAT_KEY_PREFIX,
+    get_redis_url,
+)
+from bots.transcription_results_cache import transcription_results_cache
+
+logger = logging.getLogger(__name__)
+
+# Moves a batch from the retry queue to the transcription queue, unless another worker already did
+PROMOTE_RETRY_SCRIPT = """
+if redis.call('zrem', KEYS[1], ARGV[1]) == 1 then
+    redis.call('lpush', KEYS[2], ARGV[1])
+    return 1
+end
+return 0
+"""
+
+
+class Command(BaseCommand):
+    help = "Transcribes the utterances that bots queue when TRANSCRIPTION_WORKER is async, keeping many Deepgram requests in flight from a single process"
+
+    # Batches are taken from the queue with BLMOVE into this worker's processing list and only removed from
+    # it once their transcriptions are saved. Every HEARTBEAT_INTERVAL_SECONDS, each worker looks for the
+    # processing lists of workers whose heartbeat key has expired, which died, and moves their batches back
+    # to the queue. Utterances that fail are retried with backoff.
+    MAX_ATTEMPTS = 5
+    RETRY_BASE_DELAY_SECONDS = 10
+    RETRY_MAX_DELAY_SECONDS = 300
+    HEARTBEAT_INTERVAL_SECONDS = 10
+    HEARTBEAT_TTL_SECONDS = 30
+
+    def add_arguments(self, parser):
+        parser.add_argument("--max-in-flight", type=int, default=200, help="How many utterances may be transcribed at once")
+        parser.add_argument("--max-connections", type=int, default=100, help="Size of the pool of connections to Deepgram")
+        parser.add_argument("--drain", action="store_true", help="Exit once the queue is empty, instead of waiting for more")
+
+    def handle(self, *args, **options):
+        asyncio.run(self.run(options))
+
+    async def run(self, options):
+        max_in_flight = options["max_in_flight"]
+        self.transcription_slots = asyncio.Semaphore(max_in_flight)
+        self.utterances_in_progress = 0
+        self.utterances_transcribed = 0
+        self.utterances_failed = 0
+
+        stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signal_number in [signal.SIGINT, signal.SIGTERM]:
+            loop.add_signal_handler(signal_number, stopping.set)
+
+        self.worker_id = uuid.uuid4().hex
+        self.processing_key = f"{TRANSCRIPTION_PROCESSING_KEY_PREFIX}:{self.worker_id}"
+        self.heartbeat_key = f"{TRANSCRIPTION_WORKER_HEARTBEAT_KEY_PREFIX}:{self.worker_id}"
+
+        redis_client = aioredis.from_url(get_redis_url())
+        self.redis_client = redis_client
+        self.promote_retry_script = redis_client.register_script(PROMOTE_RETRY_SCRIPT)
+        await redis_client.set(self.heartbeat_key, 1, ex=self.HEARTBEAT_TTL_SECONDS)
+        await self.recover_abandoned_work()
+        await self.promote_due_retries()
+        heartbeat_task = asyncio.create_task(self.heartbeat_loop())
+
+        # Every request goes through one pool of keep-alive connections, rather than a new connection per utterance
+        limits = httpx.Limits(max_connections=options["max_connections"], max_keepalive_connections=options["max_connections"])
+        async with httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(300, connect=10)) as http_client:
+            self.http_client = http_client
+            tasks = set()
+
+            logger.info(f"Transcription worker started with up to {max_in_flight} utterances in flight")
+            while not stopping.is_set():
+                # Leave the work in Redis for other workers rather than taking on more than can be in flight
+                if self.utterances_in_progress >= max_in_flight:
+                    await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                    continue
+
+                raw_work_item = await redis_client.blmove(TRANSCRIPTION_QUEUE_KEY, self.processing_key, 1, "RIGHT", "LEFT")
+                if raw_work_item is None:
+                    if options["drain"] and not tasks:
+                        break
+                    continue
+
+                work_item = json.loads(raw_work_item)
+                self.utterances_in_progress += len(work_item["utterance_ids"])
+                task = asyncio.create_task(self.process_work_item(raw_work_item, work_item))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+
+            logger.info(f"Stopping transcription worker, waiting for {len(tasks)} batches to finish")
+            if tasks:
+                await asyncio.wait(tasks)
+
+        heartbeat_task.cancel()
+        await redis_client.delete(self.heartbeat_key)
+        await redis_client.aclose()
+        logger.info(f"Transcription worker stopped after transcribing {self.utterances_transcribed} utterances, {self.utterances_failed} failed")
+
+    async def heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(self.HEARTBEAT_INTERVAL_SECONDS)
+            try:
+                await self.redis_client.set(self.heartbeat_key, 1, ex=self.HEARTBEAT_TTL_SECONDS)
+                # A worker that crashed is usually restarted before its heartbeat expires, so this can't only be done at startup
+                await self.recover_abandoned_work()
+                await self.promote_due_retries()
+            except Exception as e:
+                logger.exception(f"Error sending transcription worker heartbeat: {e}")
+
+    async def recover_abandoned_work(self):
+        """Moves the batches of workers that died before finishing them back to the queue"""
+        async for processing_key in self.redis_client.scan_iter(match=f"{TRANSCRIPTION_PROCESSING_KEY_PREFIX}:*"):
+            worker_id = processing_key.decode().rsplit(":", 1)[1]
+            if await self.redis_client.exists(f"{TRANSCRIPTION_WORKER_HEARTBEAT_KEY_PREFIX}:{worker_id}"):
+                continue
+            num_recovered = 0
+            while await self.redis_client.lmove(processing_key, TRANSCRIPTION_QUEUE_KEY, "RIGHT", "RIGHT") is not None:
+                num_recovered += 1
+            if num_recovered:
+                logger.info(f"Recovered {num_recovered} transcription batches from worker {worker_id}")
+
+    async def promote_due_retries(self):
+        for raw_work_item in await self.redis_client.zrangebyscore(TRANSCRIPTION_RETRY_QUEUE_KEY, "-inf", time.time()):
+            await self.promote_retry_script(keys=[TRANSCRIPTION_RETRY_QUEUE_KEY, TRANSCRIPTION_QUEUE_KEY], args=[raw_work_item])
+
+    def retry_delay(self, attempt):
+        return min(self.RETRY_MAX_DELAY_SECONDS, self.RETRY_BASE_DELAY_SECONDS * 2 ** (attempt - 1))
+
+    async def finish_work_item(self, raw_work_item, work_item, failed_utterance_ids):
+        """Removes the batch from this worker's processing list, and schedules a retry of the utterances that failed in the same transaction"""
+        pipeline = self.redis_client.pipeline(transaction=True)
+        if failed_utterance_ids:
+            attempt = work_item.get("attempt", 0) + 1
+            if attempt < self.MAX_ATTEMPTS:
+                retry_work_item = json.dumps({"recording_id": work_item["recording_id"], "utterance_ids": failed_utterance_ids, "attempt": attempt})
+                pipeline.zadd(TRANSCRIPTION_RETRY_QUEUE_KEY, {retry_work_item: time.time() + self.retry_delay(attempt)})
+            else:
+                logger.error(f"Giving up on transcribing utterances {failed_utterance_ids} for recording {work_item['recording_id']} after {attempt} attempts")
+                self.utterances_failed += len(failed_utterance_ids)
+        pipeline.lrem(self.processing_key, 1, raw_work_item)
+        await pipeline.execute()
+
+    def load_work_item(self, work_item):
+        # This process runs for a long time, so connections that have gone stale need to be replaced
+        close_old_connections()
+
+        recording = Recording.objects.select_related("bot").get(id=work_item["recording_id"])
+        RecordingManager.set_recording_transcription_in_progress(recording)
+        utterances = list(Utterance.objects.filter(recording=recording, id__in=work_item["utterance_ids"], transcription__isnull=True).order_by("id"))
+        if not utterances:
+            return recording, utterances, None, None
+        return recording, utterances, deepgram_client_cache.get_api_key(recording.bot.project_id), get_deepgram_options(recording.bot)
+
+    def save_results(self, recording, transcribed_utterances):
+        save_transcriptions(transcribed_utterances)
+        set_recording_transcription_complete_if_done(recording)
+
+    async def process_work_item(self, raw_work_item, work_item):
+        try:
+            failed_utterance_ids = []
+            try:
+                recording, utterances, api_key, deepgram_options = await sync_to_async(self.load_work_item)(work_item)
+
+                results = await asyncio.gather(*[self.transcribe(utterance, api_key, deepgram_options) for utterance in utterances], return_exceptions=True)
+
+                transcribed_utterances = []
+                for utterance, result in zip(utterances, results):
+                    if isinstance(result, Exception):
+                        logger.error(f"Error transcribing utterance {utterance.id}: {result}")
+                        failed_utterance_ids.append(utterance.id)
+                        continue
+                    utterance.transcription = result
+                    transcribed_utterances.append(utterance)
+
+                await sync_to_async(self.save_results)(recording, transcribed_utterances)
+                self.utterances_transcribed += len(transcribed_utterances)
+            except Exception as e:
+                logger.exception(f"Error processing transcription batch {work_item}: {e}")
+                # Utterances whose transcriptions were saved are skipped when the batch is loaded again
+                failed_utterance_ids = work_item["utterance_ids"]
+
+            await self.finish_work_item(raw_work_item, work_item, failed_utterance_ids)
+        except Exception as e:
+            # The batch stays in this worker's processing list, so it's recovered once the worker restarts
+            logger.exception(f"Error finishing transcription batch {work_item}: {e}")
+        finally:
+            self.utterances_in_progress -= len(work_item["utterance_ids"])
+
+    async def transcribe(self, utterance, api_key, deepgram_options):
+        async with self.transcription_slots:
+            options = {**deepgram_options, **get_deepgram_encoding_options(utterance)}
+            audio_data, cache_key, cached_transcription = await asyncio.to_thread(self.read_audio, utterance, options)
+            if cached_transcription is not None:
+                return cached_transcription
+
+            params = {key: str(value).lower() if isinstance(value, bool) else value for key, value in options.items() if value is not None}
+            response = await self.http_client.post(
+                settings.DEEPGRAM_LISTEN_URL,
+                params=params,
+                content=audio_data,
+                headers={"Authorization": f"Token {api_key}", "Content-Type": "application/octet-stream"},
+            )
+            response.raise_for_status()
+            transcription = response.json()["results"]["channels"][0]["alternatives"][0]
+
+            await asyncio.to_thread(transcription_results_cache.set, cache_key, transcription)
+            return transcription
+
+    def read_audio(self, utterance, options):
+        """Reads the utterance's audio and looks up whether it has already been transcribed with the same options"""
+        with utterance.open_audio() as audio_file:
+            audio_data = audio_file.read()
+        cache_key = transcription_results_cache.key(hashlib.sha256(audio_data).hexdigest(), options)
+        return audio_data, cache_key, transcription_results_cache.get(cache_key)
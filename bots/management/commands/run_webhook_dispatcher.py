@@ -0,0 +1,205 @@
+import asyncio
+import contextlib
+import logging
+import random
+import signal
+import time
+from collections import defaultdict
+from datetime import timedelta
+
+import httpx
+from asgiref.sync import sync_to_async
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from bots.models import WebhookDeliveryAttempt, WebhookDeliveryAttemptStatus
+from bots.webhook_circuit_breaker import is_healthy_response, webhook_circuit_breaker, webhook_destination
+from bots.webhook_utils import get_webhook_request
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Delivers the webhooks that are pending when WEBHOOK_DISPATCHER is async, keeping many deliveries in flight from a single process"
+
+    # How long a claimed delivery attempt is hidden from other dispatchers. It only runs out if this process dies before recording the outcome.
+    CLAIM_SECONDS = 300
+    RETRY_BASE_SECONDS = 10
+    RETRY_MAX_SECONDS = 600
+
+    def add_arguments(self, parser):
+        parser.add_argument("--max-in-flight", type=int, default=2000, help="How many webhooks may be delivered at once")
+        parser.add_argument("--max-per-destination", type=int, default=10, help="How many webhooks may be delivered to the same host at once")
+        parser.add_argument("--max-attempts", type=int, default=5, help="How many times a webhook is sent before it's marked as failed")
+        parser.add_argument("--batch-size", type=int, default=500, help="How many pending deliveries are claimed per query")
+        parser.add_argument("--poll-interval", type=float, default=1.0, help="Seconds to wait before looking again when nothing is pending")
+        parser.add_argument("--drain", action="store_true", help="Exit once no deliveries are due, instead of waiting for more")
+
+    def handle(self, *args, **options):
+        asyncio.run(self.run(options))
+
+    async def run(self, options):
+        max_in_flight = options["max_in_flight"]
+        self.max_attempts = options["max_attempts"]
+        self.destination_slots = defaultdict(lambda: asyncio.Semaphore(options["max_per_destination"]))
+        self.deliveries_in_progress = 0
+        self.deliveries_succeeded = 0
+        self.deliveries_failed = 0
+
+        stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signal_number in [signal.SIGINT, signal.SIGTERM]:
+            loop.add_signal_handler(signal_number, stopping.set)
+
+        # Destinations are limited by destination_slots, so the pool only needs to be big enough for everything in flight
+        limits = httpx.Limits(max_connections=max_in_flight, max_keepalive_connections=max_in_flight)
+        async with httpx.AsyncClient(limits=limits, timeout=10) as http_client:
+            self.http_client = http_client
+            tasks = set()
+
+            logger.info(f"Webhook dispatcher started with up to {max_in_flight} deliveries in flight")
+            while not stopping.is_set():
+                if self.deliveries_in_progress >= max_in_flight:
+                    await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                    continue
+
+                claimed_deliveries = await sync_to_async(self.claim_deliveries)(min(options["batch_size"], max_in_flight - self.deliveries_in_progress))
+                if not claimed_deliveries:
+                    if options["drain"] and not tasks:
+                        break
+                    with contextlib.suppress(asyncio.TimeoutError):
+                        await asyncio.wait_for(stopping.wait(), timeout=options["poll_interval"])
+                    continue
+
+                for delivery, body, headers in claimed_deliveries:
+                    self.deliveries_in_progress += 1
+                    task = asyncio.create_task(self.deliver(delivery, body, headers))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+
+            logger.info(f"Stopping webhook dispatcher, waiting for {len(tasks)} deliveries to finish")
+            if tasks:
+                await asyncio.wait(tasks)
+
+        logger.info(f"Webhook dispatcher stopped after {self.deliveries_succeeded} successful deliveries, {self.deliveries_failed} failed")
+
+    def claim_deliveries(self, limit):
+        """Takes up to limit pending delivery attempts that are due, so that other dispatchers skip them, and prepares their requests"""
+        # This process runs for a long time, so connections that have gone stale need to be replaced
+        close_old_connections()
+
+        now = timezone.now()
+        with transaction.atomic():
+            deliveries = list(WebhookDeliveryAttempt.objects.select_for_update(skip_locked=True, of=("self",)).select_related("webhook_subscription__project", "bot").filter(status=WebhookDeliveryAttemptStatus.PENDING).filter(Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=now)).order_by("id")[:limit])
+            WebhookDeliveryAttempt.objects.filter(id__in=[delivery.id for delivery in deliveries]).update(next_attempt_at=now + timedelta(seconds=self.CLAIM_SECONDS))
+
+        claimed_deliveries = []
+        for delivery in deliveries:
+            subscription = delivery.webhook_subscription
+
+            # If the subscription is no longer active, mark as failed without sending it
+            if not subscription.is_active:
+                delivery.status = WebhookDeliveryAttemptStatus.FAILURE
+                delivery.next_attempt_at = None
+                delivery.add_to_response_body_list(
+                    {
+                        "status_code": None,
+                        "error_type": "InactiveSubscription",
+                        "error_message": "Webhook subscription is no longer active",
+                        "request_url": subscription.url,
+                    }
+                )
+                delivery.save()
+                continue
+
+            claimed_deliveries.append(delivery)
+
+        # Deliveries to destinations whose circuit is open are put off until it may have recovered, one update per destination
+        deliveries_by_destination = defaultdict(list)
+        for delivery in claimed_deliveries:
+            deliveries_by_destination[webhook_destination(delivery.webhook_subscription.url)].append(delivery)
+        deliveries_to_send = []
+        for destination, destination_deliveries in deliveries_by_destination.items():
+            seconds_until_retry = webhook_circuit_breaker.seconds_until_retry(destination)
+            if seconds_until_retry > 0:
+                WebhookDeliveryAttempt.objects.filter(id__in=[delivery.id for delivery in destination_deliveries]).update(next_attempt_at=now + timedelta(seconds=seconds_until_retry))
+            else:
+                deliveries_to_send.extend(destination_deliveries)
+
+        return [(delivery, *get_webhook_request(delivery)) for delivery in deliveries_to_send]
+
+    def defer_pending_deliveries(self, destination, seconds):
+        """Puts off every pending delivery to the destination that's due before the circuit may have recovered"""
+        until = timezone.now() + timedelta(seconds=seconds)
+        num_deferred = WebhookDeliveryAttempt.objects.filter(status=WebhookDeliveryAttemptStatus.PENDING).filter(Q(webhook_subscription__url=destination) | Q(webhook_subscription__url__startswith=f"{destination}/")).filter(Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lt=until)).update(next_attempt_at=until)
+        logger.info(f"Deferred {num_deferred} pending webhook deliveries to {destination} for {seconds} seconds")
+
+    def retry_delay(self, attempt_count, destination):
+        # Exponential backoff with jitter, so deliveries that failed together don't all come back at once
+        delay = min(self.RETRY_MAX_SECONDS, self.RETRY_BASE_SECONDS * 2 ** (attempt_count - 1))
+        # There's no point retrying before the destination's circuit may have closed
+        return max(delay / 2 + random.uniform(0, delay / 2), webhook_circuit_breaker.seconds_until_retry(destination))
+
+    async def deliver(self, delivery, body, headers):
+        url = delivery.webhook_subscription.url
+        destination = webhook_destination(url)
+        try:
+            async with self.destination_slots[destination]:
+                # The circuit may have opened while this delivery was waiting for a slot. It isn't counted as an attempt.
+                allowed, probe_id = await asyncio.to_thread(webhook_circuit_breaker.allow_request, destination)
+                if not allowed:
+                    seconds_until_retry = await asyncio.to_thread(webhook_circuit_breaker.seconds_until_retry, destination)
+                    delivery.next_attempt_at = timezone.now() + timedelta(seconds=seconds_until_retry)
+                    await sync_to_async(delivery.save)()
+                    return
+
+                delivery.attempt_count += 1
+                delivery.last_attempt_at = timezone.now()
+                request_started_at = time.monotonic()
+                try:
+                    response = await self.http_client.post(url, content=body, headers=headers)
+                except httpx.HTTPError as e:
+                    response = None
+                    # Handle network errors, timeouts, etc.
+                    delivery.add_to_response_body_list(
+                        {
+                            "status_code": None,  # No HTTP status since request failed
+                            "error_type": type(e).__name__,
+                            "error_message": str(e),
+                            "request_url": url,
+                        }
+                    )
+                latency_seconds = time.monotonic() - request_started_at
+
+            status_code = response.status_code if response is not None else None
+            if response is not None:
+                # Limit response body storage to prevent DB issues with large responses
+                delivery.add_to_response_body_list(response.text[:10000])
+
+            if await asyncio.to_thread(webhook_circuit_breaker.record_result, destination, is_healthy_response(status_code), latency_seconds, probe_id):
+                seconds_until_retry = await asyncio.to_thread(webhook_circuit_breaker.seconds_until_retry, destination)
+                await sync_to_async(self.defer_pending_deliveries)(destination, seconds_until_retry)
+
+            await sync_to_async(self.record_attempt)(delivery, destination, succeeded=status_code is not None and 200 <= status_code < 300)
+        except Exception as e:
+            logger.exception(f"Error delivering webhook {delivery.id}: {e}")
+        finally:
+            self.deliveries_in_progress -= 1
+
+    def record_attempt(self, delivery, destination, succeeded):
+        if succeeded:
+            delivery.status = WebhookDeliveryAttemptStatus.SUCCESS
+            delivery.succeeded_at = timezone.now()
+            delivery.next_attempt_at = None
+            self.deliveries_succeeded += 1
+        elif delivery.attempt_count < self.max_attempts:
+            # Stays pending until it's due to be retried
+            delivery.next_attempt_at = timezone.now() + timedelta(seconds=self.retry_delay(delivery.attempt_count, destination))
+        else:
+            delivery.status = WebhookDeliveryAttemptStatus.FAILURE
+            delivery.next_attempt_at = None
+            self.deliveries_failed += 1
+            logger.error(f"Webhook delivery failed after {delivery.attempt_count} attempts. " + f"Webhook ID: {delivery.id}, URL: {delivery.webhook_subscription.url}, " + f"Event: {delivery.webhook_trigger_type}, Status: {delivery.status}")
+        delivery.save()
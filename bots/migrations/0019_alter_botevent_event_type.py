@@ -0,0 +1,18 @@
+# Generated by Django 5.1.2 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bots', '0018_webhooksecret_webhooksubscription_and_more'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='botevent',
+            name='event_type',
+            field=models.IntegerField(choices=[(1, 'Bot Put in Waiting Room'), (2, 'Bot Joined Meeting'), (3, 'Bot Recording Permission Granted'), (4, 'Meeting Ended'), (5, 'Bot Left Meeting'), (6, 'Bot requested to join meeting'), (7, 'Bot Encountered Fatal error'), (8, 'Bot requested to leave meeting'), (9, 'Bot could not join meeting'), (10, 'Post Processing Completed'), (11, 'Bot recording degraded')]),
+        ),
+    ]
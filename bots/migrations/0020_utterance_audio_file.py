@@ -0,0 +1,19 @@
+# Generated by Django 5.1.2 on 2026-10-18 12:30
+
+import bots.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bots', '0019_alter_botevent_event_type'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='utterance',
+            name='audio_file',
+            field=models.FileField(blank=True, null=True, storage=bots.models.utterance_audio_storage, upload_to=''),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.2 on 2026-10-18 13:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bots', '0020_utterance_audio_file'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='utterance',
+            name='audio_format',
+            field=models.IntegerField(choices=[(1, 'PCM'), (2, 'MP3'), (3, 'FLAC'), (4, 'Ogg Opus')], default=1, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.2 on 2026-10-18 15:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bots', '0021_alter_utterance_audio_format'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='webhookdeliveryattempt',
+            name='webhook_trigger_type',
+            field=models.IntegerField(choices=[(1, 'Bot State Change'), (2, 'Transcript Update')], default=1),
+        ),
+    ]
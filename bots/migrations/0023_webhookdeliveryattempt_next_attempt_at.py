@@ -0,0 +1,22 @@
+# Generated by Django 5.1.2 on 2026-10-18 16:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bots', '0022_alter_webhookdeliveryattempt_webhook_trigger_type'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='webhookdeliveryattempt',
+            name='next_attempt_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='webhookdeliveryattempt',
+            index=models.Index(fields=['status', 'next_attempt_at'], name='webhook_attempt_pending_idx'),
+        ),
+    ]
@@ -1,4 +1,5 @@
 import hashlib
+import io
 import json
 import math
 import os
@@ -11,6 +12,7 @@ from concurrency.fields import IntegerVersionField
 from cryptography.fernet import Fernet, InvalidToken
 from django.conf import settings
 from django.core.exceptions import ValidationError
+from django.core.files.storage import FileSystemStorage
 from django.db import models, transaction
 from django.db.models import Q
 from django.db.utils import IntegrityError
@@ -18,7 +20,7 @@ from django.utils import timezone
 from django.utils.crypto import get_random_string
 
 from accounts.models import Organization
-from bots.webhook_utils import trigger_webhook
+from bots.webhook_utils import trigger_webhook, webhook_secret_cache, webhook_subscription_index
 
 # Create your models here.
 
@@ -118,6 +120,8 @@ class BotStates(models.IntegerChoices):
 class RecordingFormats(models.TextChoices):
     MP4 = "mp4"
     WEBM = "webm"
+    # Audio only, AAC in an MP4 container
+    M4A = "m4a"
 
 
 class RecordingViews(models.TextChoices):
@@ -125,6 +129,24 @@ class RecordingViews(models.TextChoices):
     GALLERY_VIEW = "gallery_view"
 
 
+class RecordingResolutions(models.TextChoices):
+    HD_720P = "720p"
+    FULL_HD_1080P = "1080p"
+
+
+# x264 speed presets, fastest first
+class RecordingEncoderPresets(models.TextChoices):
+    ULTRAFAST = "ultrafast"
+    SUPERFAST = "superfast"
+    VERYFAST = "veryfast"
+    FASTER = "faster"
+    FAST = "fast"
+    MEDIUM = "medium"
+    SLOW = "slow"
+    SLOWER = "slower"
+    VERYSLOW = "veryslow"
+
+
 class Bot(models.Model):
     OBJECT_ID_PREFIX = "bot_"
 
@@ -186,6 +208,11 @@ class Bot(models.Model):
     def deepgram_detect_language(self):
         return self.settings.get("transcription_settings", {}).get("deepgram", {}).get("detect_language", None)
 
+    def transcription_type(self):
+        if self.settings.get("transcription_settings", {}).get("deepgram", {}).get("realtime"):
+            return TranscriptionTypes.REALTIME
+        return TranscriptionTypes.NON_REALTIME
+
     def google_meet_closed_captions_language(self):
         return self.settings.get("transcription_settings", {}).get("meeting_closed_captions", {}).get("google_meet_language", None)
 
@@ -208,12 +235,30 @@ class Bot(models.Model):
             recording_settings = {}
         return recording_settings.get("format", RecordingFormats.WEBM)
 
+    def recording_type(self):
+        if self.recording_format() == RecordingFormats.M4A:
+            return RecordingTypes.AUDIO_ONLY
+        return RecordingTypes.AUDIO_AND_VIDEO
+
     def recording_view(self):
         recording_settings = self.settings.get("recording_settings", {})
         if recording_settings is None:
             recording_settings = {}
         return recording_settings.get("view", RecordingViews.SPEAKER_VIEW)
 
+    def recording_resolution(self):
+        recording_settings = self.settings.get("recording_settings", {})
+        if recording_settings is None:
+            recording_settings = {}
+        return recording_settings.get("resolution", RecordingResolutions.FULL_HD_1080P)
+
+    # Returns only the encoder settings that were specified, so the pipeline defaults apply to the rest
+    def recording_encoder_settings(self):
+        recording_settings = self.settings.get("recording_settings", {})
+        if recording_settings is None:
+            recording_settings = {}
+        return {key: recording_settings[key] for key in ["fps", "video_bitrate_kbps", "crf", "preset", "threads"] if key in recording_settings}
+
     def create_debug_recording(self):
         debug_settings = self.settings.get("debug_settings", {})
         if debug_settings is None:
@@ -324,6 +369,7 @@ class BotEventTypes(models.IntegerChoices):
     LEAVE_REQUESTED = 8, "Bot requested to leave meeting"
     COULD_NOT_JOIN = 9, "Bot could not join meeting"
     POST_PROCESSING_COMPLETED = 10, "Post Processing Completed"
+    RECORDING_DEGRADED = 11, "Bot recording degraded"
 
     @classmethod
     def type_to_api_code(cls, value):
@@ -339,6 +385,7 @@ class BotEventTypes(models.IntegerChoices):
             cls.LEAVE_REQUESTED: "leave_requested",
             cls.COULD_NOT_JOIN: "could_not_join_meeting",
             cls.POST_PROCESSING_COMPLETED: "post_processing_completed",
+            cls.RECORDING_DEGRADED: "recording_degraded",
         }
         return mapping.get(value)
 
@@ -511,6 +558,11 @@ class BotEventManager:
             "from": BotStates.POST_PROCESSING,
             "to": BotStates.ENDED,
         },
+        # A "to" of None means the event doesn't change the bot's state
+        BotEventTypes.RECORDING_DEGRADED: {
+            "from": [BotStates.JOINED_RECORDING, BotStates.JOINED_NOT_RECORDING],
+            "to": None,
+        },
     }
 
     @classmethod
@@ -603,11 +655,13 @@ class BotEventManager:
                         valid_states_labels = [BotStates.state_to_api_code(state) for state in valid_from_states]
                         raise ValidationError(f"Event {BotEventTypes.type_to_api_code(event_type)} not allowed when bot is in state {BotStates.state_to_api_code(old_state)}. It is only allowed in these states: {', '.join(valid_states_labels)}")
 
-                    # Update bot state based on 'to' definition
-                    new_state = transition["to"]
-                    bot.state = new_state
+                    # Update bot state based on 'to' definition. Events that don't change the state leave the bot, and its version, alone.
+                    changes_state = transition["to"] is not None
+                    new_state = transition["to"] if changes_state else old_state
+                    if changes_state:
+                        bot.state = new_state
 
-                    bot.save()  # This will raise RecordModifiedError if version mismatch
+                        bot.save()  # This will raise RecordModifiedError if version mismatch
 
                     # There's a chance that some other thread in the same process will modify the bot state to be something other than new_state. This should never happen, but we
                     # should raise an exception if it does.
@@ -625,7 +679,7 @@ class BotEventManager:
                     )
 
                     # If we moved to the recording state
-                    if new_state == BotStates.JOINED_RECORDING:
+                    if new_state == BotStates.JOINED_RECORDING and old_state != new_state:
                         pending_recordings = bot.recordings.filter(state=RecordingStates.NOT_STARTED)
                         if pending_recordings.count() != 1:
                             raise ValidationError(f"Expected exactly one pending recording for bot {bot.object_id} in state {BotStates.state_to_api_code(new_state)}, but found {pending_recordings.count()}")
@@ -651,18 +705,19 @@ class BotEventManager:
                                     description=f"For bot {bot.object_id}",
                                 )
 
-                    # Trigger webhook for this event
-                    trigger_webhook(
-                        webhook_trigger_type=WebhookTriggerTypes.BOT_STATE_CHANGE,
-                        bot=bot,
-                        payload={
-                            "event_type": BotEventTypes.type_to_api_code(event_type),
-                            "event_sub_type": BotEventSubTypes.sub_type_to_api_code(event_sub_type),
-                            "old_state": BotStates.state_to_api_code(old_state),
-                            "new_state": BotStates.state_to_api_code(bot.state),
-                            "created_at": event.created_at.isoformat(),
-                        },
-                    )
+                    # Bot state change webhooks are only sent when the state changed
+                    if changes_state:
+                        trigger_webhook(
+                            webhook_trigger_type=WebhookTriggerTypes.BOT_STATE_CHANGE,
+                            bot=bot,
+                            payload={
+                                "event_type": BotEventTypes.type_to_api_code(event_type),
+                                "event_sub_type": BotEventSubTypes.sub_type_to_api_code(event_sub_type),
+                                "old_state": BotStates.state_to_api_code(old_state),
+                                "new_state": BotStates.state_to_api_code(bot.state),
+                                "created_at": event.created_at.isoformat(),
+                            },
+                        )
 
                     return event
 
@@ -895,6 +950,16 @@ class RecordingManager:
         return state == RecordingStates.COMPLETE or state == RecordingStates.FAILED
 
 
+class UtteranceAudioStorage(S3Boto3Storage):
+    bucket_name = settings.AWS_RECORDING_STORAGE_BUCKET_NAME
+
+
+def utterance_audio_storage():
+    if settings.UTTERANCE_AUDIO_STORAGE == "local":
+        return FileSystemStorage(location=settings.UTTERANCE_AUDIO_LOCAL_DIRECTORY)
+    return UtteranceAudioStorage()
+
+
 class Utterance(models.Model):
     class Sources(models.IntegerChoices):
         PER_PARTICIPANT_AUDIO = 1, "Per Participant Audio"
@@ -903,10 +968,14 @@ class Utterance(models.Model):
     class AudioFormat(models.IntegerChoices):
         PCM = 1, "PCM"
         MP3 = 2, "MP3"
+        FLAC = 3, "FLAC"
+        OGG_OPUS = 4, "Ogg Opus"
 
     recording = models.ForeignKey(Recording, on_delete=models.CASCADE, related_name="utterances")
     participant = models.ForeignKey(Participant, on_delete=models.PROTECT, related_name="utterances")
     audio_blob = models.BinaryField()
+    # When UTTERANCE_AUDIO_STORAGE isn't "database", the audio is kept here instead of in audio_blob
+    audio_file = models.FileField(storage=utterance_audio_storage, null=True, blank=True)
     audio_format = models.IntegerField(choices=AudioFormat.choices, default=AudioFormat.PCM, null=True)
     timestamp_ms = models.BigIntegerField()
     duration_ms = models.IntegerField()
@@ -922,6 +991,18 @@ class Utterance(models.Model):
     def __str__(self):
         return f"Utterance at {self.timestamp_ms}ms ({self.duration_ms}ms long)"
 
+    def open_audio(self):
+        """Returns a file object for the utterance's audio, wherever it is stored"""
+        if self.audio_file:
+            return self.audio_file.open("rb")
+        return io.BytesIO(self.audio_blob)
+
+    def delete_audio(self):
+        """Deletes the utterance's audio once it's no longer needed. The caller is responsible for saving the utterance."""
+        if self.audio_file:
+            self.audio_file.delete(save=False)
+        self.audio_blob = b""
+
 
 class Credentials(models.Model):
     class CredentialTypes(models.IntegerChoices):
@@ -950,6 +1031,10 @@ class Credentials(models.Model):
         self._encrypted_data = f.encrypt(json_data.encode())
         self.save()
 
+        from bots.transcription_client_cache import deepgram_client_cache
+
+        deepgram_client_cache.invalidate(self.project_id)
+
     def get_credentials(self):
         """Decrypt and return credentials"""
         if not self._encrypted_data:
@@ -1206,16 +1291,24 @@ class WebhookSecret(models.Model):
             f = Fernet(settings.CREDENTIALS_ENCRYPTION_KEY)
             self._secret = f.encrypt(secret)
         super().save(*args, **kwargs)
+        webhook_secret_cache.invalidate(self.project_id)
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        webhook_secret_cache.invalidate(self.project_id)
+        return result
 
 
 class WebhookTriggerTypes(models.IntegerChoices):
     BOT_STATE_CHANGE = 1, "Bot State Change"
+    TRANSCRIPT_UPDATE = 2, "Transcript Update"
     # add other event types here
 
     @classmethod
     def trigger_type_to_api_code(cls, value):
         mapping = {
             cls.BOT_STATE_CHANGE: "bot.state_change",
+            cls.TRANSCRIPT_UPDATE: "transcript.update",
         }
         return mapping.get(value)
 
@@ -1235,6 +1328,12 @@ class WebhookSubscription(models.Model):
             random_string = "".join(random.choices(string.ascii_letters + string.digits, k=16))
             self.object_id = f"{self.OBJECT_ID_PREFIX}{random_string}"
         super().save(*args, **kwargs)
+        webhook_subscription_index.invalidate(self.project_id)
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        webhook_subscription_index.invalidate(self.project_id)
+        return result
 
     url = models.URLField()
     triggers = models.JSONField(default=default_triggers)
@@ -1260,9 +1359,14 @@ class WebhookDeliveryAttempt(models.Model):
     last_attempt_at = models.DateTimeField(null=True, blank=True)
     succeeded_at = models.DateTimeField(null=True, blank=True)
     response_body_list = models.JSONField(default=list)
+    # When run_webhook_dispatcher may next pick up the delivery attempt, either to retry it or because a dispatcher's claim on it has expired
+    next_attempt_at = models.DateTimeField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [models.Index(fields=["status", "next_attempt_at"], name="webhook_attempt_pending_idx")]
+
     def add_to_response_body_list(self, response_body):
         """Add content to the response body list without saving."""
         if self.response_body_list is None:
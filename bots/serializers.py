@@ -12,7 +12,9 @@ from .models import (
     BotEventTypes,
     BotStates,
     Recording,
+    RecordingEncoderPresets,
     RecordingFormats,
+    RecordingResolutions,
     RecordingStates,
     RecordingTranscriptionStates,
     RecordingViews,
@@ -35,6 +37,10 @@ from .utils import meeting_type_from_url
                         "type": "boolean",
                         "description": "Whether to automatically detect the spoken language",
                     },
+                    "realtime": {
+                        "type": "boolean",
+                        "description": "Whether to transcribe each participant's audio while they are speaking, instead of after the utterance ends. Interim and final results are sent to the transcript.update webhook as they arrive.",
+                    },
                 },
             },
             "meeting_closed_captions": {
@@ -80,12 +86,36 @@ class RTMPSettingsJSONField(serializers.JSONField):
         "properties": {
             "format": {
                 "type": "string",
-                "description": "The format of the recording to save. The supported formats are 'webm' and 'mp4'.",
+                "description": "The format of the recording to save. The supported formats are 'webm', 'mp4' and 'm4a'. 'm4a' records audio only.",
             },
             "view": {
                 "type": "string",
                 "description": "The view to use for the recording. The supported views are 'speaker_view' and 'gallery_view'.",
             },
+            "resolution": {
+                "type": "string",
+                "description": "The resolution of the recording. The supported resolutions are '720p' and '1080p'. Defaults to '1080p'. Not supported for Google Meet.",
+            },
+            "fps": {
+                "type": "integer",
+                "description": "The frame rate of the recording, between 1 and 30. Defaults to 30.",
+            },
+            "video_bitrate_kbps": {
+                "type": "integer",
+                "description": "The target video bitrate in kbps. Cannot be combined with 'crf'.",
+            },
+            "crf": {
+                "type": "integer",
+                "description": "Constant rate factor for the video encoder, between 0 and 51. Lower is higher quality. Cannot be combined with 'video_bitrate_kbps'.",
+            },
+            "preset": {
+                "type": "string",
+                "description": "The x264 preset to use, from 'ultrafast' to 'veryslow'. Slower presets compress better but use more CPU. Defaults to 'ultrafast'.",
+            },
+            "threads": {
+                "type": "integer",
+                "description": "The number of threads the video encoder can use. Defaults to 0, which picks the number automatically.",
+            },
         },
         "required": [],
     }
@@ -142,6 +172,7 @@ class CreateBotSerializer(serializers.Serializer):
                         "type": "string",
                     },
                     "detect_language": {"type": "boolean"},
+                    "realtime": {"type": "boolean"},
                 },
                 "oneOf": [
                     {"required": ["language"]},
@@ -212,7 +243,7 @@ class CreateBotSerializer(serializers.Serializer):
         return value
 
     recording_settings = RecordingSettingsJSONField(
-        help_text="The settings for the bot's recording. Either {'format': 'webm'} or {'format': 'mp4'}, with optional 'view': 'speaker_view' or 'gallery_view'.",
+        help_text="The settings for the bot's recording. Either {'format': 'webm'}, {'format': 'mp4'} or {'format': 'm4a'} for audio only, with optional 'view': 'speaker_view' or 'gallery_view'. The video encoder can be tuned with 'resolution', 'fps', 'video_bitrate_kbps' or 'crf', 'preset' and 'threads', e.g. {'format': 'mp4', 'resolution': '720p', 'fps': 15}.",
         required=False,
         default={"format": RecordingFormats.WEBM, "view": RecordingViews.SPEAKER_VIEW},
     )
@@ -222,6 +253,12 @@ class CreateBotSerializer(serializers.Serializer):
         "properties": {
             "format": {"type": "string"},
             "view": {"type": "string"},
+            "resolution": {"type": "string"},
+            "fps": {"type": "integer", "minimum": 1, "maximum": 30},
+            "video_bitrate_kbps": {"type": "integer", "minimum": 100, "maximum": 20000},
+            "crf": {"type": "integer", "minimum": 0, "maximum": 51},
+            "preset": {"type": "string"},
+            "threads": {"type": "integer", "minimum": 0, "maximum": 16},
         },
         "required": [],
     }
@@ -237,14 +274,27 @@ class CreateBotSerializer(serializers.Serializer):
 
         # Validate format if provided
         format = value.get("format")
-        if format not in [RecordingFormats.MP4, RecordingFormats.WEBM, None]:
-            raise serializers.ValidationError({"format": "Format must be mp4 or webm"})
+        if format not in [RecordingFormats.MP4, RecordingFormats.WEBM, RecordingFormats.M4A, None]:
+            raise serializers.ValidationError({"format": "Format must be mp4, webm or m4a"})
 
         # Validate view if provided
         view = value.get("view")
         if view not in [RecordingViews.SPEAKER_VIEW, RecordingViews.GALLERY_VIEW, None]:
             raise serializers.ValidationError({"view": "View must be speaker_view or gallery_view"})
 
+        # Validate resolution if provided
+        resolution = value.get("resolution")
+        if resolution not in [RecordingResolutions.HD_720P, RecordingResolutions.FULL_HD_1080P, None]:
+            raise serializers.ValidationError({"resolution": "Resolution must be 720p or 1080p"})
+
+        # Validate preset if provided
+        preset = value.get("preset")
+        if preset not in [*RecordingEncoderPresets.values, None]:
+            raise serializers.ValidationError({"preset": f"Preset must be one of {', '.join(RecordingEncoderPresets.values)}"})
+
+        if "video_bitrate_kbps" in value and "crf" in value:
+            raise serializers.ValidationError({"crf": "crf cannot be combined with video_bitrate_kbps"})
+
         return value
 
     debug_settings = DebugSettingsJSONField(
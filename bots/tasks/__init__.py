@@ -1,10 +1,11 @@
 from .deliver_webhook_task import deliver_webhook
-from .process_utterance_task import process_utterance
+from .process_utterance_task import process_utterance, process_utterances
 from .run_bot_task import run_bot
 
 # Expose the tasks and any necessary utilities at the module level
 __all__ = [
     "process_utterance",
+    "process_utterances",
     "run_bot",
     "deliver_webhook",
 ]
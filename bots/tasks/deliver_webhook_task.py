@@ -1,11 +1,14 @@
 import logging
+import time
 
 import requests
 from celery import shared_task
 from django.utils import timezone
 
-from bots.models import WebhookDeliveryAttempt, WebhookDeliveryAttemptStatus, WebhookTriggerTypes
-from bots.webhook_utils import sign_payload
+from bots.models import WebhookDeliveryAttempt, WebhookDeliveryAttemptStatus
+from bots.webhook_circuit_breaker import is_healthy_response, webhook_circuit_breaker, webhook_destination
+from bots.webhook_sessions import webhook_session_pool
+from bots.webhook_utils import get_webhook_request
 
 logger = logging.getLogger(__name__)
 
@@ -40,34 +43,30 @@ def deliver_webhook(self, delivery_id):
         delivery.save()
         return
 
-    # Prepare the webhook payload
-    webhook_data = {
-        "idempotency_key": str(delivery.idempotency_key),
-        "bot_id": delivery.bot.object_id if delivery.bot else None,
-        "trigger": WebhookTriggerTypes.trigger_type_to_api_code(delivery.webhook_trigger_type),
-        "data": delivery.payload,
-    }
+    # Don't send to a destination whose circuit is open, try again once it may have recovered. This isn't counted as an attempt.
+    destination = webhook_destination(subscription.url)
+    allowed, probe_id = webhook_circuit_breaker.allow_request(destination)
+    if not allowed:
+        deliver_webhook.apply_async(args=[delivery_id], countdown=max(1, webhook_circuit_breaker.seconds_until_retry(destination)))
+        return
 
-    # Sign the payload
-    active_secret = subscription.project.webhook_secrets.filter().order_by("-created_at").first()
-    signature = sign_payload(webhook_data, active_secret.get_secret())
+    # Prepare and sign the webhook payload
+    body, headers = get_webhook_request(delivery)
 
     # Increment attempt counter
     delivery.attempt_count += 1
     delivery.last_attempt_at = timezone.now()
 
     # Send the webhook
+    request_started_at = time.monotonic()
     try:
-        response = requests.post(
+        response = webhook_session_pool.post(
             subscription.url,
-            json=webhook_data,
-            headers={
-                "Content-Type": "application/json",
-                "User-Agent": "Attendee-Webhook/1.0",
-                "X-Webhook-Signature": signature,
-            },
+            data=body,
+            headers=headers,
             timeout=10,  # 10-second timeout
         )
+        webhook_circuit_breaker.record_result(destination, is_healthy_response(response.status_code), time.monotonic() - request_started_at, probe_id)
 
         # Update the delivery attempt with the response
         delivery.response_status_code = response.status_code
@@ -88,6 +87,7 @@ def deliver_webhook(self, delivery_id):
 
     except requests.RequestException as e:
         # Handle network errors, timeouts, etc.
+        webhook_circuit_breaker.record_result(destination, False, time.monotonic() - request_started_at, probe_id)
         delivery.status = WebhookDeliveryAttemptStatus.FAILURE
         error_response = {
             "status_code": None,  # No HTTP status since request failed
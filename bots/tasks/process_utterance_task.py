@@ -1,11 +1,16 @@
+import json
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 from celery import shared_task
+from django.conf import settings
 from django.db import DatabaseError
 
 logger = logging.getLogger(__name__)
 
-from bots.models import Credentials, RecordingManager, Utterance
+from bots.models import Recording, RecordingManager, Utterance
+from bots.transcription_client_cache import deepgram_client_cache
+from bots.transcription_results_cache import hash_audio_file, transcription_results_cache
 
 
 @shared_task(
@@ -16,57 +21,129 @@ from bots.models import Credentials, RecordingManager, Utterance
     max_retries=5,
 )
 def process_utterance(self, utterance_id):
-    import json
+    # Utterances are enqueued with process_utterances now, this handles any that were enqueued one at a time
+    utterance = Utterance.objects.select_related("recording__bot").get(id=utterance_id)
+    transcribe_utterances(utterance.recording, [utterance])
 
+
+@shared_task(
+    bind=True,
+    soft_time_limit=3600,
+    autoretry_for=(DatabaseError,),
+    retry_backoff=True,  # Enable exponential backoff
+    max_retries=5,
+)
+def process_utterances(self, recording_id, utterance_ids):
+    recording = Recording.objects.select_related("bot").get(id=recording_id)
+    utterances = list(Utterance.objects.filter(recording=recording, id__in=utterance_ids).order_by("id"))
+    transcribe_utterances(recording, utterances)
+
+
+def transcribe_utterances(recording, utterances):
+    """
+    Transcribes a batch of utterances from the same recording, up to settings.TRANSCRIPTION_MAX_CONCURRENCY
+    at a time, and updates the recording's transcription state once for the whole batch.
+    """
     from deepgram import (
-        DeepgramClient,
-        FileSource,
         PrerecordedOptions,
+        StreamSource,
     )
 
-    utterance = Utterance.objects.get(id=utterance_id)
-    logger.info(f"Processing utterance {utterance_id}")
+    logger.info(f"Processing {len(utterances)} utterances for recording {recording.id}")
 
-    recording = utterance.recording
     RecordingManager.set_recording_transcription_in_progress(recording)
 
-    if utterance.transcription is None:
-        payload: FileSource = {
-            "buffer": utterance.audio_blob.tobytes(),
-        }
-
-        # nova-3 does not have multilingual support yet, so we need to use nova-2 if we're transcribing with a non-default language
-        if (recording.bot.deepgram_language() != "en" and recording.bot.deepgram_language()) or recording.bot.deepgram_detect_language():
-            deepgram_model = "nova-2"
-        else:
-            deepgram_model = "nova-3"
-
-        options = PrerecordedOptions(
-            model=deepgram_model,
-            smart_format=True,
-            language=recording.bot.deepgram_language(),
-            detect_language=recording.bot.deepgram_detect_language(),
-            encoding="linear16",  # for 16-bit PCM
-            sample_rate=utterance.sample_rate,
-        )
-
-        deepgram_credentials_record = recording.bot.project.credentials.filter(credential_type=Credentials.CredentialTypes.DEEPGRAM).first()
-        if not deepgram_credentials_record:
-            raise Exception("Deepgram credentials record not found")
-
-        deepgram_credentials = deepgram_credentials_record.get_credentials()
-        if not deepgram_credentials:
-            raise Exception("Deepgram credentials not found")
-
-        deepgram = DeepgramClient(deepgram_credentials["api_key"])
-
-        response = deepgram.listen.rest.v("1").transcribe_file(payload, options)
-        utterance.transcription = json.loads(response.results.channels[0].alternatives[0].to_json())
-        utterance.audio_blob = b""  # set the binary field to empty byte string
-        utterance.save()
-
-        logger.info(f"Transcription complete for utterance {utterance_id} with model {deepgram_model}")
+    utterances_to_transcribe = [utterance for utterance in utterances if utterance.transcription is None]
+    if utterances_to_transcribe:
+        deepgram_options = get_deepgram_options(recording.bot)
+        deepgram = deepgram_client_cache.get_client(recording.bot.project_id)
+
+        def transcribe(utterance):
+            options = {**deepgram_options, **get_deepgram_encoding_options(utterance)}
+
+            # Stream the audio from wherever it's stored rather than loading it into memory first
+            audio_file = utterance.open_audio()
+            payload: StreamSource = {
+                "stream": audio_file,
+            }
+            try:
+                cache_key = transcription_results_cache.key(hash_audio_file(audio_file), options)
+                cached_transcription = transcription_results_cache.get(cache_key)
+                if cached_transcription is not None:
+                    logger.info(f"Using cached transcription for utterance {utterance.id}")
+                    return cached_transcription
+                response = deepgram.listen.rest.v("1").transcribe_file(payload, PrerecordedOptions(**options))
+            finally:
+                audio_file.close()
+
+            transcription = json.loads(response.results.channels[0].alternatives[0].to_json())
+            transcription_results_cache.set(cache_key, transcription)
+            return transcription
+
+        # The threads only talk to Deepgram and the audio storage, all database access stays on this thread
+        with ThreadPoolExecutor(max_workers=min(settings.TRANSCRIPTION_MAX_CONCURRENCY, len(utterances_to_transcribe))) as executor:
+            futures = [(utterance, executor.submit(transcribe, utterance)) for utterance in utterances_to_transcribe]
+
+        transcribed_utterances = []
+        failed_utterance_ids = []
+        for utterance, future in futures:
+            try:
+                utterance.transcription = future.result()
+            except Exception as e:
+                logger.exception(f"Error transcribing utterance {utterance.id}: {e}")
+                failed_utterance_ids.append(utterance.id)
+                continue
+            transcribed_utterances.append(utterance)
+
+        save_transcriptions(transcribed_utterances)
+        logger.info(f"Transcription complete for {len(transcribed_utterances)} utterances for recording {recording.id} with model {deepgram_options['model']}")
+
+        if failed_utterance_ids:
+            raise Exception(f"Failed to transcribe utterances {failed_utterance_ids} for recording {recording.id}")
+
+    set_recording_transcription_complete_if_done(recording)
+
+
+def get_deepgram_options(bot):
+    """The options every utterance of the bot's recordings is transcribed with, as keyword arguments for PrerecordedOptions"""
+    deepgram_language = bot.deepgram_language()
+    deepgram_detect_language = bot.deepgram_detect_language()
+
+    # nova-3 does not have multilingual support yet, so we need to use nova-2 if we're transcribing with a non-default language
+    if (deepgram_language != "en" and deepgram_language) or deepgram_detect_language:
+        deepgram_model = "nova-2"
+    else:
+        deepgram_model = "nova-3"
+
+    return {
+        "model": deepgram_model,
+        "smart_format": True,
+        "language": deepgram_language,
+        "detect_language": deepgram_detect_language,
+    }
+
+
+def get_deepgram_encoding_options(utterance):
+    if utterance.audio_format in [Utterance.AudioFormat.PCM, None]:
+        return {"encoding": "linear16", "sample_rate": utterance.sample_rate}  # for 16-bit PCM
+    # FLAC and Ogg Opus carry their encoding and sample rate in the container, which Deepgram reads itself
+    return {}
+
+
+def save_transcriptions(transcribed_utterances):
+    """Saves the transcriptions of a batch of utterances in one query and then deletes their audio, which isn't needed anymore"""
+    Utterance.objects.bulk_update(transcribed_utterances, ["transcription"])
+
+    # Only now that the transcriptions are saved, so if saving them fails the retry can still read the audio
+    for utterance in transcribed_utterances:
+        utterance.delete_audio()
+    Utterance.objects.bulk_update(transcribed_utterances, ["audio_blob", "audio_file"])
+
+
+def set_recording_transcription_complete_if_done(recording):
+    # The recording may have ended while the batch was being transcribed
+    recording.refresh_from_db(fields=["state"])
 
     # If the recording is in a terminal state and there are no more utterances to transcribe, set the recording's transcription state to complete
-    if RecordingManager.is_terminal_state(utterance.recording.state) and Utterance.objects.filter(recording=utterance.recording, transcription__isnull=True).count() == 0:
-        RecordingManager.set_recording_transcription_complete(utterance.recording)
+    if RecordingManager.is_terminal_state(recording.state) and not Utterance.objects.filter(recording=recording, transcription__isnull=True).exists():
+        RecordingManager.set_recording_transcription_complete(recording)
@@ -631,7 +631,9 @@ class WebSocketClient {
   
     enableMediaSending() {
       this.mediaSendingEnabled = true;
-      this.startBlackFrameTimer();
+      // Audio only recordings don't need filler frames
+      if (window.initialData.sendVideo)
+        this.startBlackFrameTimer();
     }
   
     disableMediaSending() {
@@ -733,7 +735,7 @@ class WebSocketClient {
             return;
         }
   
-        if (!this.mediaSendingEnabled) {
+        if (!this.mediaSendingEnabled || !window.initialData.sendVideo) {
           return;
         }
         
@@ -1156,7 +1158,8 @@ const handleVideoTrack = async (event) => {
                  // if (Math.random() < 0.02)
                    //realConsole?.log('firstStreamId', firstStreamId, 'streamIdToSend', virtualStreamToPhysicalStreamMappingManager.getVideoStreamIdToSend());
                   
-                  if (firstStreamId && firstStreamId === virtualStreamToPhysicalStreamMappingManager.getVideoStreamIdToSend()) {
+                  // Skip copying the frame out entirely for audio only recordings
+                  if (window.initialData.sendVideo && firstStreamId && firstStreamId === virtualStreamToPhysicalStreamMappingManager.getVideoStreamIdToSend()) {
                       // Check if enough time has passed since the last frame
                       if (currentTime - lastFrameTime >= frameInterval) {
                           // Copy the frame to get access to raw data
@@ -0,0 +1,175 @@
+import gi
+
+gi.require_version("GLib", "2.0")
+gi.require_version("Gst", "1.0")
+import threading
+import time
+
+from django.test import SimpleTestCase
+from gi.repository import GLib, Gst
+
+from bots.bot_controller.encoder_profile import EncoderProfile
+from bots.bot_controller.gstreamer_pipeline import GstreamerPipeline
+from bots.bot_controller.pipeline_configuration import PipelineConfiguration
+
+
+def create_black_i420_frame(width, height):
+    return b"\x00" * (width * height) + b"\x80" * (width * height // 2)
+
+
+class TestGstreamerPipeline(SimpleTestCase):
+    def test_rtmp_streaming_bot_with_native_sink_is_valid_configuration(self):
+        pipeline_configuration = PipelineConfiguration.rtmp_streaming_bot(native_sink=True)
+        self.assertTrue(pipeline_configuration.rtmp_native_sink)
+        self.assertFalse(PipelineConfiguration.rtmp_streaming_bot().rtmp_native_sink)
+
+        # The native sink only makes sense when streaming
+        with self.assertRaises(ValueError):
+            PipelineConfiguration(
+                record_video=True,
+                record_audio=True,
+                transcribe_audio=True,
+                rtmp_stream_audio=False,
+                rtmp_stream_video=False,
+                rtmp_native_sink=True,
+            )
+
+    def test_rtmp_sink_reports_connection_failure(self):
+        main_loop = GLib.MainLoop()
+        connection_failed_calls = []
+
+        def on_rtmp_connection_failed():
+            connection_failed_calls.append(True)
+            main_loop.quit()
+
+        # Nothing is listening on port 1, so the connection will be refused
+        pipeline = GstreamerPipeline(
+            on_new_sample_callback=None,
+            encoder_profile=EncoderProfile(video_frame_size=(640, 360)),
+            audio_format=GstreamerPipeline.AUDIO_FORMAT_PCM,
+            output_format=GstreamerPipeline.OUTPUT_FORMAT_FLV,
+            num_audio_sources=1,
+            sink_type=GstreamerPipeline.SINK_TYPE_RTMP,
+            rtmp_location="rtmp://127.0.0.1:1/live/test-stream-key",
+            on_rtmp_connection_failed_callback=on_rtmp_connection_failed,
+        )
+        pipeline.setup()
+
+        frame = create_black_i420_frame(640, 360)
+        for _ in range(10):
+            pipeline.on_new_video_frame(frame, time.time_ns())
+            pipeline.on_mixed_audio_raw_data_received_callback(b"\x00" * 640, time.time_ns())
+
+        # Give up after 10 seconds
+        GLib.timeout_add_seconds(10, main_loop.quit)
+        main_loop.run()
+
+        self.assertEqual(len(connection_failed_calls), 1)
+        self.assertTrue(pipeline.rtmp_connection_failed)
+
+        pipeline.cleanup()
+        _, current_state, _ = pipeline.pipeline.get_state(0)
+        self.assertEqual(current_state, Gst.State.NULL)
+
+    def test_encoder_profile_builds_encoder_strings(self):
+        self.assertEqual(EncoderProfile().video_encoder_string(), "x264enc tune=zerolatency speed-preset=ultrafast")
+        self.assertEqual(EncoderProfile().audio_encoder_string(), "voaacenc bitrate=128000")
+        self.assertEqual(
+            EncoderProfile(crf=28, preset="veryfast", threads=2).video_encoder_string(),
+            "x264enc tune=zerolatency speed-preset=veryfast threads=2 pass=qual quantizer=28",
+        )
+        self.assertEqual(EncoderProfile(video_bitrate_kbps=1500).video_encoder_string(), "x264enc tune=zerolatency speed-preset=ultrafast bitrate=1500")
+
+        with self.assertRaises(ValueError):
+            EncoderProfile(video_bitrate_kbps=1500, crf=28)
+        with self.assertRaises(ValueError):
+            EncoderProfile(preset="warpspeed")
+
+    def test_encoder_profile_bounds_queues_by_time(self):
+        profile = EncoderProfile(video_frame_size=(1280, 720), fps=30, video_queue_max_ms=500, audio_queue_max_ms=4000)
+        self.assertEqual(profile.raw_video_queue_limits_string(), "leaky=downstream max-size-buffers=15 max-size-bytes=20736000 max-size-time=500000000")
+        self.assertEqual(profile.encoded_video_queue_limits_string(), "max-size-buffers=0 max-size-bytes=0 max-size-time=4000000000")
+        self.assertEqual(profile.audio_queue_limits_string(), "leaky=downstream max-size-buffers=0 max-size-bytes=4000000 max-size-time=4000000000")
+
+    def test_m4a_pipeline_has_no_video_branch(self):
+        pipeline = GstreamerPipeline(
+            on_new_sample_callback=None,
+            audio_format=GstreamerPipeline.AUDIO_FORMAT_PCM,
+            output_format=GstreamerPipeline.OUTPUT_FORMAT_M4A,
+            num_audio_sources=1,
+            sink_type=GstreamerPipeline.SINK_TYPE_FILE,
+            file_location="/tmp/test_m4a_pipeline_has_no_video_branch.m4a",
+        )
+        pipeline.setup()
+
+        self.assertIsNone(pipeline.appsrc)
+        self.assertFalse(pipeline.wants_any_video_frames())
+        element_factory_names = set()
+        iterator = pipeline.pipeline.iterate_elements()
+        while True:
+            result, element = iterator.next()
+            if result != Gst.IteratorResult.OK:
+                break
+            element_factory_names.add(element.get_factory().get_name())
+        self.assertNotIn("x264enc", element_factory_names)
+        self.assertNotIn("videoconvert", element_factory_names)
+
+        pipeline.on_mixed_audio_raw_data_received_callback(b"\x00" * 640, time.time_ns())
+        pipeline.cleanup()
+
+    def test_reports_pipeline_metrics(self):
+        pipeline = GstreamerPipeline(
+            on_new_sample_callback=None,
+            encoder_profile=EncoderProfile(video_frame_size=(640, 360)),
+            audio_format=GstreamerPipeline.AUDIO_FORMAT_PCM,
+            output_format=GstreamerPipeline.OUTPUT_FORMAT_MP4,
+            num_audio_sources=1,
+            sink_type=GstreamerPipeline.SINK_TYPE_FILE,
+            file_location="/tmp/test_reports_pipeline_metrics.mp4",
+        )
+        pipeline.setup()
+
+        frame = create_black_i420_frame(640, 360)
+        start_time_ns = time.time_ns()
+        for i in range(10):
+            pipeline.on_new_video_frame(frame, start_time_ns + i * 100_000_000)
+            pipeline.on_mixed_audio_raw_data_received_callback(b"\x00" * 6400, start_time_ns + i * 100_000_000)
+
+        metrics = pipeline.get_metrics()
+        self.assertEqual(metrics["video_buffers_pushed"], 10)
+        self.assertEqual(metrics["audio_buffers_pushed"], 10)
+        self.assertEqual(metrics["video_push_failures"], 0)
+        self.assertEqual(metrics["av_drift_ms"], 0)
+        self.assertIn("q1", metrics["queues"])
+        self.assertEqual(set(metrics["queues"]["q1"]), {"level_buffers", "level_bytes", "level_time_ms", "overruns"})
+
+        pipeline.cleanup()
+
+        # EOS flushes the frames through the encoder
+        self.assertGreater(pipeline.get_metrics()["encoder_latency"]["count"], 0)
+
+    def test_audio_and_video_threads_share_one_start_time(self):
+        pipeline = GstreamerPipeline(
+            on_new_sample_callback=None,
+            audio_format=GstreamerPipeline.AUDIO_FORMAT_PCM,
+            output_format=GstreamerPipeline.OUTPUT_FORMAT_MP4,
+            num_audio_sources=1,
+            sink_type=GstreamerPipeline.SINK_TYPE_FILE,
+            file_location="/tmp/test_audio_and_video_threads_share_one_start_time.mp4",
+        )
+        barrier = threading.Barrier(8)
+        buffer_pts = {}
+
+        def push_buffer(current_time_ns):
+            barrier.wait()
+            buffer_pts[current_time_ns] = pipeline.get_buffer_pts(current_time_ns)
+
+        threads = [threading.Thread(target=push_buffer, args=(1_000_000_000 + i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Whichever thread came first set the start time, and every timestamp is relative to it
+        self.assertIn(pipeline.start_time_ns, buffer_pts)
+        self.assertEqual(buffer_pts, {current_time_ns: current_time_ns - pipeline.start_time_ns for current_time_ns in buffer_pts})
@@ -0,0 +1,42 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+from django.test import SimpleTestCase
+
+from bots.bot_controller.individual_audio_input_manager import IndividualAudioInputManager, calculate_normalized_rms, calculate_normalized_rms_batch
+
+
+class TestIndividualAudioInputManager(SimpleTestCase):
+    def test_batch_rms_matches_rms(self):
+        rng = np.random.default_rng(0)
+        chunks = [rng.normal(0, amplitude, num_samples).clip(-32768, 32767).astype(np.int16).tobytes() for amplitude, num_samples in [(10, 320), (5000, 640), (32767, 960)]]
+
+        np.testing.assert_allclose(calculate_normalized_rms_batch(chunks), [calculate_normalized_rms(chunk) for chunk in chunks], rtol=1e-5)
+
+    def test_batch_silence_detection_matches_silence_detection(self):
+        manager = IndividualAudioInputManager(save_utterance_callback=None, get_participant_callback=None)
+        rng = np.random.default_rng(0)
+        chunks = [rng.normal(0, amplitude, 640).clip(-32768, 32767).astype(np.int16).tobytes() for amplitude in [50, 3000, 20000]]
+
+        self.assertEqual(manager.silence_detected_batch(chunks + [None]), [manager.silence_detected(chunk) for chunk in chunks] + [True])
+
+    def test_utterance_buffers_are_reused(self):
+        saved_utterances = []
+
+        def save_utterance(utterance):
+            saved_utterances.append(bytes(utterance["audio_data"]))
+            utterance["release_audio_data"]()
+
+        manager = IndividualAudioInputManager(save_utterance_callback=save_utterance, get_participant_callback=lambda speaker_id: {"participant_uuid": speaker_id})
+        loud_chunk = np.random.default_rng(0).normal(0, 3000, 640).clip(-32768, 32767).astype(np.int16).tobytes()
+
+        start_time = datetime(2025, 1, 1)
+        for utterance_index in range(3):
+            utterance_start_time = start_time + timedelta(seconds=10 * utterance_index)
+            manager.process_chunk("speaker", utterance_start_time, loud_chunk, audio_is_silent=False)
+            manager.process_chunk("speaker", utterance_start_time + timedelta(milliseconds=20), loud_chunk, audio_is_silent=False)
+            manager.process_chunk("speaker", utterance_start_time + timedelta(seconds=5), None)
+
+        self.assertEqual(saved_utterances, [loud_chunk * 2] * 3)
+        self.assertEqual(manager.arena.blocks_allocated, 1)
+        self.assertEqual(manager.arena.blocks_reused, 2)
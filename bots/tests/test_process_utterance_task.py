@@ -0,0 +1,157 @@
+import json
+import tempfile
+from unittest.mock import MagicMock, patch
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.db import DatabaseError
+from django.db.models.query import QuerySet
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+
+from bots.models import (
+    Bot,
+    BotStates,
+    Organization,
+    Participant,
+    Project,
+    Recording,
+    RecordingManager,
+    RecordingStates,
+    RecordingTranscriptionStates,
+    RecordingTypes,
+    TranscriptionTypes,
+    Utterance,
+)
+from bots.tasks.process_utterance_task import get_deepgram_encoding_options, transcribe_utterances
+
+
+def create_mock_deepgram():
+    mock_deepgram = MagicMock()
+    mock_response = MagicMock()
+    mock_response.results.channels[0].alternatives[0].to_json.return_value = json.dumps({"transcript": "This is a test transcript", "confidence": 0.95, "words": []})
+    mock_deepgram.listen.rest.v.return_value.transcribe_file.return_value = mock_response
+    return mock_deepgram
+
+
+@override_settings(TRANSCRIPTION_RESULTS_CACHE_TTL_SECONDS=0)
+class TranscribeUtterancesTest(TransactionTestCase):
+    def setUp(self):
+        self.organization = Organization.objects.create(name="Test Org")
+        self.project = Project.objects.create(name="Test Project", organization=self.organization)
+        self.bot = Bot.objects.create(project=self.project, meeting_url="https://zoom.us/j/123", state=BotStates.ENDED)
+        self.recording = Recording.objects.create(
+            bot=self.bot,
+            recording_type=RecordingTypes.AUDIO_ONLY,
+            transcription_type=TranscriptionTypes.NON_REALTIME,
+            is_default_recording=True,
+            state=RecordingStates.COMPLETE,
+        )
+        self.participant = Participant.objects.create(bot=self.bot, uuid="participant_1", full_name="Test User")
+
+        # Keep the utterances' audio in a temporary directory instead of object storage
+        self.audio_directory = tempfile.TemporaryDirectory()
+        storage_patcher = patch.object(Utterance._meta.get_field("audio_file"), "storage", FileSystemStorage(location=self.audio_directory.name))
+        storage_patcher.start()
+        self.addCleanup(storage_patcher.stop)
+        self.addCleanup(self.audio_directory.cleanup)
+
+        self.mock_deepgram = create_mock_deepgram()
+        client_patcher = patch("bots.tasks.process_utterance_task.deepgram_client_cache.get_client", return_value=self.mock_deepgram)
+        client_patcher.start()
+        self.addCleanup(client_patcher.stop)
+
+    def create_utterance(self, timestamp_ms, audio_byte=b"\x01"):
+        utterance = Utterance(recording=self.recording, participant=self.participant, timestamp_ms=timestamp_ms, duration_ms=1000, sample_rate=32000, audio_blob=b"")
+        utterance.audio_file.save(f"{timestamp_ms}.pcm", ContentFile(audio_byte * 64000), save=False)
+        utterance.save()
+        return utterance
+
+    def test_audio_is_kept_until_the_transcriptions_are_saved(self):
+        utterances = [self.create_utterance(0), self.create_utterance(1000)]
+        audio_file_names = [utterance.audio_file.name for utterance in utterances]
+
+        real_bulk_update = QuerySet.bulk_update
+        bulk_update_calls = []
+
+        def bulk_update_failing_once(queryset, *args, **kwargs):
+            bulk_update_calls.append(args)
+            if len(bulk_update_calls) == 1:
+                raise DatabaseError("connection lost")
+            return real_bulk_update(queryset, *args, **kwargs)
+
+        with patch.object(QuerySet, "bulk_update", autospec=True, side_effect=bulk_update_failing_once):
+            with self.assertRaises(DatabaseError):
+                transcribe_utterances(self.recording, utterances)
+
+        # Nothing was saved and the audio is still there for the retry
+        storage = Utterance._meta.get_field("audio_file").storage
+        self.assertTrue(all(storage.exists(name) for name in audio_file_names))
+        self.assertFalse(Utterance.objects.filter(transcription__isnull=False).exists())
+
+        # The retry loads the utterances again, like the task does
+        transcribe_utterances(self.recording, list(Utterance.objects.filter(recording=self.recording).order_by("id")))
+
+        for utterance in Utterance.objects.filter(recording=self.recording):
+            self.assertEqual(utterance.transcription["transcript"], "This is a test transcript")
+            self.assertFalse(utterance.audio_file)
+        self.assertFalse(any(storage.exists(name) for name in audio_file_names))
+        self.recording.refresh_from_db()
+        self.assertEqual(self.recording.transcription_state, RecordingTranscriptionStates.COMPLETE)
+
+    def test_batch_updates_the_recording_state_once(self):
+        utterances = [self.create_utterance(1000 * i) for i in range(3)]
+
+        with (
+            patch.object(RecordingManager, "set_recording_transcription_in_progress", wraps=RecordingManager.set_recording_transcription_in_progress) as mock_set_in_progress,
+            patch.object(RecordingManager, "set_recording_transcription_complete", wraps=RecordingManager.set_recording_transcription_complete) as mock_set_complete,
+        ):
+            transcribe_utterances(self.recording, utterances)
+
+        mock_set_in_progress.assert_called_once()
+        mock_set_complete.assert_called_once()
+        self.assertEqual(self.mock_deepgram.listen.rest.v.return_value.transcribe_file.call_count, 3)
+        self.assertFalse(Utterance.objects.filter(recording=self.recording, transcription__isnull=True).exists())
+
+    def test_successful_transcriptions_are_saved_when_others_in_the_batch_fail(self):
+        utterances = [self.create_utterance(0, b"\x01"), self.create_utterance(1000, b"\x02"), self.create_utterance(2000, b"\x03")]
+        transcribe_file = self.mock_deepgram.listen.rest.v.return_value.transcribe_file
+        successful_response = transcribe_file.return_value
+
+        def transcribe_file_failing_for_the_second_utterance(payload, options):
+            if payload["stream"].read(1) == b"\x02":
+                raise Exception("Deepgram is unavailable")
+            return successful_response
+
+        transcribe_file.side_effect = transcribe_file_failing_for_the_second_utterance
+        with self.assertRaisesMessage(Exception, f"Failed to transcribe utterances [{utterances[1].id}]"):
+            transcribe_utterances(self.recording, utterances)
+
+        saved_utterances = {utterance.id: utterance for utterance in Utterance.objects.filter(recording=self.recording)}
+        for utterance in [utterances[0], utterances[2]]:
+            self.assertEqual(saved_utterances[utterance.id].transcription["transcript"], "This is a test transcript")
+            self.assertFalse(saved_utterances[utterance.id].audio_file)
+        # The failed utterance keeps its audio for the retry, so the recording isn't done yet
+        self.assertIsNone(saved_utterances[utterances[1].id].transcription)
+        self.assertTrue(saved_utterances[utterances[1].id].audio_file)
+        self.recording.refresh_from_db()
+        self.assertEqual(self.recording.transcription_state, RecordingTranscriptionStates.IN_PROGRESS)
+
+        # The retry only sends the utterance that failed
+        transcribe_file.side_effect = None
+        transcribe_file.reset_mock()
+        transcribe_utterances(self.recording, list(Utterance.objects.filter(recording=self.recording).order_by("id")))
+        self.assertEqual(transcribe_file.call_count, 1)
+        self.recording.refresh_from_db()
+        self.assertEqual(self.recording.transcription_state, RecordingTranscriptionStates.COMPLETE)
+
+
+class GetDeepgramEncodingOptionsTest(SimpleTestCase):
+    def test_raw_pcm_needs_its_encoding_and_sample_rate(self):
+        for audio_format in [Utterance.AudioFormat.PCM, None]:
+            utterance = Utterance(audio_format=audio_format, sample_rate=32000)
+            self.assertEqual(get_deepgram_encoding_options(utterance), {"encoding": "linear16", "sample_rate": 32000})
+
+    def test_containers_are_left_to_deepgram(self):
+        for audio_format in [Utterance.AudioFormat.FLAC, Utterance.AudioFormat.OGG_OPUS]:
+            utterance = Utterance(audio_format=audio_format, sample_rate=32000)
+            self.assertEqual(get_deepgram_encoding_options(utterance), {})
@@ -0,0 +1,94 @@
+import json
+import threading
+from datetime import datetime, timedelta, timezone
+from urllib.parse import parse_qs, urlparse
+
+from django.test import SimpleTestCase
+from websockets.sync.server import serve
+
+from bots.bot_controller.realtime_transcriber import RealtimeTranscriber
+
+
+class MockDeepgramStreamingServer:
+    """Answers like Deepgram's streaming API: an interim result for the first chunk of each segment and a final result when it's finalized or the stream is closed"""
+
+    def __init__(self):
+        self.requests = []
+        self.server = serve(self.handler, "localhost", 0)
+        self.url = f"ws://localhost:{self.server.socket.getsockname()[1]}/v1/listen"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def handler(self, websocket):
+        self.requests.append(websocket.request)
+        segment_start = 0.0
+        segment_bytes = 0
+        for message in websocket:
+            if isinstance(message, bytes):
+                if segment_bytes == 0:
+                    websocket.send(self.result(segment_start, len(message) / 64000, "hello", is_final=False))
+                segment_bytes += len(message)
+                continue
+
+            # Like Deepgram, closing the stream finalizes whatever audio is left
+            message_type = json.loads(message)["type"]
+            if message_type in ["Finalize", "CloseStream"] and segment_bytes:
+                websocket.send(self.result(segment_start, segment_bytes / 64000, "hello world", is_final=True))
+                segment_start += segment_bytes / 64000
+                segment_bytes = 0
+            if message_type == "CloseStream":
+                return
+
+    def result(self, start, duration, transcript, is_final):
+        return json.dumps({"type": "Results", "start": start, "duration": duration, "is_final": is_final, "channel": {"alternatives": [{"transcript": transcript, "confidence": 0.9, "words": []}]}})
+
+    def shutdown(self):
+        self.server.shutdown()
+
+
+class TestRealtimeTranscriber(SimpleTestCase):
+    def setUp(self):
+        self.server = MockDeepgramStreamingServer()
+        self.saved_transcriptions = []
+        self.transcriber = RealtimeTranscriber(
+            url=self.server.url,
+            api_key="test_api_key",
+            options={"model": "nova-3", "smart_format": True, "language": "en", "detect_language": None},
+            sample_rate=32000,
+            get_participant_callback=lambda speaker_id: {"participant_uuid": str(speaker_id), "participant_user_uuid": None, "participant_full_name": "Test User"},
+            save_transcription_callback=self.saved_transcriptions.append,
+        )
+
+    def tearDown(self):
+        self.transcriber.cleanup()
+        self.server.shutdown()
+
+    def test_streams_audio_and_saves_interim_and_final_results(self):
+        chunk = b"\x01\x00" * 320
+        first_segment_time = datetime(2025, 1, 1, tzinfo=timezone.utc)
+        second_segment_time = first_segment_time + timedelta(seconds=30)
+
+        for i in range(50):
+            self.transcriber.send_audio(1, first_segment_time + timedelta(milliseconds=10 * i), chunk)
+        self.transcriber.finalize(1)
+        for i in range(50):
+            self.transcriber.send_audio(1, second_segment_time + timedelta(milliseconds=10 * i), chunk)
+        self.transcriber.flush(timeout=5)
+
+        request = self.server.requests[0]
+        self.assertEqual(request.headers["Authorization"], "Token test_api_key")
+        query = parse_qs(urlparse(request.path).query)
+        self.assertEqual(query["model"], ["nova-3"])
+        self.assertEqual(query["smart_format"], ["true"])
+        self.assertEqual(query["encoding"], ["linear16"])
+        self.assertEqual(query["sample_rate"], ["32000"])
+        self.assertEqual(query["interim_results"], ["true"])
+        self.assertNotIn("detect_language", query)
+
+        self.assertEqual([(t["transcription"]["transcript"], t["is_final"]) for t in self.saved_transcriptions], [("hello", False), ("hello world", True), ("hello", False), ("hello world", True)])
+        # Interim and final results for a segment share a source_uuid_suffix, so the final result replaces the interim one
+        self.assertEqual(self.saved_transcriptions[0]["source_uuid_suffix"], self.saved_transcriptions[1]["source_uuid_suffix"])
+        self.assertNotEqual(self.saved_transcriptions[1]["source_uuid_suffix"], self.saved_transcriptions[3]["source_uuid_suffix"])
+        # Offsets in Deepgram's results are mapped back to when the segment was spoken, not when it was streamed
+        self.assertEqual(self.saved_transcriptions[1]["timestamp_ms"], int(first_segment_time.timestamp() * 1000))
+        self.assertEqual(self.saved_transcriptions[3]["timestamp_ms"], int(second_segment_time.timestamp() * 1000))
+        self.assertEqual(self.saved_transcriptions[3]["duration_ms"], 500)
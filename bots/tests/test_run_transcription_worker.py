@@ -0,0 +1,161 @@
+import json
+import os
+import signal
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+
+import redis
+from django.core.management import call_command
+from django.test import TransactionTestCase, override_settings
+
+from bots.management.commands.run_transcription_worker import Command
+from bots.models import (
+    Bot,
+    BotStates,
+    Credentials,
+    Organization,
+    Participant,
+    Project,
+    Recording,
+    RecordingStates,
+    RecordingTranscriptionStates,
+    RecordingTypes,
+    TranscriptionTypes,
+    Utterance,
+)
+from bots.transcription_queue import TRANSCRIPTION_QUEUE_KEY, TRANSCRIPTION_RETRY_QUEUE_KEY, enqueue_utterances_for_transcription, get_redis_url
+
+
+class MockDeepgramServer:
+    """Answers like Deepgram's pre-recorded API. Audio starting with a byte in failing_first_bytes gets a 500."""
+
+    def __init__(self):
+        self.requests = []
+        self.failing_first_bytes = set()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                audio_data = self.rfile.read(int(self.headers["Content-Length"]))
+                server.requests.append((self.path, dict(self.headers), audio_data))
+                if audio_data[0] in server.failing_first_bytes:
+                    self.send_response(500)
+                    self.end_headers()
+                    return
+                body = json.dumps({"results": {"channels": [{"alternatives": [{"transcript": f"utterance {audio_data[0]}", "confidence": 0.9, "words": []}]}]}}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("localhost", 0), Handler)
+        self.url = f"http://localhost:{self.server.server_address[1]}/v1/listen"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class RunTranscriptionWorkerTest(TransactionTestCase):
+    def setUp(self):
+        self.deepgram = MockDeepgramServer()
+        self.addCleanup(self.deepgram.shutdown)
+        settings_override = override_settings(TRANSCRIPTION_WORKER="async", DEEPGRAM_LISTEN_URL=self.deepgram.url, TRANSCRIPTION_RESULTS_CACHE_TTL_SECONDS=0)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.redis_client = redis.from_url(get_redis_url())
+        self.redis_client.delete(TRANSCRIPTION_QUEUE_KEY, TRANSCRIPTION_RETRY_QUEUE_KEY)
+        self.addCleanup(self.redis_client.delete, TRANSCRIPTION_QUEUE_KEY, TRANSCRIPTION_RETRY_QUEUE_KEY)
+
+        self.organization = Organization.objects.create(name="Test Org")
+        self.project = Project.objects.create(name="Test Project", organization=self.organization)
+        Credentials.objects.create(project=self.project, credential_type=Credentials.CredentialTypes.DEEPGRAM).set_credentials({"api_key": "test_api_key"})
+        self.bot = Bot.objects.create(project=self.project, meeting_url="https://zoom.us/j/123", state=BotStates.ENDED)
+        self.recording = Recording.objects.create(
+            bot=self.bot,
+            recording_type=RecordingTypes.AUDIO_ONLY,
+            transcription_type=TranscriptionTypes.NON_REALTIME,
+            is_default_recording=True,
+            state=RecordingStates.COMPLETE,
+        )
+        self.participant = Participant.objects.create(bot=self.bot, uuid="participant_1", full_name="Test User")
+        self.utterances = [Utterance.objects.create(recording=self.recording, participant=self.participant, timestamp_ms=1000 * i, duration_ms=100, sample_rate=32000, audio_blob=bytes([i]) * 6400) for i in range(1, 4)]
+
+    def test_failed_utterances_are_retried_until_the_recording_is_transcribed(self):
+        self.deepgram.failing_first_bytes = {2}
+        enqueue_utterances_for_transcription(self.recording.id, [utterance.id for utterance in self.utterances])
+
+        with patch.object(Command, "RETRY_BASE_DELAY_SECONDS", 0):
+            call_command("run_transcription_worker", "--drain")
+
+        path, headers, _ = self.deepgram.requests[0]
+        self.assertEqual(headers["Authorization"], "Token test_api_key")
+        self.assertIn("encoding=linear16", path)
+        self.assertIn("sample_rate=32000", path)
+
+        # The utterance that failed is waiting to be retried, the batch itself was acknowledged
+        transcriptions = {utterance.id: utterance.transcription for utterance in Utterance.objects.filter(recording=self.recording)}
+        self.assertEqual(transcriptions[self.utterances[0].id]["transcript"], "utterance 1")
+        self.assertIsNone(transcriptions[self.utterances[1].id])
+        self.assertEqual(transcriptions[self.utterances[2].id]["transcript"], "utterance 3")
+        self.assertEqual(self.redis_client.llen(TRANSCRIPTION_QUEUE_KEY), 0)
+        retry_work_items = [json.loads(raw_work_item) for raw_work_item in self.redis_client.zrange(TRANSCRIPTION_RETRY_QUEUE_KEY, 0, -1)]
+        self.assertEqual(retry_work_items, [{"recording_id": self.recording.id, "utterance_ids": [self.utterances[1].id], "attempt": 1}])
+        self.recording.refresh_from_db()
+        self.assertEqual(self.recording.transcription_state, RecordingTranscriptionStates.IN_PROGRESS)
+
+        # Once Deepgram recovers, the next run picks up the retry and completes the recording's transcription
+        self.deepgram.failing_first_bytes = set()
+        call_command("run_transcription_worker", "--drain")
+
+        self.assertEqual(Utterance.objects.get(id=self.utterances[1].id).transcription["transcript"], "utterance 2")
+        self.assertEqual(self.redis_client.zcard(TRANSCRIPTION_RETRY_QUEUE_KEY), 0)
+        self.assertEqual(len(self.deepgram.requests), 4)
+        self.recording.refresh_from_db()
+        self.assertEqual(self.recording.transcription_state, RecordingTranscriptionStates.COMPLETE)
+
+    def test_batches_of_a_worker_that_died_are_recovered(self):
+        utterance_ids = [utterance.id for utterance in self.utterances]
+        # A worker took the batch and died before finishing it, so its heartbeat expired
+        self.redis_client.lpush("transcription_queue:processing:dead_worker", json.dumps({"recording_id": self.recording.id, "utterance_ids": utterance_ids}))
+        self.addCleanup(self.redis_client.delete, "transcription_queue:processing:dead_worker")
+
+        call_command("run_transcription_worker", "--drain")
+
+        self.assertFalse(Utterance.objects.filter(recording=self.recording, transcription__isnull=True).exists())
+        self.assertEqual(self.redis_client.llen("transcription_queue:processing:dead_worker"), 0)
+        self.recording.refresh_from_db()
+        self.assertEqual(self.recording.transcription_state, RecordingTranscriptionStates.COMPLETE)
+
+    def test_batches_of_a_worker_that_dies_while_this_one_runs_are_recovered(self):
+        utterance_ids = [utterance.id for utterance in self.utterances]
+        # The worker crashed moments ago and was restarted, so its heartbeat is still alive when this worker starts
+        self.redis_client.lpush("transcription_queue:processing:crashed_worker", json.dumps({"recording_id": self.recording.id, "utterance_ids": utterance_ids}))
+        self.redis_client.set("transcription_queue:worker:crashed_worker", 1, px=500)
+        self.addCleanup(self.redis_client.delete, "transcription_queue:processing:crashed_worker", "transcription_queue:worker:crashed_worker")
+
+        def stop_worker_once_transcribed():
+            deadline = time.monotonic() + 10
+            while len(self.deepgram.requests) < len(utterance_ids) and time.monotonic() < deadline:
+                time.sleep(0.05)
+            # The worker finishes the batches in flight before stopping
+            os.kill(os.getpid(), signal.SIGINT)
+
+        stopper = threading.Thread(target=stop_worker_once_transcribed)
+        stopper.start()
+        with patch.object(Command, "HEARTBEAT_INTERVAL_SECONDS", 0.1):
+            call_command("run_transcription_worker")
+        stopper.join()
+
+        self.assertFalse(Utterance.objects.filter(recording=self.recording, transcription__isnull=True).exists())
+        self.assertEqual(self.redis_client.llen("transcription_queue:processing:crashed_worker"), 0)
+        self.recording.refresh_from_db()
+        self.assertEqual(self.recording.transcription_state, RecordingTranscriptionStates.COMPLETE)
@@ -0,0 +1,62 @@
+from unittest.mock import patch
+
+from django.test import TransactionTestCase
+
+from bots.models import Credentials, Organization, Project
+from bots.transcription_client_cache import DeepgramClientCache, deepgram_client_cache
+
+
+class DeepgramClientCacheTest(TransactionTestCase):
+    def setUp(self):
+        self.organization = Organization.objects.create(name="Test Org")
+        self.project = Project.objects.create(name="Test Project", organization=self.organization)
+        self.credentials = Credentials.objects.create(project=self.project, credential_type=Credentials.CredentialTypes.DEEPGRAM)
+        self.credentials.set_credentials({"api_key": "first_api_key"})
+
+        # A cache of its own stands in for another worker process, which set_credentials can't invalidate
+        self.cache = DeepgramClientCache()
+        self.addCleanup(deepgram_client_cache.invalidate, self.project.id)
+
+        client_patcher = patch("deepgram.DeepgramClient", side_effect=lambda api_key: object())
+        self.mock_deepgram_client = client_patcher.start()
+        self.addCleanup(client_patcher.stop)
+
+    def test_client_is_built_once_and_cached_within_the_ttl(self):
+        client = self.cache.get_client(self.project.id)
+
+        with self.assertNumQueries(0):
+            self.assertIs(self.cache.get_client(self.project.id), client)
+            self.assertEqual(self.cache.get_api_key(self.project.id), "first_api_key")
+        self.mock_deepgram_client.assert_called_once_with("first_api_key")
+
+    def test_unchanged_credentials_are_only_checked_after_the_ttl(self):
+        client = self.cache.get_client(self.project.id)
+        self.cache.TTL_SECONDS = 0
+
+        # A single updated_at lookup, the credentials aren't decrypted again and the client is kept
+        with self.assertNumQueries(1):
+            self.assertIs(self.cache.get_client(self.project.id), client)
+        self.mock_deepgram_client.assert_called_once()
+
+    def test_rotated_credentials_are_picked_up_once_the_ttl_runs_out(self):
+        client = self.cache.get_client(self.project.id)
+        self.credentials.set_credentials({"api_key": "second_api_key"})
+
+        # Within the TTL the cached entry is used as is
+        self.assertIs(self.cache.get_client(self.project.id), client)
+        self.assertEqual(self.cache.get_api_key(self.project.id), "first_api_key")
+
+        # Once it runs out, the newer updated_at means the entry is rebuilt
+        self.cache.TTL_SECONDS = 0
+        self.assertEqual(self.cache.get_api_key(self.project.id), "second_api_key")
+        self.assertIsNot(self.cache.get_client(self.project.id), client)
+        self.mock_deepgram_client.assert_called_with("second_api_key")
+
+    def test_set_credentials_invalidates_the_cache_right_away(self):
+        self.assertEqual(deepgram_client_cache.get_api_key(self.project.id), "first_api_key")
+        with self.assertNumQueries(0):
+            deepgram_client_cache.get_api_key(self.project.id)
+
+        self.credentials.set_credentials({"api_key": "second_api_key"})
+
+        self.assertEqual(deepgram_client_cache.get_api_key(self.project.id), "second_api_key")
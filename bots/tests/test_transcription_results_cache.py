@@ -0,0 +1,40 @@
+import hashlib
+import io
+from unittest.mock import MagicMock
+
+from django.test import SimpleTestCase, override_settings
+
+from bots.transcription_results_cache import TranscriptionResultsCache, hash_audio_file
+
+
+class TestTranscriptionResultsCache(SimpleTestCase):
+    def setUp(self):
+        self.cache = TranscriptionResultsCache()
+        self.stored = {}
+        self.cache.redis_client = MagicMock()
+        self.cache.redis_client.get.side_effect = self.stored.get
+        self.cache.redis_client.set.side_effect = lambda key, value, ex: self.stored.__setitem__(key, value)
+
+    def test_hash_audio_file_rewinds_the_file(self):
+        audio_file = io.BytesIO(b"\x01\x02" * 1000000)
+
+        self.assertEqual(hash_audio_file(audio_file), hashlib.sha256(b"\x01\x02" * 1000000).hexdigest())
+        self.assertEqual(audio_file.tell(), 0)
+
+    @override_settings(TRANSCRIPTION_RESULTS_CACHE_TTL_SECONDS=60)
+    def test_results_are_keyed_by_audio_and_options(self):
+        key = self.cache.key("audio_hash", {"model": "nova-3", "language": "en"})
+        self.cache.set(key, {"transcript": "hello"})
+
+        self.assertEqual(self.cache.get(self.cache.key("audio_hash", {"language": "en", "model": "nova-3"})), {"transcript": "hello"})
+        self.assertIsNone(self.cache.get(self.cache.key("audio_hash", {"model": "nova-2", "language": "en"})))
+        self.assertIsNone(self.cache.get(self.cache.key("other_audio_hash", {"model": "nova-3", "language": "en"})))
+        self.cache.redis_client.set.assert_called_once_with(key, '{"transcript": "hello"}', ex=60)
+
+    @override_settings(TRANSCRIPTION_RESULTS_CACHE_TTL_SECONDS=0)
+    def test_cache_can_be_turned_off(self):
+        key = self.cache.key("audio_hash", {"model": "nova-3"})
+        self.cache.set(key, {"transcript": "hello"})
+
+        self.assertIsNone(self.cache.get(key))
+        self.cache.redis_client.set.assert_not_called()
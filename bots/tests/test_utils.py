@@ -0,0 +1,76 @@
+import io
+
+import numpy as np
+from django.test import SimpleTestCase
+from pydub import AudioSegment
+
+from bots.utils import I420Scaler, half_ceil, pcm_to_flac, pcm_to_opus, scale_i420
+
+
+def create_sine_wave_pcm(sample_rate=32000, seconds=1, frequency=440):
+    samples = (np.sin(2 * np.pi * frequency * np.arange(sample_rate * seconds) / sample_rate) * 10000).astype(np.int16)
+    return samples.tobytes()
+
+
+class TestI420Scaler(SimpleTestCase):
+    def test_matches_scale_i420(self):
+        scaler = I420Scaler()
+        rng = np.random.default_rng(0)
+
+        # Same aspect ratio, letterbox, pillarbox and odd dimensions
+        for frame_size in [(320, 180), (640, 480), (360, 640), (1281, 721)]:
+            width, height = frame_size
+            for _ in range(2):
+                frame = rng.integers(0, 256, width * height + 2 * half_ceil(width) * half_ceil(height), dtype=np.uint8).tobytes()
+                self.assertEqual(bytes(scaler.scale(frame, frame_size, (1920, 1080))), scale_i420(frame, frame_size, (1920, 1080)))
+
+    def test_evicts_oldest_canvas(self):
+        scaler = I420Scaler()
+        for width in range(2, 2 + 2 * (I420Scaler.MAX_CANVASES + 1), 2):
+            scaler.scale(b"\x00" * (width * 2 + 2 * half_ceil(width)), (width, 2), (64, 36))
+
+        self.assertEqual(len(scaler.canvases), I420Scaler.MAX_CANVASES)
+        self.assertNotIn(((2, 2), (64, 36)), scaler.canvases)
+
+    def test_fast_paths(self):
+        scaler = I420Scaler()
+        frame = np.random.default_rng(0).integers(0, 256, 64 * 36 * 3 // 2, dtype=np.uint8).tobytes()
+
+        # Already the output size, so the original buffer is returned untouched
+        scaled_frame = scaler.scale(frame, (64, 36), (64, 36))
+        self.assertIs(scaled_frame.obj, frame)
+
+        y_plane_size = 64 * 36
+        scaled_frame = scaler.scale_planes(frame[:y_plane_size], frame[y_plane_size : y_plane_size * 5 // 4], frame[y_plane_size * 5 // 4 :], (64, 36), (64, 36))
+        self.assertEqual(bytes(scaled_frame), frame)
+
+        # Exact 2x downscale matches the regular resize
+        self.assertEqual(bytes(scaler.scale(frame, (64, 36), (32, 18))), scale_i420(frame, (64, 36), (32, 18)))
+        self.assertEqual(bytes(scaler.scale(frame, (64, 36), (48, 27))), scale_i420(frame, (64, 36), (48, 27)))
+
+        self.assertEqual(scaler.path_counts, {"passthrough": 1, "copy": 1, "downscale_2x": 1, "resize": 1})
+
+
+class TestUtteranceAudioEncoding(SimpleTestCase):
+    def test_pcm_to_flac_round_trip_is_lossless(self):
+        pcm_data = create_sine_wave_pcm()
+        flac_data = pcm_to_flac(pcm_data, sample_rate=32000)
+
+        self.assertTrue(flac_data.startswith(b"fLaC"))
+        self.assertLess(len(flac_data), len(pcm_data))
+        decoded_audio = AudioSegment.from_file(io.BytesIO(flac_data), format="flac")
+        self.assertEqual((decoded_audio.frame_rate, decoded_audio.channels, decoded_audio.sample_width), (32000, 1, 2))
+        self.assertEqual(decoded_audio.raw_data, pcm_data)
+
+    def test_pcm_to_opus_round_trip_keeps_the_audio(self):
+        pcm_data = create_sine_wave_pcm()
+        opus_data = pcm_to_opus(pcm_data, sample_rate=32000)
+
+        self.assertTrue(opus_data.startswith(b"OggS"))
+        self.assertIn(b"OpusHead", opus_data[:100])
+        self.assertLess(len(opus_data), len(pcm_data) / 10)
+        # Opus is lossy and resampled to 48kHz, so compare the duration and the loudness
+        decoded_audio = AudioSegment.from_file(io.BytesIO(opus_data), format="ogg").set_frame_rate(32000)
+        original_audio = AudioSegment(data=pcm_data, sample_width=2, frame_rate=32000, channels=1)
+        self.assertAlmostEqual(len(decoded_audio), len(original_audio), delta=30)
+        self.assertAlmostEqual(decoded_audio.dBFS, original_audio.dBFS, delta=1)
@@ -0,0 +1,360 @@
+import os
+import tempfile
+import threading
+import time
+from unittest.mock import MagicMock, patch
+
+from django.core.files.storage import FileSystemStorage
+from django.db import DatabaseError
+from django.test import TransactionTestCase, override_settings
+
+from bots.bot_controller.utterance_persistence_worker import UtterancePersistenceWorker
+from bots.models import (
+    Bot,
+    BotStates,
+    Organization,
+    Project,
+    Recording,
+    RecordingStates,
+    RecordingTranscriptionStates,
+    RecordingTypes,
+    TranscriptionTypes,
+    Utterance,
+    WebhookDeliveryAttempt,
+    WebhookSubscription,
+    WebhookTriggerTypes,
+)
+from bots.webhook_utils import trigger_webhook
+
+
+class UtterancePersistenceWorkerTest(TransactionTestCase):
+    def setUp(self):
+        self.organization = Organization.objects.create(name="Test Org")
+        self.project = Project.objects.create(name="Test Project", organization=self.organization)
+        self.bot = Bot.objects.create(project=self.project, meeting_url="https://zoom.us/j/123", state=BotStates.JOINED_RECORDING)
+        self.recording = Recording.objects.create(
+            bot=self.bot,
+            recording_type=RecordingTypes.AUDIO_ONLY,
+            transcription_type=TranscriptionTypes.NON_REALTIME,
+            is_default_recording=True,
+            state=RecordingStates.IN_PROGRESS,
+        )
+
+        enqueue_patcher = patch("bots.bot_controller.utterance_persistence_worker.enqueue_utterances_for_transcription")
+        self.mock_enqueue = enqueue_patcher.start()
+        self.addCleanup(enqueue_patcher.stop)
+
+        self.worker = self.create_worker()
+
+    def create_worker(self, **kwargs):
+        worker = UtterancePersistenceWorker(bot_id=self.bot.id, **kwargs)
+        worker.SAVE_RETRY_BASE_DELAY_SECONDS = 0
+        self.addCleanup(worker.cleanup)
+        return worker
+
+    def create_message(self, timestamp_ms, release_audio_data=None):
+        return {
+            "participant_uuid": "participant_1",
+            "participant_user_uuid": None,
+            "participant_full_name": "Test User",
+            "audio_data": memoryview(b"\x01\x00" * 3200),
+            "release_audio_data": release_audio_data or MagicMock(),
+            "timestamp_ms": timestamp_ms,
+            "flush_reason": "silence_limit",
+            "sample_rate": 32000,
+        }
+
+    def test_utterances_queued_while_saving_are_saved_in_one_batch(self):
+        # Hold the worker up while it releases the first utterance's audio, so the next ones queue up behind it
+        first_utterance_saved = threading.Event()
+        continue_worker = threading.Event()
+
+        def release_first_audio_data():
+            first_utterance_saved.set()
+            continue_worker.wait(timeout=5)
+
+        self.worker.add_utterance(self.create_message(0, release_first_audio_data))
+        self.assertTrue(first_utterance_saved.wait(timeout=5))
+        messages = [self.create_message(1000 * i) for i in range(1, 5)]
+        for message in messages:
+            self.worker.add_utterance(message)
+        continue_worker.set()
+        self.worker.flush()
+
+        self.assertEqual(Utterance.objects.filter(recording=self.recording).count(), 5)
+        self.assertEqual(self.worker.batches_saved, 2)
+        for message in messages:
+            message["release_audio_data"].assert_called_once()
+
+    def test_flush_saves_and_enqueues_everything_queued(self):
+        for i in range(3):
+            self.worker.add_utterance(self.create_message(1000 * i))
+        self.worker.flush()
+
+        utterance_ids = list(Utterance.objects.filter(recording=self.recording).order_by("id").values_list("id", flat=True))
+        self.assertEqual(len(utterance_ids), 3)
+        enqueued_utterance_ids = [utterance_id for call in self.mock_enqueue.call_args_list for utterance_id in call.args[1]]
+        self.assertEqual(enqueued_utterance_ids, utterance_ids)
+
+    def test_cleanup_saves_queued_utterances_and_stops_the_thread(self):
+        message = self.create_message(0)
+        self.worker.add_utterance(message)
+        self.worker.cleanup()
+
+        self.assertFalse(self.worker.thread.is_alive())
+        self.assertEqual(Utterance.objects.filter(recording=self.recording).count(), 1)
+        message["release_audio_data"].assert_called_once()
+        self.mock_enqueue.assert_called_once()
+
+    def test_failed_save_is_retried_before_the_audio_is_released(self):
+        real_bulk_create = Utterance.objects.bulk_create
+        bulk_create_calls = []
+
+        def bulk_create_failing_once(*args, **kwargs):
+            bulk_create_calls.append(args)
+            if len(bulk_create_calls) == 1:
+                raise DatabaseError("connection lost")
+            return real_bulk_create(*args, **kwargs)
+
+        message = self.create_message(0)
+        with patch.object(Utterance.objects, "bulk_create", side_effect=bulk_create_failing_once):
+            self.worker.add_utterance(message)
+            self.worker.flush()
+
+        self.assertEqual(len(bulk_create_calls), 2)
+        self.assertEqual(Utterance.objects.filter(recording=self.recording).count(), 1)
+        message["release_audio_data"].assert_called_once()
+        self.assertEqual(self.worker.utterances_dropped, 0)
+
+    def test_audio_is_released_once_every_save_attempt_failed(self):
+        message = self.create_message(0)
+        with patch.object(Utterance.objects, "bulk_create", side_effect=DatabaseError("connection lost")) as mock_bulk_create:
+            self.worker.add_utterance(message)
+            self.worker.flush()
+
+        self.assertEqual(mock_bulk_create.call_count, UtterancePersistenceWorker.SAVE_ATTEMPTS)
+        message["release_audio_data"].assert_called_once()
+        self.assertEqual(self.worker.utterances_dropped, 1)
+        self.assertFalse(Utterance.objects.exists())
+
+    @override_settings(UTTERANCE_AUDIO_STORAGE="s3")
+    def test_a_retry_doesnt_encode_or_upload_the_audio_again(self):
+        audio_directory = tempfile.TemporaryDirectory()
+        self.addCleanup(audio_directory.cleanup)
+        storage_patcher = patch.object(Utterance._meta.get_field("audio_file"), "storage", FileSystemStorage(location=audio_directory.name))
+        storage_patcher.start()
+        self.addCleanup(storage_patcher.stop)
+
+        real_bulk_create = Utterance.objects.bulk_create
+        bulk_create_calls = []
+
+        def bulk_create_failing_once(*args, **kwargs):
+            bulk_create_calls.append(args)
+            if len(bulk_create_calls) == 1:
+                raise DatabaseError("connection lost")
+            return real_bulk_create(*args, **kwargs)
+
+        with patch.object(self.worker, "encode_audio", wraps=self.worker.encode_audio) as mock_encode_audio, patch.object(Utterance.objects, "bulk_create", side_effect=bulk_create_failing_once):
+            self.worker.add_utterance(self.create_message(0))
+            self.worker.flush()
+
+        self.assertEqual(len(bulk_create_calls), 2)
+        mock_encode_audio.assert_called_once()
+        # The failed attempt didn't leave a copy of the audio behind
+        uploaded_files = [os.path.join(directory, name) for directory, _, names in os.walk(audio_directory.name) for name in names]
+        self.assertEqual(uploaded_files, [os.path.join(audio_directory.name, Utterance.objects.get(recording=self.recording).audio_file.name)])
+
+    @override_settings(UTTERANCE_AUDIO_STORAGE="s3")
+    def test_uploaded_audio_is_deleted_once_every_save_attempt_failed(self):
+        audio_directory = tempfile.TemporaryDirectory()
+        self.addCleanup(audio_directory.cleanup)
+        storage_patcher = patch.object(Utterance._meta.get_field("audio_file"), "storage", FileSystemStorage(location=audio_directory.name))
+        storage_patcher.start()
+        self.addCleanup(storage_patcher.stop)
+
+        with patch.object(Utterance.objects, "bulk_create", side_effect=DatabaseError("connection lost")):
+            self.worker.add_utterance(self.create_message(0))
+            self.worker.flush()
+
+        self.assertEqual(self.worker.utterances_dropped, 1)
+        self.assertEqual([name for _, _, names in os.walk(audio_directory.name) for name in names], [])
+
+    def test_flush_gives_up_after_the_timeout(self):
+        first_utterance_saved = threading.Event()
+        worker_can_continue = threading.Event()
+        self.addCleanup(worker_can_continue.set)
+
+        def release_first_audio_data():
+            first_utterance_saved.set()
+            worker_can_continue.wait(timeout=5)
+
+        # The worker is stuck, like it is while the database is down
+        self.worker.add_utterance(self.create_message(0, release_first_audio_data))
+        self.assertTrue(first_utterance_saved.wait(timeout=5))
+        self.worker.add_utterance(self.create_message(1000))
+
+        started_at = time.monotonic()
+        self.assertFalse(self.worker.flush(timeout=0.2))
+        self.assertLess(time.monotonic() - started_at, 2)
+
+        worker_can_continue.set()
+        self.assertTrue(self.worker.flush())
+        self.assertEqual(Utterance.objects.filter(recording=self.recording).count(), 2)
+
+    def test_adding_utterances_never_blocks(self):
+        first_utterance_saved = threading.Event()
+        worker_can_continue = threading.Event()
+        self.addCleanup(worker_can_continue.set)
+        self.worker.max_pending_utterances = 2
+
+        def release_first_audio_data():
+            first_utterance_saved.set()
+            worker_can_continue.wait(timeout=5)
+
+        # The worker is stuck on the first utterance, the rest pile up behind it
+        self.worker.add_utterance(self.create_message(0, release_first_audio_data))
+        self.assertTrue(first_utterance_saved.wait(timeout=5))
+        for i in range(1, 6):
+            self.worker.add_utterance(self.create_message(1000 * i))
+
+        self.assertGreater(self.worker.utterances_backlogged, 0)
+        worker_can_continue.set()
+        self.worker.flush()
+        self.assertEqual(Utterance.objects.filter(recording=self.recording).count(), 6)
+
+    def get_enqueued_batches(self):
+        return [(call.args[0], call.args[1]) for call in self.mock_enqueue.call_args_list]
+
+    def test_saved_utterances_are_enqueued_together_once_the_window_ends(self):
+        worker = self.create_worker(transcription_batch_window_seconds=60)
+        for i in range(3):
+            worker.add_utterance(self.create_message(1000 * i))
+            # Each utterance is saved in a batch of its own
+            worker.queue.join()
+
+        self.assertEqual(worker.batches_saved, 3)
+        self.mock_enqueue.assert_not_called()
+
+        # Ending the window early, like flush does, hands them over as a single batch
+        worker.flush()
+        utterance_ids = list(Utterance.objects.filter(recording=self.recording).order_by("id").values_list("id", flat=True))
+        self.assertEqual(self.get_enqueued_batches(), [(self.recording.id, utterance_ids)])
+
+    def test_pending_utterances_are_enqueued_once_the_window_ends(self):
+        worker = self.create_worker(transcription_batch_window_seconds=1)
+        for i in range(2):
+            worker.add_utterance(self.create_message(1000 * i))
+
+        deadline = time.monotonic() + 5
+        while not self.mock_enqueue.called and time.monotonic() < deadline:
+            time.sleep(0.01)
+        utterance_ids = list(Utterance.objects.filter(recording=self.recording).order_by("id").values_list("id", flat=True))
+        self.assertEqual(self.get_enqueued_batches(), [(self.recording.id, utterance_ids)])
+
+    def test_large_batches_are_split(self):
+        worker = self.create_worker(transcription_batch_window_seconds=60, max_transcription_batch_size=2)
+        for i in range(5):
+            worker.add_utterance(self.create_message(1000 * i))
+        worker.flush()
+
+        utterance_ids = list(Utterance.objects.filter(recording=self.recording).order_by("id").values_list("id", flat=True))
+        self.assertEqual(self.get_enqueued_batches(), [(self.recording.id, utterance_ids[0:2]), (self.recording.id, utterance_ids[2:4]), (self.recording.id, utterance_ids[4:5])])
+        self.assertEqual(worker.transcription_tasks_enqueued, 3)
+
+    def test_batches_that_fail_to_be_enqueued_are_tried_again(self):
+        worker = self.create_worker(transcription_batch_window_seconds=0.2)
+        self.mock_enqueue.side_effect = [Exception("Redis is down"), None]
+
+        worker.add_utterance(self.create_message(0))
+        worker.flush()
+        self.assertEqual(worker.transcription_tasks_enqueued, 0)
+
+        # The ids were kept and go out one window later
+        deadline = time.monotonic() + 5
+        while worker.transcription_tasks_enqueued == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        utterance_id = Utterance.objects.get(recording=self.recording).id
+        self.assertEqual(self.get_enqueued_batches(), [(self.recording.id, [utterance_id]), (self.recording.id, [utterance_id])])
+        self.assertEqual(worker.transcription_tasks_enqueued, 1)
+        self.assertEqual(worker.pending_transcription_utterance_ids, {})
+
+    @override_settings(UTTERANCE_AUDIO_FORMAT="flac", UTTERANCE_AUDIO_STORAGE="database")
+    def test_utterances_are_encoded_before_being_saved(self):
+        for i in range(3):
+            self.worker.add_utterance(self.create_message(1000 * i))
+        self.worker.flush()
+
+        utterances = list(Utterance.objects.filter(recording=self.recording).order_by("timestamp_ms"))
+        self.assertEqual([utterance.timestamp_ms for utterance in utterances], [0, 1000, 2000])
+        for utterance in utterances:
+            self.assertEqual(utterance.audio_format, Utterance.AudioFormat.FLAC)
+            self.assertTrue(bytes(utterance.audio_blob).startswith(b"fLaC"))
+            self.assertEqual(utterance.duration_ms, 100)
+
+    def create_realtime_transcription_message(self, segment_id, transcript, is_final):
+        return {
+            "participant_uuid": "participant_1",
+            "participant_user_uuid": None,
+            "participant_full_name": "Test User",
+            "source_uuid_suffix": f"participant_1-{segment_id}",
+            "transcription": {"transcript": transcript},
+            "is_final": is_final,
+            "timestamp_ms": 1000 * segment_id,
+            "duration_ms": 500,
+        }
+
+    def test_realtime_transcriptions_are_saved_and_sent_off_the_main_loop(self):
+        with patch("bots.bot_controller.utterance_persistence_worker.trigger_webhook") as mock_trigger_webhook:
+            self.worker.add_realtime_transcription(self.create_realtime_transcription_message(1, "Hello", False))
+            self.worker.add_realtime_transcription(self.create_realtime_transcription_message(1, "Hello there", True))
+            self.worker.add_realtime_transcription(self.create_realtime_transcription_message(2, "Bye", True))
+            self.worker.flush()
+
+        # The interim result was replaced by the final one for the same segment
+        transcripts = list(Utterance.objects.filter(recording=self.recording).order_by("timestamp_ms").values_list("transcription__transcript", flat=True))
+        self.assertEqual(transcripts, ["Hello there", "Bye"])
+        self.recording.refresh_from_db()
+        self.assertEqual(self.recording.transcription_state, RecordingTranscriptionStates.IN_PROGRESS)
+
+        # Every result is sent, interim ones included
+        self.assertEqual(mock_trigger_webhook.call_count, 3)
+        for call in mock_trigger_webhook.call_args_list:
+            self.assertEqual(call.kwargs["webhook_trigger_type"], WebhookTriggerTypes.TRANSCRIPT_UPDATE)
+            self.assertEqual(call.kwargs["bot"].id, self.bot.id)
+            self.assertEqual(call.kwargs["payload"]["speaker_uuid"], "participant_1")
+        self.assertEqual([call.kwargs["payload"]["is_final"] for call in mock_trigger_webhook.call_args_list], [False, True, True])
+        self.assertEqual(self.worker.batches_saved, 0)
+
+    @override_settings(WEBHOOK_DISPATCHER="async")
+    def test_a_failed_webhook_doesnt_send_the_others_twice(self):
+        WebhookSubscription.objects.create(project=self.project, url="https://example.com/transcripts", triggers=[WebhookTriggerTypes.TRANSCRIPT_UPDATE])
+        trigger_webhook_calls = []
+
+        def trigger_webhook_failing_once(**kwargs):
+            trigger_webhook_calls.append(kwargs)
+            if len(trigger_webhook_calls) == 2:
+                raise DatabaseError("connection lost")
+            return trigger_webhook(**kwargs)
+
+        # Hold the worker up on an utterance, so both results are saved in the same batch
+        first_utterance_saved = threading.Event()
+        worker_can_continue = threading.Event()
+        self.addCleanup(worker_can_continue.set)
+
+        def release_first_audio_data():
+            first_utterance_saved.set()
+            worker_can_continue.wait(timeout=5)
+
+        with patch("bots.bot_controller.utterance_persistence_worker.trigger_webhook", side_effect=trigger_webhook_failing_once):
+            self.worker.add_utterance(self.create_message(0, release_first_audio_data))
+            self.assertTrue(first_utterance_saved.wait(timeout=5))
+            self.worker.add_realtime_transcription(self.create_realtime_transcription_message(1, "Hello", True))
+            self.worker.add_realtime_transcription(self.create_realtime_transcription_message(2, "Bye", True))
+            worker_can_continue.set()
+            self.worker.flush()
+
+        # The first attempt was rolled back as a whole, so each result was sent exactly once
+        self.assertEqual(len(trigger_webhook_calls), 4)
+        self.assertEqual(sorted(attempt.payload["transcription"]["transcript"] for attempt in WebhookDeliveryAttempt.objects.all()), ["Bye", "Hello"])
+        self.assertEqual(Utterance.objects.filter(recording=self.recording, transcription__isnull=False).count(), 2)
+        self.assertEqual(self.worker.utterances_dropped, 0)
@@ -0,0 +1,43 @@
+import threading
+import time
+
+from django.test import SimpleTestCase
+
+from bots.bot_controller.video_frame_processor import VideoFrameProcessor
+
+
+def create_black_i420_frame(width, height):
+    return b"\x00" * (width * height) + b"\x80" * (width * height // 2)
+
+
+class TestVideoFrameProcessor(SimpleTestCase):
+    def test_drops_oldest_frames_and_emits_in_order(self):
+        emitted_timestamps = []
+        first_frame_emitted = threading.Event()
+        release_output = threading.Event()
+
+        def output_callback(frame, timestamp_ns):
+            self.assertEqual(len(frame), len(create_black_i420_frame(64, 36)))
+            emitted_timestamps.append(timestamp_ns)
+            first_frame_emitted.set()
+            release_output.wait(timeout=5)
+
+        processor = VideoFrameProcessor(output_callback=output_callback, output_size=(64, 36), num_workers=1, max_pending_frames=2)
+        frame = create_black_i420_frame(32, 18)
+
+        # The single worker gets stuck emitting the first frame, so the rest pile up in the queue
+        processor.add_frame(frame, (32, 18), 0)
+        self.assertTrue(first_frame_emitted.wait(timeout=5))
+        for timestamp_ns in range(1, 6):
+            processor.add_frame(frame, (32, 18), timestamp_ns)
+        release_output.set()
+
+        deadline = time.time() + 5
+        while len(emitted_timestamps) < 3 and time.time() < deadline:
+            time.sleep(0.01)
+        processor.cleanup()
+
+        self.assertEqual(emitted_timestamps, [0, 4, 5])
+        stats = processor.get_stats()
+        self.assertEqual(stats["frames_dropped_queue_full"], 3)
+        self.assertEqual(stats["frames_emitted"], 3)
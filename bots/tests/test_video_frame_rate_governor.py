@@ -0,0 +1,53 @@
+from django.test import SimpleTestCase
+
+from bots.bot_controller.video_frame_rate_governor import VideoFrameRateGovernor
+
+FRAME_SIZE = (64, 36)
+FRAME_INTERVAL_NS = 1_000_000_000 // 10
+
+
+def create_i420_frame(y_value):
+    width, height = FRAME_SIZE
+    return bytes([y_value]) * (width * height) + b"\x80" * (width * height // 2)
+
+
+class TestVideoFrameRateGovernor(SimpleTestCase):
+    def setUp(self):
+        self.emitted_frames = []
+        self.governor = VideoFrameRateGovernor(
+            output_callback=lambda frame, current_time_ns, duration_ns: self.emitted_frames.append((frame[0], current_time_ns, duration_ns)),
+            video_frame_size=FRAME_SIZE,
+            fps=10,
+            keepalive_interval_seconds=1,
+        )
+
+    def test_at_most_one_frame_is_emitted_per_slot(self):
+        # Frames arrive at 30 fps, each with different content
+        for i in range(30):
+            self.governor.on_new_video_frame(create_i420_frame(i), i * 1_000_000_000 // 30)
+
+        self.assertEqual([timestamp_ns for _, timestamp_ns, _ in self.emitted_frames], [i * 1_000_000_000 // 30 for i in range(0, 30, 3)])
+        stats = self.governor.get_stats()
+        self.assertEqual(stats["frames_emitted"], 10)
+        self.assertEqual(stats["frames_dropped_over_rate"], 20)
+
+    def test_duplicate_frames_are_dropped(self):
+        self.governor.on_new_video_frame(create_i420_frame(1), 0)
+        for i in range(1, 5):
+            self.governor.on_new_video_frame(create_i420_frame(1), i * FRAME_INTERVAL_NS)
+        self.governor.on_new_video_frame(create_i420_frame(2), 5 * FRAME_INTERVAL_NS)
+
+        self.assertEqual([(y_value, timestamp_ns) for y_value, timestamp_ns, _ in self.emitted_frames], [(1, 0), (2, 5 * FRAME_INTERVAL_NS)])
+        self.assertEqual(self.governor.get_stats()["frames_dropped_duplicate"], 4)
+
+    def test_identical_frames_are_kept_alive_without_overlapping(self):
+        # Static content for 3.5 seconds
+        for i in range(36):
+            self.governor.on_new_video_frame(create_i420_frame(1), i * FRAME_INTERVAL_NS)
+
+        self.assertEqual([timestamp_ns for _, timestamp_ns, _ in self.emitted_frames], [0, 1_000_000_000, 2_000_000_000, 3_000_000_000])
+        self.assertEqual(self.governor.get_stats()["keepalive_frames_emitted"], 3)
+        # Keepalives last one frame interval like every other frame, so none overlaps the next frame
+        self.assertTrue(all(duration_ns == FRAME_INTERVAL_NS for _, _, duration_ns in self.emitted_frames))
+        for (_, timestamp_ns, duration_ns), (_, next_timestamp_ns, _) in zip(self.emitted_frames, self.emitted_frames[1:]):
+            self.assertLessEqual(timestamp_ns + duration_ns, next_timestamp_ns)
@@ -1,14 +1,23 @@
+import json
+import threading
 import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from unittest.mock import patch
 
 from django.contrib.messages.storage.fallback import FallbackStorage
+from django.core.management import call_command
+from django.db import transaction
 from django.http import Http404, HttpRequest
 from django.http.request import QueryDict
-from django.test import TransactionTestCase
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+from django.utils import timezone
 
 from accounts.models import User
 from bots.models import (
     Bot,
+    BotEvent,
+    BotEventManager,
+    BotEventTypes,
     BotStates,
     Organization,
     Project,
@@ -20,7 +29,9 @@ from bots.models import (
 )
 from bots.projects_views import CreateWebhookView, DeleteWebhookView, ProjectWebhooksView
 from bots.tasks.deliver_webhook_task import deliver_webhook
-from bots.webhook_utils import sign_payload, verify_signature
+from bots.webhook_circuit_breaker import webhook_circuit_breaker
+from bots.webhook_sessions import WebhookSessionPool
+from bots.webhook_utils import sign_body, sign_payload, trigger_webhook, verify_signature, webhook_secret_cache, webhook_subscription_index
 
 
 class WebhookSubscriptionTest(TransactionTestCase):
@@ -273,8 +284,9 @@ class WebhookDeliveryTest(TransactionTestCase):
             meeting_url="https://zoom.us/j/123",
             state=BotStates.READY,
         )
+        webhook_circuit_breaker.reset("https://example.com")
 
-    @patch("bots.tasks.deliver_webhook_task.requests.post")
+    @patch("bots.tasks.deliver_webhook_task.webhook_session_pool.post")
     def test_webhook_delivery_success(self, mock_post):
         """Test successful webhook delivery"""
         mock_post.return_value.status_code = 200
@@ -297,12 +309,15 @@ class WebhookDeliveryTest(TransactionTestCase):
 
         # Verify request was made with correct data
         mock_post.assert_called_once()
+        body = mock_post.call_args.kwargs["data"]
+        self.assertEqual(mock_post.call_args.kwargs["headers"]["X-Webhook-Signature"], sign_body(body, self.webhook_secret.get_secret()))
+        self.assertEqual(json.loads(body)["data"], {"test": "data"})
         self.assertTrue(isinstance(attempt.status, int))
         self.assertEqual(attempt.status, WebhookDeliveryAttemptStatus.SUCCESS)
         self.assertEqual(len(attempt.response_body_list), 1)
         self.assertIsNotNone(attempt.succeeded_at)
 
-    @patch("bots.tasks.deliver_webhook_task.requests.post")
+    @patch("bots.tasks.deliver_webhook_task.webhook_session_pool.post")
     def test_webhook_delivery_failure(self, mock_post):
         """Test webhook delivery failure and retry"""
         mock_post.return_value.status_code = 500
@@ -328,7 +343,7 @@ class WebhookDeliveryTest(TransactionTestCase):
         self.assertIsNone(attempt.succeeded_at)
         self.assertEqual(attempt.attempt_count, 1)
 
-    @patch("bots.tasks.deliver_webhook_task.requests.post")
+    @patch("bots.tasks.deliver_webhook_task.webhook_session_pool.post")
     def test_webhook_delivery_inactive(self, mock_post):
         """Test webhook delivery does not deliver when the subscription is inactive"""
 
@@ -353,3 +368,245 @@ class WebhookDeliveryTest(TransactionTestCase):
         self.assertIsNone(attempt.response_body_list[0]["status_code"])
         self.assertIsNone(attempt.succeeded_at)
         self.assertEqual(attempt.attempt_count, 0)
+
+    def test_webhook_secret_cache_picks_up_rotated_secret(self):
+        """Test the decrypted secret is cached and a new secret replaces it right away"""
+        self.assertEqual(webhook_secret_cache.get_secret(self.project.id), self.webhook_secret.get_secret())
+        with self.assertNumQueries(0):
+            self.assertEqual(webhook_secret_cache.get_secret(self.project.id), self.webhook_secret.get_secret())
+
+        rotated_secret = WebhookSecret.objects.create(project=self.project)
+        self.assertNotEqual(rotated_secret.get_secret(), self.webhook_secret.get_secret())
+        self.assertEqual(webhook_secret_cache.get_secret(self.project.id), rotated_secret.get_secret())
+
+    @patch("bots.tasks.deliver_webhook_task.webhook_session_pool.post")
+    def test_webhook_delivery_deferred_while_circuit_open(self, mock_post):
+        """Test webhook delivery is put off without counting an attempt while the destination's circuit is open"""
+        attempt = WebhookDeliveryAttempt.objects.create(
+            webhook_subscription=self.webhook_subscription,
+            webhook_trigger_type=WebhookTriggerTypes.BOT_STATE_CHANGE,
+            bot=self.bot,
+            idempotency_key=uuid.uuid4(),
+            payload={"test": "data"},
+        )
+        webhook_circuit_breaker.open("https://example.com", 30)
+
+        with patch.object(deliver_webhook, "apply_async") as mock_apply_async:
+            deliver_webhook.apply(args=[attempt.id])
+
+        attempt.refresh_from_db()
+        mock_post.assert_not_called()
+        mock_apply_async.assert_called_once()
+        self.assertGreater(mock_apply_async.call_args.kwargs["countdown"], 29)
+        self.assertEqual(attempt.status, WebhookDeliveryAttemptStatus.PENDING)
+        self.assertEqual(attempt.attempt_count, 0)
+
+    @patch("bots.webhook_utils.group")
+    def test_trigger_webhook_enqueues_deliveries_after_commit(self, mock_group):
+        """Test delivery attempts are only created for matching subscriptions and are enqueued once the transaction commits"""
+        WebhookSubscription.objects.create(project=self.project, url="https://example.com/transcripts", triggers=[WebhookTriggerTypes.TRANSCRIPT_UPDATE])
+
+        with transaction.atomic():
+            num_deliveries = trigger_webhook(WebhookTriggerTypes.BOT_STATE_CHANGE, self.bot, {"test": "data"})
+            mock_group.return_value.apply_async.assert_not_called()
+
+        self.assertEqual(num_deliveries, 1)
+        mock_group.return_value.apply_async.assert_called_once()
+        attempt = WebhookDeliveryAttempt.objects.get()
+        self.assertEqual(attempt.webhook_subscription, self.webhook_subscription)
+        self.assertEqual(attempt.status, WebhookDeliveryAttemptStatus.PENDING)
+
+    @patch("bots.webhook_utils.group")
+    def test_subscription_deleted_by_another_process_is_skipped(self, mock_group):
+        """Test a subscription deleted without invalidating this process's index gets no delivery attempt, and the bot's event is still saved"""
+        trigger_webhook(WebhookTriggerTypes.BOT_STATE_CHANGE, self.bot, {"test": "data"})
+        self.assertIn(self.project.id, webhook_subscription_index.entries)
+
+        # A queryset delete skips WebhookSubscription.delete, like a delete in another process
+        WebhookSubscription.objects.filter(id=self.webhook_subscription.id).delete()
+        self.assertEqual(webhook_subscription_index.get_subscription_ids(self.project.id, WebhookTriggerTypes.BOT_STATE_CHANGE), [self.webhook_subscription.id])
+
+        event = BotEventManager.create_event(bot=self.bot, event_type=BotEventTypes.JOIN_REQUESTED)
+
+        self.assertEqual(event.new_state, BotStates.JOINING)
+        self.bot.refresh_from_db()
+        self.assertEqual(self.bot.state, BotStates.JOINING)
+        self.assertFalse(WebhookDeliveryAttempt.objects.exists())
+        # The stale index was dropped, so it's reloaded on the next trigger
+        self.assertNotIn(self.project.id, webhook_subscription_index.entries)
+
+    @patch("bots.webhook_utils.group")
+    def test_events_that_dont_change_the_state_send_no_state_change_webhook(self, mock_group):
+        """Test a RECORDING_DEGRADED event is recorded without bumping the bot's version or sending a bot.state_change webhook"""
+        self.bot.state = BotStates.JOINED_RECORDING
+        self.bot.save()
+        self.bot.refresh_from_db()
+        version = self.bot.version
+
+        event = BotEventManager.create_event(bot=self.bot, event_type=BotEventTypes.RECORDING_DEGRADED, event_metadata={"queue": "video_queue"})
+
+        self.assertEqual(BotEvent.objects.get(), event)
+        self.assertEqual((event.old_state, event.new_state), (BotStates.JOINED_RECORDING, BotStates.JOINED_RECORDING))
+        self.bot.refresh_from_db()
+        self.assertEqual(self.bot.version, version)
+        self.assertFalse(WebhookDeliveryAttempt.objects.exists())
+        mock_group.return_value.apply_async.assert_not_called()
+
+
+class WebhookSessionPoolTest(SimpleTestCase):
+    def test_sessions_are_reused_per_host(self):
+        pool = WebhookSessionPool(max_hosts=2)
+
+        session = pool.get_session("https://example.com/webhook1")
+        self.assertIs(pool.get_session("https://example.com/webhook2"), session)
+        self.assertIsNot(pool.get_session("https://other.example.com/webhook"), session)
+
+        # Going over max_hosts closes the least recently used host's session
+        pool.get_session("https://example.com/webhook1")
+        pool.get_session("https://third.example.com/webhook")
+        self.assertEqual(list(pool.sessions.keys()), ["https://example.com", "https://third.example.com"])
+        self.assertEqual(pool.get_metrics()["hosts"], 2)
+
+
+class MockWebhookEndpoint:
+    """Stands in for customers' webhook endpoints: /ok answers 200 and anything else answers 500"""
+
+    def __init__(self):
+        self.requests = []
+        endpoint = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                endpoint.requests.append((self.path, dict(self.headers), body))
+                self.send_response(200 if self.path == "/ok" else 500)
+                self.end_headers()
+                self.wfile.write(b"OK" if self.path == "/ok" else b"Server Error")
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("localhost", 0), Handler)
+        self.url = f"http://localhost:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@override_settings(WEBHOOK_DISPATCHER="async")
+class WebhookDispatcherTest(TransactionTestCase):
+    def setUp(self):
+        self.endpoint = MockWebhookEndpoint()
+        self.organization = Organization.objects.create(name="Test Org")
+        self.project = Project.objects.create(name="Test Project", organization=self.organization)
+        self.webhook_secret = WebhookSecret.objects.create(project=self.project)
+        self.ok_subscription = WebhookSubscription.objects.create(project=self.project, url=f"{self.endpoint.url}/ok", triggers=[WebhookTriggerTypes.BOT_STATE_CHANGE])
+        self.failing_subscription = WebhookSubscription.objects.create(project=self.project, url=f"{self.endpoint.url}/fail", triggers=[WebhookTriggerTypes.BOT_STATE_CHANGE])
+        self.bot = Bot.objects.create(project=self.project, meeting_url="https://zoom.us/j/123", state=BotStates.READY)
+
+    def tearDown(self):
+        self.endpoint.shutdown()
+
+    @patch("bots.webhook_utils.group")
+    def test_dispatcher_delivers_pending_webhooks_and_schedules_retries(self, mock_group):
+        trigger_webhook(WebhookTriggerTypes.BOT_STATE_CHANGE, self.bot, {"test": "data"})
+        mock_group.assert_not_called()
+
+        call_command("run_webhook_dispatcher", "--drain")
+
+        delivered = WebhookDeliveryAttempt.objects.get(webhook_subscription=self.ok_subscription)
+        self.assertEqual(delivered.status, WebhookDeliveryAttemptStatus.SUCCESS)
+        self.assertEqual(delivered.attempt_count, 1)
+        self.assertEqual(delivered.response_body_list, ["OK"])
+        self.assertIsNotNone(delivered.succeeded_at)
+
+        # A failed delivery stays pending until its retry is due
+        retrying = WebhookDeliveryAttempt.objects.get(webhook_subscription=self.failing_subscription)
+        self.assertEqual(retrying.status, WebhookDeliveryAttemptStatus.PENDING)
+        self.assertEqual(retrying.attempt_count, 1)
+        self.assertGreater(retrying.next_attempt_at, retrying.last_attempt_at)
+
+        # The signature is computed over the exact bytes that were sent
+        path, headers, body = next(request for request in self.endpoint.requests if request[0] == "/ok")
+        self.assertEqual(headers["X-Webhook-Signature"], sign_body(body, self.webhook_secret.get_secret()))
+        self.assertEqual(json.loads(body)["idempotency_key"], str(delivered.idempotency_key))
+        self.assertEqual(json.loads(body)["data"], {"test": "data"})
+
+        # Once attempts run out the delivery is marked as failed
+        retrying.next_attempt_at = timezone.now()
+        retrying.save()
+        call_command("run_webhook_dispatcher", "--drain", "--max-attempts", "2")
+        retrying.refresh_from_db()
+        self.assertEqual(retrying.status, WebhookDeliveryAttemptStatus.FAILURE)
+        self.assertEqual(retrying.attempt_count, 2)
+        self.assertIsNone(retrying.next_attempt_at)
+        self.assertEqual(len(self.endpoint.requests), 3)
+
+
+class CircuitBreakerTest(SimpleTestCase):
+    def setUp(self):
+        self.destination = f"https://{uuid.uuid4().hex}.example.com"
+
+    def tearDown(self):
+        webhook_circuit_breaker.reset(self.destination)
+
+    def end_cooldown(self):
+        webhook_circuit_breaker.get_redis_client().delete(webhook_circuit_breaker.key(self.destination, "open"))
+
+    def allowed(self):
+        return webhook_circuit_breaker.allow_request(self.destination)[0]
+
+    def test_opens_on_error_rate_and_closes_after_a_successful_probe(self):
+        for _ in range(5):
+            self.assertFalse(webhook_circuit_breaker.record_result(self.destination, True, 0.1))
+        for _ in range(4):
+            self.assertFalse(webhook_circuit_breaker.record_result(self.destination, False, 10))
+        self.assertEqual(webhook_circuit_breaker.allow_request(self.destination), (True, None))
+
+        # Half of the last 10 requests failed
+        self.assertTrue(webhook_circuit_breaker.record_result(self.destination, False, 10))
+        self.assertEqual(webhook_circuit_breaker.get_health(self.destination), {"requests": 10, "error_rate": 0.5, "p50_latency_ms": 100, "p95_latency_ms": 10000})
+        self.assertFalse(self.allowed())
+        self.assertGreater(webhook_circuit_breaker.seconds_until_retry(self.destination), 29)
+
+        # After the cooldown only one probe is let through, and when it fails the circuit opens for twice as long
+        self.end_cooldown()
+        allowed, probe_id = webhook_circuit_breaker.allow_request(self.destination)
+        self.assertTrue(allowed)
+        self.assertIsNotNone(probe_id)
+        self.assertFalse(self.allowed())
+        self.assertTrue(webhook_circuit_breaker.record_result(self.destination, False, 10, probe_id))
+        self.assertGreater(webhook_circuit_breaker.seconds_until_retry(self.destination), 59)
+
+        # A successful probe closes the circuit
+        self.end_cooldown()
+        allowed, probe_id = webhook_circuit_breaker.allow_request(self.destination)
+        self.assertFalse(webhook_circuit_breaker.record_result(self.destination, True, 0.1, probe_id))
+        self.assertEqual(webhook_circuit_breaker.allow_request(self.destination), (True, None))
+        self.assertTrue(self.allowed())
+        self.assertEqual(webhook_circuit_breaker.seconds_until_retry(self.destination), 0)
+
+    def test_only_the_probe_closes_or_reopens_the_circuit(self):
+        webhook_circuit_breaker.open(self.destination, 30)
+
+        # Requests that were in flight when the circuit opened finish afterwards
+        for _ in range(5):
+            self.assertFalse(webhook_circuit_breaker.record_result(self.destination, False, 10))
+        self.assertFalse(webhook_circuit_breaker.record_result(self.destination, True, 0.1))
+        self.assertLessEqual(webhook_circuit_breaker.seconds_until_retry(self.destination), 30)
+        self.assertEqual(webhook_circuit_breaker.get_health(self.destination)["requests"], 6)
+
+        # Nor do they count once the circuit is half open and a probe is in flight
+        self.end_cooldown()
+        allowed, probe_id = webhook_circuit_breaker.allow_request(self.destination)
+        self.assertTrue(allowed)
+        self.assertFalse(webhook_circuit_breaker.record_result(self.destination, True, 0.1))
+        self.assertFalse(webhook_circuit_breaker.record_result(self.destination, False, 10))
+        self.assertFalse(self.allowed())
+
+        self.assertTrue(webhook_circuit_breaker.record_result(self.destination, False, 10, probe_id))
+        seconds_until_retry = webhook_circuit_breaker.seconds_until_retry(self.destination)
+        self.assertGreater(seconds_until_retry, 59)
+        self.assertLessEqual(seconds_until_retry, 60)
@@ -0,0 +1,67 @@
+import threading
+import time
+
+from bots.models import Credentials
+
+
+class DeepgramClientCache:
+    """
+    Keeps each project's Deepgram API key, and a DeepgramClient built from it, for the lifetime of the
+    worker process, so transcription workers don't query and decrypt the project's credentials and
+    build a new client for every utterance. The SDK's sync REST client still opens a new HTTP
+    connection for every request, only run_transcription_worker keeps a pool of connections to Deepgram.
+
+    A cached entry is used as is for TTL_SECONDS. After that, the credentials' updated_at is
+    checked and the entry is only rebuilt if the credentials changed. Credentials.set_credentials
+    invalidates the entry right away in the process that called it; other processes pick up
+    the change once the TTL runs out.
+    """
+
+    TTL_SECONDS = 60
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # project_id -> (credentials version, api key, client or None if not built yet, time the version was last checked)
+        self.entries = {}
+
+    def get_entry(self, project_id):
+        with self.lock:
+            entry = self.entries.get(project_id)
+        if entry and time.monotonic() - entry[3] < self.TTL_SECONDS:
+            return entry
+
+        version = Credentials.objects.filter(project_id=project_id, credential_type=Credentials.CredentialTypes.DEEPGRAM).values_list("updated_at", flat=True).first()
+        if version is None:
+            raise Exception("Deepgram credentials record not found")
+
+        if entry and entry[0] == version:
+            entry = (version, entry[1], entry[2], time.monotonic())
+        else:
+            deepgram_credentials = Credentials.objects.get(project_id=project_id, credential_type=Credentials.CredentialTypes.DEEPGRAM).get_credentials()
+            if not deepgram_credentials:
+                raise Exception("Deepgram credentials not found")
+            entry = (version, deepgram_credentials["api_key"], None, time.monotonic())
+
+        with self.lock:
+            self.entries[project_id] = entry
+        return entry
+
+    def get_api_key(self, project_id):
+        return self.get_entry(project_id)[1]
+
+    def get_client(self, project_id):
+        from deepgram import DeepgramClient
+
+        version, api_key, client, checked_at = self.get_entry(project_id)
+        if client is None:
+            client = DeepgramClient(api_key)
+            with self.lock:
+                self.entries[project_id] = (version, api_key, client, checked_at)
+        return client
+
+    def invalidate(self, project_id):
+        with self.lock:
+            self.entries.pop(project_id, None)
+
+
+deepgram_client_cache = DeepgramClientCache()
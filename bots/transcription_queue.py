@@ -0,0 +1,34 @@
+import json
+import os
+
+import redis
+from django.conf import settings
+
+# The Redis list that run_transcription_worker takes work from when TRANSCRIPTION_WORKER is "async"
+TRANSCRIPTION_QUEUE_KEY = "transcription_queue"
+# Batches that failed and are waiting to be retried, scored by when they're due
+TRANSCRIPTION_RETRY_QUEUE_KEY = "transcription_queue:retry"
+# Each worker moves the batches it takes into a list of its own until they're done, and keeps a heartbeat key alive while it runs
+TRANSCRIPTION_PROCESSING_KEY_PREFIX = "transcription_queue:processing"
+TRANSCRIPTION_WORKER_HEARTBEAT_KEY_PREFIX = "transcription_queue:worker"
+
+redis_client = None
+
+
+def get_redis_url():
+    return os.getenv("REDIS_URL") + ("?ssl_cert_reqs=none" if os.getenv("DISABLE_REDIS_SSL") else "")
+
+
+def enqueue_utterances_for_transcription(recording_id, utterance_ids):
+    """Hands a batch of utterances from the same recording to whichever transcription worker is configured"""
+    global redis_client
+
+    if settings.TRANSCRIPTION_WORKER == "async":
+        if redis_client is None:
+            redis_client = redis.from_url(get_redis_url())
+        redis_client.lpush(TRANSCRIPTION_QUEUE_KEY, json.dumps({"recording_id": recording_id, "utterance_ids": utterance_ids}))
+        return
+
+    from bots.tasks.process_utterance_task import process_utterances
+
+    process_utterances.delay(recording_id, utterance_ids)
@@ -0,0 +1,66 @@
+import hashlib
+import json
+import logging
+
+import redis
+from django.conf import settings
+
+from bots.transcription_queue import get_redis_url
+
+logger = logging.getLogger(__name__)
+
+
+def hash_audio_file(audio_file):
+    """sha256 of the file's contents. The file is left at its start, so it can be read again."""
+    audio_hash = hashlib.sha256()
+    for block in iter(lambda: audio_file.read(1024 * 1024), b""):
+        audio_hash.update(block)
+    audio_file.seek(0)
+    return audio_hash.hexdigest()
+
+
+class TranscriptionResultsCache:
+    """
+    Remembers transcription results by the hash of the audio and the options it was transcribed with,
+    so a retried task or a duplicate submission doesn't call, and pay for, the transcription provider again.
+
+    Results are kept in Redis for settings.TRANSCRIPTION_RESULTS_CACHE_TTL_SECONDS, setting it to 0
+    turns the cache off. The cache is best effort: if Redis can't be reached, the provider is called as usual.
+    """
+
+    KEY_PREFIX = "transcription_result"
+
+    def __init__(self):
+        self.redis_client = None
+
+    def get_redis_client(self):
+        if self.redis_client is None:
+            self.redis_client = redis.from_url(get_redis_url())
+        return self.redis_client
+
+    def key(self, audio_sha256, options):
+        options_sha256 = hashlib.sha256(json.dumps(options, sort_keys=True).encode()).hexdigest()
+        return f"{self.KEY_PREFIX}:{audio_sha256}:{options_sha256}"
+
+    def get(self, key):
+        if settings.TRANSCRIPTION_RESULTS_CACHE_TTL_SECONDS <= 0:
+            return None
+        try:
+            cached_transcription = self.get_redis_client().get(key)
+        except redis.RedisError as e:
+            logger.warning(f"Error reading transcription results cache: {e}")
+            return None
+        if cached_transcription is None:
+            return None
+        return json.loads(cached_transcription)
+
+    def set(self, key, transcription):
+        if settings.TRANSCRIPTION_RESULTS_CACHE_TTL_SECONDS <= 0:
+            return
+        try:
+            self.get_redis_client().set(key, json.dumps(transcription), ex=settings.TRANSCRIPTION_RESULTS_CACHE_TTL_SECONDS)
+        except redis.RedisError as e:
+            logger.warning(f"Error writing transcription results cache: {e}")
+
+
+transcription_results_cache = TranscriptionResultsCache()
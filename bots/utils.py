@@ -51,6 +51,70 @@ def pcm_to_mp3(
     return mp3_data
 
 
+def pcm_to_flac(pcm_data: bytes, sample_rate: int = 32000, channels: int = 1, sample_width: int = 2) -> bytes:
+    """
+    Convert PCM audio data to FLAC format. FLAC is lossless, so this is a drop in replacement for PCM at about half the size for speech.
+
+    Args:
+        pcm_data (bytes): Raw PCM audio data
+        sample_rate (int): Sample rate in Hz (default: 32000)
+        channels (int): Number of audio channels (default: 1)
+        sample_width (int): Sample width in bytes (default: 2)
+
+    Returns:
+        bytes: FLAC encoded audio data
+    """
+    audio_segment = AudioSegment(
+        data=pcm_data,
+        sample_width=sample_width,
+        frame_rate=sample_rate,
+        channels=channels,
+    )
+
+    buffer = io.BytesIO()
+    audio_segment.export(buffer, format="flac")
+    flac_data = buffer.getvalue()
+    buffer.close()
+
+    return flac_data
+
+
+def pcm_to_opus(
+    pcm_data: bytes,
+    sample_rate: int = 32000,
+    channels: int = 1,
+    sample_width: int = 2,
+    bitrate: str = "24k",
+) -> bytes:
+    """
+    Convert PCM audio data to Opus in an Ogg container.
+
+    Args:
+        pcm_data (bytes): Raw PCM audio data
+        sample_rate (int): Sample rate in Hz (default: 32000)
+        channels (int): Number of audio channels (default: 1)
+        sample_width (int): Sample width in bytes (default: 2)
+        bitrate (str): Opus encoding bitrate (default: "24k", which is plenty for speech)
+
+    Returns:
+        bytes: Ogg Opus encoded audio data
+    """
+    audio_segment = AudioSegment(
+        data=pcm_data,
+        sample_width=sample_width,
+        frame_rate=sample_rate,
+        channels=channels,
+    )
+
+    buffer = io.BytesIO()
+    # Opus doesn't support 32kHz, so resample to 48kHz
+    audio_segment.export(buffer, format="ogg", codec="libopus", bitrate=bitrate, parameters=["-ar", "48000"])
+    opus_data = buffer.getvalue()
+    buffer.close()
+
+    return opus_data
+
+
 def mp3_to_pcm(mp3_data: bytes, sample_rate: int = 32000, channels: int = 1, sample_width: int = 2) -> bytes:
     """
     Convert MP3 audio data to PCM format.
@@ -121,6 +185,10 @@ def scale_i420(frame, frame_size, new_size):
     :return:           A bytes object with the scaled I420 frame.
     """
 
+    # Nothing to do if the frame is already the right size
+    if tuple(frame_size) == tuple(new_size):
+        return bytes(frame)
+
     # 1) Unpack source / destination dimensions
     orig_width, orig_height = frame_size
     new_width, new_height = new_size
@@ -215,6 +283,151 @@ def scale_i420(frame, frame_size, new_size):
     return np.concatenate([final_y.flatten(), final_u.flatten(), final_v.flatten()]).astype(np.uint8).tobytes()
 
 
+class I420Canvas:
+    """
+    A preallocated I420 output frame of a fixed size, with the letterbox/pillarbox
+    geometry for one source size precomputed. The black background is painted once,
+    and every scaled frame is resized directly into the views of the canvas.
+    """
+
+    def __init__(self, frame_size, new_size):
+        orig_width, orig_height = frame_size
+        new_width, new_height = new_size
+
+        input_aspect = orig_width / orig_height
+        output_aspect = new_width / new_height
+
+        # Same geometry as scale_i420
+        if abs(input_aspect - output_aspect) < 1e-6:
+            scaled_width, scaled_height = new_width, new_height
+        elif input_aspect > output_aspect:
+            scaled_width = new_width
+            scaled_height = int(round(new_width / input_aspect))
+        else:
+            scaled_height = new_height
+            scaled_width = int(round(new_height * input_aspect))
+
+        y_plane_size = new_width * new_height
+        uv_plane_size = half_ceil(new_width) * half_ceil(new_height)
+
+        # Black is Y=0, U=128, V=128
+        self.buffer = np.empty(y_plane_size + 2 * uv_plane_size, dtype=np.uint8)
+        self.buffer[:y_plane_size] = 0
+        self.buffer[y_plane_size:] = 128
+
+        final_y = self.buffer[:y_plane_size].reshape(new_height, new_width)
+        final_u = self.buffer[y_plane_size : y_plane_size + uv_plane_size].reshape(half_ceil(new_height), half_ceil(new_width))
+        final_v = self.buffer[y_plane_size + uv_plane_size :].reshape(half_ceil(new_height), half_ceil(new_width))
+
+        offset_y = (new_height - scaled_height) // 2
+        offset_x = (new_width - scaled_width) // 2
+        offset_y_uv = offset_y // 2
+        offset_x_uv = offset_x // 2
+        scaled_uv_width = half_ceil(scaled_width)
+        scaled_uv_height = half_ceil(scaled_height)
+
+        self.y_size = (scaled_width, scaled_height)
+        self.uv_size = (scaled_uv_width, scaled_uv_height)
+
+        # For an exact 2x downscale, INTER_AREA takes a faster path in OpenCV (a 2x2 box average) and produces the same output as INTER_LINEAR
+        self.is_downscale_2x = (2 * scaled_width, 2 * scaled_height) == (orig_width, orig_height)
+        self.y_interpolation = cv2.INTER_AREA if self.is_downscale_2x else cv2.INTER_LINEAR
+        self.uv_interpolation = cv2.INTER_AREA if (2 * scaled_uv_width, 2 * scaled_uv_height) == (half_ceil(orig_width), half_ceil(orig_height)) else cv2.INTER_LINEAR
+        self.y_view = final_y[offset_y : offset_y + scaled_height, offset_x : offset_x + scaled_width]
+        self.u_view = final_u[offset_y_uv : offset_y_uv + scaled_uv_height, offset_x_uv : offset_x_uv + scaled_uv_width]
+        self.v_view = final_v[offset_y_uv : offset_y_uv + scaled_uv_height, offset_x_uv : offset_x_uv + scaled_uv_width]
+        self.memoryview = memoryview(self.buffer)
+
+
+class I420Scaler:
+    """
+    Produces the same output as scale_i420, but resizes into a cached I420Canvas
+    instead of allocating new planes for every frame. Canvases are keyed by
+    (frame_size, new_size), so a stream whose resolution changes only pays the
+    allocation cost once per distinct size.
+
+    The returned memoryview points into the canvas and is overwritten by the next call
+    with the same sizes, so callers must consume or copy it before scaling again. The one
+    exception is a packed frame that is already the output size, which is returned as a
+    view of the original buffer. A scaler is not thread safe; use one per thread that
+    scales frames.
+
+    path_counts records how often each path was taken:
+      passthrough: packed frame already the output size, returned untouched
+      copy: separate planes already the output size, copied into the canvas
+      downscale_2x: exact 2x downscale, resized with INTER_AREA
+      resize: everything else
+    """
+
+    MAX_CANVASES = 8
+    PATHS = ("passthrough", "copy", "downscale_2x", "resize")
+
+    def __init__(self):
+        self.canvases = {}
+        self.path_counts = dict.fromkeys(self.PATHS, 0)
+
+    def get_canvas(self, frame_size, new_size):
+        key = (tuple(frame_size), tuple(new_size))
+        canvas = self.canvases.get(key)
+        if canvas is None:
+            # Evict the oldest canvas so a stream that cycles through many sizes can't grow this unbounded
+            if len(self.canvases) >= self.MAX_CANVASES:
+                del self.canvases[next(iter(self.canvases))]
+            canvas = I420Canvas(frame_size, new_size)
+            self.canvases[key] = canvas
+        return canvas
+
+    def scale(self, frame, frame_size, new_size):
+        """
+        Scales a packed I420 frame (any object supporting the buffer protocol).
+
+        :return: A memoryview of the scaled I420 frame.
+        """
+        orig_width, orig_height = frame_size
+        y_plane_size = orig_width * orig_height
+        uv_plane_size = half_ceil(orig_width) * half_ceil(orig_height)
+
+        if tuple(frame_size) == tuple(new_size):
+            self.path_counts["passthrough"] += 1
+            return memoryview(frame).cast("B")[: y_plane_size + 2 * uv_plane_size]
+
+        y = np.frombuffer(frame, dtype=np.uint8, count=y_plane_size)
+        u = np.frombuffer(frame, dtype=np.uint8, count=uv_plane_size, offset=y_plane_size)
+        v = np.frombuffer(frame, dtype=np.uint8, count=uv_plane_size, offset=y_plane_size + uv_plane_size)
+
+        return self.scale_planes(y, u, v, frame_size, new_size)
+
+    def scale_planes(self, y_buffer, u_buffer, v_buffer, frame_size, new_size):
+        """
+        Scales an I420 frame whose Y, U and V planes are in separate buffers.
+
+        :return: A memoryview of the scaled I420 frame.
+        """
+        orig_width, orig_height = frame_size
+        orig_chroma_width = half_ceil(orig_width)
+        orig_chroma_height = half_ceil(orig_height)
+
+        y = np.frombuffer(y_buffer, dtype=np.uint8, count=orig_width * orig_height).reshape(orig_height, orig_width)
+        u = np.frombuffer(u_buffer, dtype=np.uint8, count=orig_chroma_width * orig_chroma_height).reshape(orig_chroma_height, orig_chroma_width)
+        v = np.frombuffer(v_buffer, dtype=np.uint8, count=orig_chroma_width * orig_chroma_height).reshape(orig_chroma_height, orig_chroma_width)
+
+        canvas = self.get_canvas(frame_size, new_size)
+
+        if tuple(frame_size) == tuple(new_size):
+            self.path_counts["copy"] += 1
+            canvas.y_view[:] = y
+            canvas.u_view[:] = u
+            canvas.v_view[:] = v
+            return canvas.memoryview
+
+        self.path_counts["downscale_2x" if canvas.is_downscale_2x else "resize"] += 1
+        cv2.resize(y, canvas.y_size, dst=canvas.y_view, interpolation=canvas.y_interpolation)
+        cv2.resize(u, canvas.uv_size, dst=canvas.u_view, interpolation=canvas.uv_interpolation)
+        cv2.resize(v, canvas.uv_size, dst=canvas.v_view, interpolation=canvas.uv_interpolation)
+
+        return canvas.memoryview
+
+
 def png_to_yuv420_frame(png_bytes: bytes) -> tuple:
     """
     Convert PNG image bytes to YUV420 (I420) format without resizing,
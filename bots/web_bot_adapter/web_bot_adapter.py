@@ -15,8 +15,9 @@ from websockets.sync.server import serve
 
 from bots.bot_adapter import BotAdapter
 from bots.bot_controller.automatic_leave_configuration import AutomaticLeaveConfiguration
+from bots.bot_controller.video_frame_processor import VideoFrameProcessor
 from bots.models import RecordingViews
-from bots.utils import half_ceil, scale_i420
+from bots.utils import half_ceil
 
 from .debug_screen_recorder import DebugScreenRecorder
 from .ui_methods import UiRequestToJoinDeniedException, UiRetryableException, UiRetryableExpectedException
@@ -39,6 +40,8 @@ class WebBotAdapter(BotAdapter):
         automatic_leave_configuration: AutomaticLeaveConfiguration,
         recording_view: RecordingViews,
         should_create_debug_recording: bool,
+        video_frame_size=(1920, 1080),
+        send_video=True,
     ):
         self.display_name = display_name
         self.send_message_callback = send_message_callback
@@ -48,10 +51,15 @@ class WebBotAdapter(BotAdapter):
         self.add_encoded_mp4_chunk_callback = add_encoded_mp4_chunk_callback
         self.upsert_caption_callback = upsert_caption_callback
         self.recording_view = recording_view
+        # When false, the payload doesn't send or record any video, because the bot is only recording audio
+        self.send_video = send_video
 
         self.meeting_url = meeting_url
 
-        self.video_frame_size = (1920, 1080)
+        self.video_frame_size = video_frame_size
+        self.display_size = (1920, 1080)
+        # Scale frames off the websocket thread. Adapters that record via MediaRecorder don't receive raw frames.
+        self.video_frame_processor = VideoFrameProcessor(output_callback=add_video_frame_callback, output_size=self.video_frame_size) if add_video_frame_callback and send_video else None
 
         self.driver = None
 
@@ -116,15 +124,15 @@ class WebBotAdapter(BotAdapter):
                 logger.info(f"video dimensions {width} {height} message length {len(message) - offset - 8}")
             self.video_frame_ticker += 1
 
-            # Scale frame to 1920x1080
+            # Scale frame to the recording resolution
             expected_video_data_length = width * height + 2 * half_ceil(width) * half_ceil(height)
-            video_data = np.frombuffer(message[offset + 8 :], dtype=np.uint8)
+            # View the frame in place; frames that are already the recording resolution are passed through without a copy
+            video_data = np.frombuffer(message, dtype=np.uint8, offset=offset + 8)
 
             # Check if len(video_data) does not agree with width and height
             if len(video_data) == expected_video_data_length:  # I420 format uses 1.5 bytes per pixel
-                scaled_i420_frame = scale_i420(video_data, (width, height), (1920, 1080))
-                if self.wants_any_video_frames_callback() and self.send_frames:
-                    self.add_video_frame_callback(scaled_i420_frame, timestamp * 1000)
+                if self.video_frame_processor and self.wants_any_video_frames_callback() and self.send_frames:
+                    self.video_frame_processor.add_frame(video_data, (width, height), timestamp * 1000)
 
             else:
                 logger.info(f"video data length does not agree with width and height {len(video_data)} {width} {height}")
@@ -308,7 +316,7 @@ class WebBotAdapter(BotAdapter):
         self.driver = webdriver.Chrome(options=options)
         logger.info(f"web driver server initialized at port {self.driver.service.port}")
 
-        initial_data_code = f"window.initialData = {{websocketPort: {self.websocket_port}, addClickRipple: {'true' if self.should_create_debug_recording else 'false'}, recordingView: '{self.recording_view}'}}"
+        initial_data_code = f"window.initialData = {{websocketPort: {self.websocket_port}, addClickRipple: {'true' if self.should_create_debug_recording else 'false'}, recordingView: '{self.recording_view}', sendVideo: {'true' if self.send_video else 'false'}}}"
 
         # Define the CDN libraries needed
         CDN_LIBRARIES = ["https://cdnjs.cloudflare.com/ajax/libs/protobufjs/7.4.0/protobuf.min.js", "https://cdnjs.cloudflare.com/ajax/libs/pako/2.1.0/pako.min.js"]
@@ -342,12 +350,12 @@ class WebBotAdapter(BotAdapter):
         display_var_for_debug_recording = os.environ.get("DISPLAY")
         if os.environ.get("DISPLAY") is None:
             # Create virtual display only if no real display is available
-            display = Display(visible=0, size=(1920, 1080))
+            display = Display(visible=0, size=self.display_size)
             display.start()
             display_var_for_debug_recording = display.new_display_var
 
         if self.should_create_debug_recording:
-            self.debug_screen_recorder = DebugScreenRecorder(display_var_for_debug_recording, self.video_frame_size, BotAdapter.DEBUG_RECORDING_FILE_PATH)
+            self.debug_screen_recorder = DebugScreenRecorder(display_var_for_debug_recording, self.display_size, BotAdapter.DEBUG_RECORDING_FILE_PATH)
             self.debug_screen_recorder.start()
 
         # Start websocket server in a separate thread
@@ -468,6 +476,9 @@ class WebBotAdapter(BotAdapter):
             except Exception as e:
                 logger.info(f"Error shutting down websocket server: {e}")
 
+        if self.video_frame_processor:
+            self.video_frame_processor.cleanup()
+
         self.cleaned_up = True
 
     def get_first_buffer_timestamp_ms_offset(self):
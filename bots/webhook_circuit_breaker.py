@@ -0,0 +1,160 @@
+import logging
+import uuid
+from urllib.parse import urlsplit
+
+import redis
+
+from bots.transcription_queue import get_redis_url
+
+logger = logging.getLogger(__name__)
+
+
+def webhook_destination(url):
+    parsed_url = urlsplit(url)
+    return f"{parsed_url.scheme}://{parsed_url.netloc}"
+
+
+def is_healthy_response(status_code):
+    """Network errors (no status code), 5xx and 429 responses mean the destination is struggling. Other error responses come from a working endpoint."""
+    return status_code is not None and status_code < 500 and status_code != 429
+
+
+class CircuitBreaker:
+    """
+    Tracks how each webhook destination has been behaving and stops sending to the ones that are down.
+    The state is kept in Redis, so every Celery worker and webhook dispatcher sees the same health for
+    a destination and they stop, and resume, together.
+
+    The outcomes and latencies of the last WINDOW_SIZE requests to a destination are kept. Once at least
+    MIN_REQUESTS of them have been made and ERROR_RATE_THRESHOLD of them failed, the circuit opens and
+    nothing is sent to the destination for COOLDOWN_SECONDS. After that it's half open: a single probe
+    request is let through. If the probe succeeds the circuit closes, and if it fails the circuit opens
+    again for twice as long as before, up to MAX_COOLDOWN_SECONDS.
+
+    The breaker is best effort: if Redis can't be reached, requests are sent as if the circuit were closed.
+    """
+
+    KEY_PREFIX = "webhook_circuit"
+    WINDOW_SIZE = 50
+    MIN_REQUESTS = 10
+    ERROR_RATE_THRESHOLD = 0.5
+    COOLDOWN_SECONDS = 30
+    MAX_COOLDOWN_SECONDS = 600
+    # How long a probe may take before another one is let through
+    PROBE_TIMEOUT_SECONDS = 30
+    # Health of destinations that haven't been sent to for this long is forgotten
+    STATE_TTL_SECONDS = 24 * 60 * 60
+
+    def __init__(self):
+        self.redis_client = None
+
+    def get_redis_client(self):
+        if self.redis_client is None:
+            self.redis_client = redis.from_url(get_redis_url())
+        return self.redis_client
+
+    def key(self, destination, name):
+        return f"{self.KEY_PREFIX}:{destination}:{name}"
+
+    def seconds_until_retry(self, destination):
+        """How long to wait before sending to the destination, 0 if a request can be sent now"""
+        try:
+            pipeline = self.get_redis_client().pipeline()
+            pipeline.pttl(self.key(destination, "open"))
+            pipeline.exists(self.key(destination, "cooldown"))
+            pipeline.pttl(self.key(destination, "probe"))
+            open_ms, half_open, probe_ms = pipeline.execute()
+        except redis.RedisError as e:
+            logger.warning(f"Error reading webhook circuit breaker: {e}")
+            return 0
+        if open_ms > 0:
+            return open_ms / 1000
+        if half_open and probe_ms > 0:
+            return probe_ms / 1000
+        return 0
+
+    def allow_request(self, destination):
+        """
+        Returns whether a request may be sent to the destination now, and a probe id if the circuit is
+        half open and the caller's request is the probe. The probe id has to be passed to record_result.
+        """
+        try:
+            redis_client = self.get_redis_client()
+            if redis_client.exists(self.key(destination, "open")):
+                return False, None
+            if not redis_client.exists(self.key(destination, "cooldown")):
+                return True, None
+            probe_id = uuid.uuid4().hex
+            if redis_client.set(self.key(destination, "probe"), probe_id, nx=True, ex=self.PROBE_TIMEOUT_SECONDS):
+                return True, probe_id
+            return False, None
+        except redis.RedisError as e:
+            logger.warning(f"Error reading webhook circuit breaker: {e}")
+            return True, None
+
+    def record_result(self, destination, succeeded, latency_seconds, probe_id=None):
+        """
+        Records the outcome of a request to the destination. Only the probe, identified by the probe id
+        allow_request returned for it, closes or reopens a half open circuit. Returns True if this opened the circuit.
+        """
+        outcomes_key = self.key(destination, "outcomes")
+        try:
+            redis_client = self.get_redis_client()
+            pipeline = redis_client.pipeline()
+            pipeline.lpush(outcomes_key, f"{int(succeeded)}:{round(latency_seconds * 1000)}")
+            pipeline.ltrim(outcomes_key, 0, self.WINDOW_SIZE - 1)
+            pipeline.expire(outcomes_key, self.STATE_TTL_SECONDS)
+            pipeline.get(self.key(destination, "cooldown"))
+            pipeline.get(self.key(destination, "probe"))
+            cooldown, current_probe_id = pipeline.execute()[-2:]
+
+            # Requests that were already in flight when the circuit opened only count towards its health
+            if cooldown is not None:
+                if probe_id is None or current_probe_id != probe_id.encode():
+                    return False
+                if succeeded:
+                    redis_client.delete(self.key(destination, "cooldown"), self.key(destination, "probe"), outcomes_key)
+                    logger.info(f"Webhook circuit breaker for {destination} closed")
+                    return False
+                self.open(destination, min(self.MAX_COOLDOWN_SECONDS, int(cooldown) * 2))
+                return True
+
+            if succeeded:
+                return False
+            health = self.get_health(destination)
+            if health["requests"] >= self.MIN_REQUESTS and health["error_rate"] >= self.ERROR_RATE_THRESHOLD:
+                logger.warning(f"Webhook circuit breaker for {destination} opened, {health}")
+                self.open(destination, self.COOLDOWN_SECONDS)
+                return True
+            return False
+        except redis.RedisError as e:
+            logger.warning(f"Error writing webhook circuit breaker: {e}")
+            return False
+
+    def open(self, destination, cooldown_seconds):
+        pipeline = self.get_redis_client().pipeline()
+        pipeline.set(self.key(destination, "open"), 1, ex=cooldown_seconds)
+        pipeline.set(self.key(destination, "cooldown"), cooldown_seconds, ex=self.STATE_TTL_SECONDS)
+        pipeline.delete(self.key(destination, "probe"))
+        pipeline.execute()
+
+    def reset(self, destination):
+        """Forgets the destination's health and closes its circuit"""
+        self.get_redis_client().delete(*[self.key(destination, name) for name in ["outcomes", "open", "cooldown", "probe"]])
+
+    def get_health(self, destination):
+        """Error rate and latency percentiles of the last WINDOW_SIZE requests to the destination"""
+        outcomes = [outcome.decode().split(":") for outcome in self.get_redis_client().lrange(self.key(destination, "outcomes"), 0, -1)]
+        if not outcomes:
+            return {"requests": 0, "error_rate": 0, "p50_latency_ms": None, "p95_latency_ms": None}
+
+        latencies = sorted(int(latency_ms) for _, latency_ms in outcomes)
+        return {
+            "requests": len(outcomes),
+            "error_rate": round(sum(1 for succeeded, _ in outcomes if succeeded == "0") / len(outcomes), 3),
+            "p50_latency_ms": latencies[int(0.5 * (len(latencies) - 1))],
+            "p95_latency_ms": latencies[int(0.95 * (len(latencies) - 1))],
+        }
+
+
+webhook_circuit_breaker = CircuitBreaker()
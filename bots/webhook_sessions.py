@@ -0,0 +1,98 @@
+import logging
+import threading
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+
+class WebhookSessionPool:
+    """
+    Keeps a requests.Session per destination host for the lifetime of the worker process, so
+    consecutive webhooks to the same endpoint reuse a kept-alive connection instead of paying for
+    DNS, TCP and TLS setup every time.
+
+    Each session holds at most pool_maxsize connections, and sessions for the least recently used
+    hosts are closed once there are more than max_hosts of them. How often connections were reused
+    is logged every METRICS_LOG_INTERVAL requests.
+    """
+
+    METRICS_LOG_INTERVAL = 100
+
+    def __init__(self, *, pool_maxsize=4, max_hosts=100):
+        self.pool_maxsize = pool_maxsize
+        self.max_hosts = max_hosts
+        self.lock = threading.Lock()
+        self.sessions = OrderedDict()
+
+        # Counts for the hosts whose sessions have been closed, so the metrics cover the whole process
+        self.closed_sessions_requests = 0
+        self.closed_sessions_connections = 0
+        self.posts = 0
+
+    def get_session(self, url):
+        parsed_url = urlsplit(url)
+        host = f"{parsed_url.scheme}://{parsed_url.netloc}"
+
+        with self.lock:
+            session = self.sessions.get(host)
+            if session:
+                self.sessions.move_to_end(host)
+                return session
+
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            self.sessions[host] = session
+
+            if len(self.sessions) > self.max_hosts:
+                _, least_recently_used_session = self.sessions.popitem(last=False)
+                self.close_session(least_recently_used_session)
+        return session
+
+    def post(self, url, **kwargs):
+        try:
+            return self.get_session(url).post(url, **kwargs)
+        finally:
+            self.posts += 1
+            if self.posts % self.METRICS_LOG_INTERVAL == 0:
+                logger.info(f"Webhook connection metrics: {self.get_metrics()}")
+
+    def connection_pools(self, session):
+        # http:// and https:// are mounted to the same adapter, so it's only counted once
+        for adapter in {id(adapter): adapter for adapter in session.adapters.values()}.values():
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool:
+                    yield pool
+
+    def close_session(self, session):
+        for pool in self.connection_pools(session):
+            self.closed_sessions_requests += pool.num_requests
+            self.closed_sessions_connections += pool.num_connections
+        session.close()
+
+    def get_metrics(self):
+        with self.lock:
+            sessions = list(self.sessions.values())
+            num_requests = self.closed_sessions_requests
+            num_connections = self.closed_sessions_connections
+        for session in sessions:
+            for pool in self.connection_pools(session):
+                num_requests += pool.num_requests
+                num_connections += pool.num_connections
+
+        return {
+            "hosts": len(sessions),
+            "requests": num_requests,
+            "connections_opened": num_connections,
+            "connection_reuse_rate": round(1 - num_connections / num_requests, 3) if num_requests else None,
+        }
+
+
+webhook_session_pool = WebhookSessionPool()
@@ -3,52 +3,202 @@ import hashlib
 import hmac
 import json
 import logging
+import threading
+import time
 import uuid
 
+from celery import group
+from django.conf import settings
+from django.db import transaction
+
 logger = logging.getLogger(__name__)
 
 
+class WebhookSubscriptionIndex:
+    """
+    Caches the ids of each project's active webhook subscriptions by trigger type, so triggering a
+    webhook doesn't have to search the subscriptions' triggers JSON every time a bot changes state.
+
+    A project's index is reloaded after TTL_SECONDS. Saving or deleting a WebhookSubscription
+    invalidates it right away in the process that did it; other processes pick up the change once
+    the TTL runs out. Until then their index can still hold subscriptions that were deactivated or
+    deleted, so it's only a prefilter: trigger_webhook checks the ids against the database before
+    creating delivery attempts for them.
+    """
+
+    TTL_SECONDS = 30
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # project_id -> (trigger type -> subscription ids, time the index was loaded)
+        self.entries = {}
+
+    def get_subscription_ids(self, project_id, webhook_trigger_type):
+        from bots.models import WebhookSubscription
+
+        with self.lock:
+            entry = self.entries.get(project_id)
+        if entry is None or time.monotonic() - entry[1] >= self.TTL_SECONDS:
+            subscription_ids_by_trigger = {}
+            for subscription_id, triggers in WebhookSubscription.objects.filter(project_id=project_id, is_active=True).values_list("id", "triggers"):
+                for trigger in triggers:
+                    subscription_ids_by_trigger.setdefault(trigger, []).append(subscription_id)
+            entry = (subscription_ids_by_trigger, time.monotonic())
+            with self.lock:
+                self.entries[project_id] = entry
+        return entry[0].get(webhook_trigger_type, [])
+
+    def invalidate(self, project_id):
+        with self.lock:
+            self.entries.pop(project_id, None)
+
+
+webhook_subscription_index = WebhookSubscriptionIndex()
+
+
+class WebhookSecretCache:
+    """
+    Keeps each project's decrypted webhook signing secret for the lifetime of the worker process, so
+    delivering a webhook doesn't query and decrypt the project's newest WebhookSecret every time.
+
+    A cached secret is used as is for TTL_SECONDS. After that, the id and updated_at of the project's
+    newest secret are checked and it's only decrypted again if the secret was rotated. Saving or deleting
+    a WebhookSecret invalidates the entry right away in the process that did it; other processes pick up
+    the rotation once the TTL runs out.
+    """
+
+    TTL_SECONDS = 30
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # project_id -> (secret version, decrypted secret, time the version was last checked)
+        self.entries = {}
+
+    def get_secret(self, project_id):
+        from bots.models import WebhookSecret
+
+        with self.lock:
+            entry = self.entries.get(project_id)
+        if entry and time.monotonic() - entry[2] < self.TTL_SECONDS:
+            return entry[1]
+
+        version = WebhookSecret.objects.filter(project_id=project_id).order_by("-created_at").values_list("id", "updated_at").first()
+        if version is None:
+            raise Exception("Webhook secret not found")
+
+        if entry and entry[0] == version:
+            entry = (version, entry[1], time.monotonic())
+        else:
+            entry = (version, WebhookSecret.objects.get(id=version[0]).get_secret(), time.monotonic())
+
+        with self.lock:
+            self.entries[project_id] = entry
+        return entry[1]
+
+    def invalidate(self, project_id):
+        with self.lock:
+            self.entries.pop(project_id, None)
+
+
+webhook_secret_cache = WebhookSecretCache()
+
+
 def trigger_webhook(webhook_trigger_type, bot, payload):
     """
     Trigger a webhook for a given event.
     """
-    from bots.models import WebhookDeliveryAttempt
+    from bots.models import WebhookDeliveryAttempt, WebhookSubscription
+    from bots.tasks.deliver_webhook_task import deliver_webhook
+
+    cached_subscription_ids = webhook_subscription_index.get_subscription_ids(bot.project_id, webhook_trigger_type)
+    if not cached_subscription_ids:
+        return 0
 
-    subscriptions = bot.project.webhook_subscriptions.filter(triggers__contains=[webhook_trigger_type], is_active=True)
+    # Another process may have deleted or deactivated a subscription since the index was loaded. A delivery
+    # attempt for a deleted subscription would fail the foreign key check and roll back the caller's transaction.
+    subscription_ids = list(WebhookSubscription.objects.filter(id__in=cached_subscription_ids, is_active=True).values_list("id", flat=True))
+    if len(subscription_ids) != len(cached_subscription_ids):
+        webhook_subscription_index.invalidate(bot.project_id)
+    if not subscription_ids:
+        return 0
 
-    delivery_attempts = []
-    for subscription in subscriptions:
-        # Create a webhook delivery attempt record
-        delivery_attempt = WebhookDeliveryAttempt.objects.create(
-            webhook_subscription=subscription,
-            webhook_trigger_type=webhook_trigger_type,
-            idempotency_key=uuid.uuid4(),
-            bot=bot,
-            payload=payload,
-        )
-        delivery_attempts.append(delivery_attempt)
+    # Create a webhook delivery attempt record for each subscription in a single query
+    delivery_attempts = WebhookDeliveryAttempt.objects.bulk_create(
+        [
+            WebhookDeliveryAttempt(
+                webhook_subscription_id=subscription_id,
+                webhook_trigger_type=webhook_trigger_type,
+                idempotency_key=uuid.uuid4(),
+                bot=bot,
+                payload=payload,
+            )
+            for subscription_id in subscription_ids
+        ]
+    )
+    delivery_attempt_ids = [delivery_attempt.id for delivery_attempt in delivery_attempts]
 
-        from bots.tasks.deliver_webhook_task import deliver_webhook
+    # The run_webhook_dispatcher command picks up pending delivery attempts from the database by itself
+    if settings.WEBHOOK_DISPATCHER == "async":
+        return len(delivery_attempts)
 
-        deliver_webhook.delay(delivery_attempt.id)
+    # This is usually called inside a transaction, so wait for it to commit before enqueuing the deliveries,
+    # otherwise a worker can pick one up before its delivery attempt exists
+    transaction.on_commit(lambda: group(deliver_webhook.s(delivery_attempt_id) for delivery_attempt_id in delivery_attempt_ids).apply_async())
 
     return len(delivery_attempts)
 
 
-def sign_payload(payload, secret):
+def get_webhook_request(delivery):
     """
-    Sign a webhook payload using HMAC-SHA256. Returns a base64-encoded HMAC-SHA256 signature
+    Returns the body and headers of the request that delivers a webhook delivery attempt. The body is
+    the canonical JSON the signature is computed over, so it has to be sent as is.
     """
-    # Convert the payload to a canonical JSON string
-    payload_json = json.dumps(payload, sort_keys=True, separators=(",", ":"))
+    from bots.models import WebhookTriggerTypes
+
+    # Prepare the webhook payload
+    webhook_data = {
+        "idempotency_key": str(delivery.idempotency_key),
+        "bot_id": delivery.bot.object_id if delivery.bot else None,
+        "trigger": WebhookTriggerTypes.trigger_type_to_api_code(delivery.webhook_trigger_type),
+        "data": delivery.payload,
+    }
+
+    # Serialize and sign the payload once
+    body = canonical_json(webhook_data)
+    signature = sign_body(body, webhook_secret_cache.get_secret(delivery.webhook_subscription.project_id))
 
-    # Create the signature
-    signature = hmac.new(secret, payload_json.encode("utf-8"), hashlib.sha256).digest()
+    headers = {
+        "Content-Type": "application/json",
+        "User-Agent": "Attendee-Webhook/1.0",
+        "X-Webhook-Signature": signature,
+    }
+    return body, headers
+
+
+def canonical_json(payload):
+    """
+    Serialize a webhook payload the way it's signed and sent: sorted keys and no whitespace, UTF-8 encoded.
+    """
+    return json.dumps(payload, sort_keys=True, separators=(",", ":")).encode("utf-8")
+
+
+def sign_body(body, secret):
+    """
+    Sign a serialized webhook body using HMAC-SHA256. Returns a base64-encoded HMAC-SHA256 signature
+    """
+    signature = hmac.new(secret, body, hashlib.sha256).digest()
 
     # Return base64 encoded signature
     return base64.b64encode(signature).decode("utf-8")
 
 
+def sign_payload(payload, secret):
+    """
+    Sign a webhook payload using HMAC-SHA256. Returns a base64-encoded HMAC-SHA256 signature
+    """
+    return sign_body(canonical_json(payload), secret)
+
+
 def verify_signature(payload, signature, secret):
     """
     Verify a webhook signature. Not used in production, but useful for testing.
@@ -1,11 +1,12 @@
 import logging
 import time
 
-import cv2
 import numpy as np
 import zoom_meeting_sdk as zoom
 from gi.repository import GLib
 
+from bots.bot_controller.video_frame_processor import VideoFrameProcessor
+
 logger = logging.getLogger(__name__)
 
 
@@ -29,97 +30,6 @@ def create_black_i420_frame(video_frame_size):
     return yuv_frame.astype(np.uint8).tobytes()
 
 
-def scale_i420(frame, new_size):
-    new_width, new_height = new_size
-    """
-    Scales the given frame in I420 format to new_width x new_height while
-    preserving aspect ratio. If the aspect ratios do not match, letterboxes/pillarboxes
-    the scaled image on a black background.
-    
-    :param frame: Frame object with methods:
-        - GetStreamWidth()
-        - GetStreamHeight()
-        - GetYBuffer()
-        - GetUBuffer()
-        - GetVBuffer()
-    :param new_width: Desired width.
-    :param new_height: Desired height.
-    :return: Scaled (and possibly letter/pillarboxed) I420 frame bytes.
-    """
-    orig_width = frame.GetStreamWidth()
-    orig_height = frame.GetStreamHeight()
-
-    # 1) Convert buffers to NumPy arrays without extra copies if possible.
-    y = np.frombuffer(frame.GetYBuffer(), dtype=np.uint8, count=orig_width * orig_height)
-    u = np.frombuffer(frame.GetUBuffer(), dtype=np.uint8, count=(orig_width // 2) * (orig_height // 2))
-    v = np.frombuffer(frame.GetVBuffer(), dtype=np.uint8, count=(orig_width // 2) * (orig_height // 2))
-
-    # Reshape planes
-    y = y.reshape(orig_height, orig_width)
-    u = u.reshape(orig_height // 2, orig_width // 2)
-    v = v.reshape(orig_height // 2, orig_width // 2)
-
-    # 2) Determine scale preserving aspect ratio
-    input_aspect = orig_width / orig_height
-    output_aspect = new_width / new_height
-
-    if abs(input_aspect - output_aspect) < 1e-6:
-        # Aspect ratios match (or extremely close). Just do a simple stretch to (new_width, new_height).
-        scaled_y = cv2.resize(y, (new_width, new_height), interpolation=cv2.INTER_LINEAR)
-        scaled_u = cv2.resize(u, (new_width // 2, new_height // 2), interpolation=cv2.INTER_LINEAR)
-        scaled_v = cv2.resize(v, (new_width // 2, new_height // 2), interpolation=cv2.INTER_LINEAR)
-
-        # Flatten and return
-        return np.concatenate([scaled_y.flatten(), scaled_u.flatten(), scaled_v.flatten()]).astype(np.uint8).tobytes()
-
-    # Otherwise, the aspect ratios differ => letterbox or pillarbox
-    # 3) Compute scaled dimensions that fit entirely within (new_width, new_height)
-    if input_aspect > output_aspect:
-        # The image is relatively wider => match width, shrink height
-        scaled_width = new_width
-        scaled_height = int(round(new_width / input_aspect))
-    else:
-        # The image is relatively taller => match height, shrink width
-        scaled_height = new_height
-        scaled_width = int(round(new_height * input_aspect))
-
-    # 4) Resize Y, U, and V to the scaled dimensions
-    scaled_y = cv2.resize(y, (scaled_width, scaled_height), interpolation=cv2.INTER_LINEAR)
-    scaled_u = cv2.resize(u, (scaled_width // 2, scaled_height // 2), interpolation=cv2.INTER_LINEAR)
-    scaled_v = cv2.resize(v, (scaled_width // 2, scaled_height // 2), interpolation=cv2.INTER_LINEAR)
-
-    # 5) Create the black background only if needed
-    # For I420, black is typically (Y=0, U=128, V=128) or (Y=16, U=128, V=128).
-    # We'll use Y=0, U=128, V=128 for "dark" black.
-    final_y = np.zeros((new_height, new_width), dtype=np.uint8)
-    final_u = np.full((new_height // 2, new_width // 2), 128, dtype=np.uint8)
-    final_v = np.full((new_height // 2, new_width // 2), 128, dtype=np.uint8)
-
-    # 6) Compute centering offsets for each plane
-    # For Y-plane
-    offset_y = (new_height - scaled_height) // 2
-    offset_x = (new_width - scaled_width) // 2
-
-    # Insert Y
-    final_y[offset_y : offset_y + scaled_height, offset_x : offset_x + scaled_width] = scaled_y
-
-    # For U, V planes (subsampled by 2 in each dimension)
-    offset_y_uv = offset_y // 2
-    offset_x_uv = offset_x // 2
-
-    final_u[
-        offset_y_uv : offset_y_uv + (scaled_height // 2),
-        offset_x_uv : offset_x_uv + (scaled_width // 2),
-    ] = scaled_u
-    final_v[
-        offset_y_uv : offset_y_uv + (scaled_height // 2),
-        offset_x_uv : offset_x_uv + (scaled_width // 2),
-    ] = scaled_v
-
-    # 7) Flatten back to I420 layout and return bytes
-    return np.concatenate([final_y.flatten(), final_u.flatten(), final_v.flatten()]).astype(np.uint8).tobytes()
-
-
 class VideoInputStream:
     def __init__(self, video_input_manager, user_id, stream_type, share_source_id):
         self.video_input_manager = video_input_manager
@@ -167,7 +77,7 @@ class VideoInputStream:
         if current_time - self.last_frame_time >= 0.25 and self.raw_data_status == zoom.RawData_Off:
             # Create a black frame of the same dimensions
             black_frame = create_black_i420_frame(self.video_input_manager.video_frame_size)
-            self.video_input_manager.new_frame_callback(black_frame, time.time_ns())
+            self.video_input_manager.video_frame_processor.add_frame(black_frame, self.video_input_manager.video_frame_size, time.time_ns())
             logger.info(f"In VideoInputStream.send_black_frame for user {self.user_id} sent black frame")
 
         return not self.renderer_destroyed  # Continue timer if not cleaned up
@@ -209,8 +119,14 @@ class VideoInputStream:
             logger.debug(f"In VideoInputStream.on_raw_video_frame_received_callback for user {self.user_id} received frame")
             self.last_debug_frame_time = time.time()
 
-        scaled_i420_frame = scale_i420(data, self.video_input_manager.video_frame_size)
-        self.video_input_manager.new_frame_callback(scaled_i420_frame, current_time_ns)
+        # The frame is only valid during this callback, so copy the planes before handing them to the worker pool
+        self.video_input_manager.video_frame_processor.add_frame_planes(
+            bytes(data.GetYBuffer()),
+            bytes(data.GetUBuffer()),
+            bytes(data.GetVBuffer()),
+            (data.GetStreamWidth(), data.GetStreamHeight()),
+            current_time_ns,
+        )
 
 
 class VideoInputManager:
@@ -228,6 +144,7 @@ class VideoInputManager:
         self.video_frame_size = video_frame_size
         self.mode = None
         self.input_streams = []
+        self.video_frame_processor = VideoFrameProcessor(output_callback=new_frame_callback, output_size=video_frame_size)
 
     def has_any_video_input_streams(self):
         return len(self.input_streams) > 0
@@ -255,6 +172,7 @@ class VideoInputManager:
     def cleanup(self):
         for input_stream in self.input_streams:
             input_stream.cleanup()
+        self.video_frame_processor.cleanup()
 
     def set_mode(self, *, mode, active_speaker_id, active_sharer_id, active_sharer_source_id):
         if mode != VideoInputManager.Mode.ACTIVE_SPEAKER and mode != VideoInputManager.Mode.ACTIVE_SHARER: